@@ -0,0 +1,49 @@
+import sys
+import timeit
+import numpy as np
+from pathlib import Path
+
+# normalize_dicom is a module of the preprocessing scripts folders (same file in LIDC-IDRI and Head-Neck-PET-CT)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'preprocessing_scripts' / 'LIDC-IDRI'))
+import normalize_dicom
+
+
+arguments = {
+    'shape': (512, 512),
+    'repeat': 50,
+    # (name, dtype, window width, window center, rescale slope, rescale intercept)
+    'cases': [
+        ('CT lung int16', 'int16', 1500.0, -600.0, 1.0, -1024.0),
+        ('CT mediastinum uint16', 'uint16', 350.0, 50.0, 1.0, -1024.0),
+        ('PET float32', 'float32', 30000.0, 15000.0, 1.0, 0.0),
+    ],
+    }
+
+
+"""
+Description: micro-benchmark of the windowing of normalize_dicom.get_LUT_value,
+compared with the np.piecewise reference implementation.
+Checks that both outputs are bit-identical, and prints the time per slice and the speedup
+Params:
+    shape     - Required  : shape of the random slices
+    repeat    - Required  : number of calls timed for each case
+    cases     - Required  : data type and window/rescale values of each benchmarked case
+Returns:
+    - No return value
+"""
+rng = np.random.default_rng(0)
+
+for name, dtype, width, center, slope, intercept in arguments['cases']:
+    data = rng.integers(0, 4096, size=arguments['shape']).astype(dtype)
+    window = (width, center, slope, intercept)
+
+    reference = normalize_dicom._get_LUT_value_piecewise(data, *window)
+    result = normalize_dicom.get_LUT_value(data, *window)
+    assert reference.dtype == result.dtype and np.array_equal(reference, result), f"{name}: outputs differ!"
+
+    time_reference = timeit.timeit(lambda: normalize_dicom._get_LUT_value_piecewise(data, *window), number=arguments['repeat'])
+    time_result = timeit.timeit(lambda: normalize_dicom.get_LUT_value(data, *window), number=arguments['repeat'])
+
+    print(f"{name:25s} piecewise: {1000 * time_reference / arguments['repeat']:7.3f} ms/slice   " +\
+          f"get_LUT_value: {1000 * time_result / arguments['repeat']:7.3f} ms/slice   " +\
+          f"speedup: {time_reference / time_result:5.1f}x")
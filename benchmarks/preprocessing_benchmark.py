@@ -0,0 +1,326 @@
+import os
+import ast
+import sys
+import json
+import time
+import runpy
+import shutil
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+import pydicom
+from pathlib import Path
+
+import synthetic_datasets
+
+ROOT = Path(__file__).resolve().parents[1]
+SCRIPTS_FOLDER = ROOT / 'preprocessing_scripts'
+# Modules of the scripts folders (normalize_dicom, segmentation_mask and dicom_index are the same in LIDC-IDRI and Head-Neck-PET-CT)
+sys.path[:0] = [str(SCRIPTS_FOLDER), str(SCRIPTS_FOLDER / 'LIDC-IDRI'), str(SCRIPTS_FOLDER / 'BUSI')]
+import array_store
+import dicom_index
+import lidc_xml
+import normalize_dicom
+import segmentation_mask
+import busi_engine
+
+
+arguments = {
+    'work_folder': "benchmarks/synthetic", # Folder of the generated data sets and of the outputs of the scripts
+    'results_file': "benchmarks/results.json", # JSON file of the results, None only prints them
+    'scripts': ['LIDC-IDRI', 'Head-Neck-PET-CT', 'BraTS2019', 'BUSI', 'BUSI-jonas', 'convert_to_0_1'], # Benchmarked scripts, see SCRIPTS
+    'repeat': 3, # Number of end to end runs of each script (the best time is the one to compare)
+    'stages': True, # Also time the stages (scan, parse, decode, normalize, rasterize, write) in this process
+    'generate': True, # Generate the data sets again (False reuses the data sets of work_folder)
+    'npatients': 4, # Size of the data sets, see synthetic_datasets
+    'nslices': 32,
+    'ncontours': 4,
+    'nreaders': 4,
+    'nimages': 40,
+    'shape': (128, 128),
+    'seed': 0,
+    'script_arguments': {'LIDC-IDRI': {}, 'Head-Neck-PET-CT': {}, 'BraTS2019': {}, 'BUSI': {}, 'BUSI-jonas': {}, 'convert_to_0_1': {}}, # Arguments of the scripts, e.g. {'BraTS2019': {'workers': 4}}
+    }
+
+
+"""
+Description: end to end benchmark of the preprocessing scripts, on synthetic data sets (see synthetic_datasets).
+Each script runs in its own Python process, with its arguments dict pointing to the synthetic data set
+(and to a new output folder for each run), and is timed from start to exit.
+The stages of each data set are also timed separately in this process, with the functions used by the scripts,
+one stage for all the files at once: scan (list the files / index the series), parse (XML, RTSTRUCT, NIfTI headers),
+decode (pixel data), normalize (windowing / dtype), rasterize (contours to masks) and write (.npy files).
+convert_to_0_1 converts a copy of the output of the last BUSI run.
+Params:
+    work_folder        - Required  : folder of the data sets and of the outputs
+    results_file       - Required  : path of the JSON results, or None
+    scripts            - Required  : names of the benchmarked scripts
+    repeat             - Required  : number of end to end runs of each script
+    stages             - Required  : time the stages of each data set
+    generate           - Required  : generate the data sets
+    npatients ... seed - Required  : parameters of the data sets (see synthetic_datasets)
+    script_arguments   - Required  : arguments of each script, added to the paths set by the benchmark
+Returns:
+    - No return value
+"""
+
+# Script path (relative to the repository), data set, and what the script asks on the standard input
+SCRIPTS = {
+    'LIDC-IDRI': ('preprocessing_scripts/LIDC-IDRI/LIDC-IDRI_preprocessing.py', 'LIDC-IDRI', "s\n"),
+    'Head-Neck-PET-CT': ('preprocessing_scripts/Head-Neck-PET-CT/head-neck_preprocessing.py', 'Head-Neck-PET-CT', ""),
+    'BraTS2019': ('preprocessing_scripts/BraTS2019/BraTS2019_preprocessing.py', 'BraTS2019', ""),
+    'BUSI': ('preprocessing_scripts/BUSI/busi_preprocessing.py', 'BUSI', ""),
+    'BUSI-jonas': ('preprocessing_scripts/BUSI/busi_preprocessing_jonas.py', 'BUSI', ""),
+    'convert_to_0_1': ('convert_to_0_1.py', None, ""),
+}
+
+
+def script_with_arguments(script_path, new_arguments):
+    """Get the source of a script, with new values in its arguments dict
+    @params:
+        script_path     - Required : Path to the script
+        new_arguments   - Required : dictionary of the changed arguments (keys of the arguments dict of the script)
+    Returns:
+        - Source code, with the same number of lines (the line numbers of the errors are those of the script)
+    """
+    source = Path(script_path).read_text()
+    # First assignment 'arguments = {...}' (the scripts also have commented out dicts)
+    node = next(node for node in ast.parse(source).body
+                if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == 'arguments' for target in node.targets))
+    script_arguments = ast.literal_eval(node.value)
+    unknown = set(new_arguments) - set(script_arguments)
+    if unknown:
+        raise ValueError(f"{script_path} has no arguments {sorted(unknown)}")
+    script_arguments.update(new_arguments)
+
+    lines = source.splitlines(keepends=True)
+    replacement = f"arguments = {script_arguments!r}\n" + "\n" * (node.end_lineno - node.lineno)
+    return ''.join(lines[:node.lineno - 1]) + replacement + ''.join(lines[node.end_lineno:])
+
+
+
+def run_script(script_path, new_arguments, stdin=""):
+    """Run a script in a new Python process, with new arguments
+    @params:
+        script_path     - Required : Path to the script
+        new_arguments   - Required : dictionary of the changed arguments
+        stdin           - Optional : text given on the standard input (answers of input())
+    Returns:
+        - Time (seconds) from the start of the process to its exit
+        - CompletedProcess (return code and outputs)
+    """
+    script_path = Path(script_path)
+    # Next to the script, so that its imports (and its paths relative to __file__) are unchanged
+    run_path = script_path.parent / f"_benchmark_{os.getpid()}_{script_path.name}"
+    run_path.write_text(script_with_arguments(script_path, new_arguments))
+    try:
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, str(run_path)], input=stdin, capture_output=True, text=True)
+        seconds = time.perf_counter() - start
+    finally:
+        run_path.unlink()
+    return seconds, process
+
+
+
+def count_files(folder):
+    """Number and total size (bytes) of the files of a folder"""
+    nfiles, nbytes = 0, 0
+    for path in Path(folder).rglob('*'):
+        if path.is_file():
+            nfiles += 1
+            nbytes += path.stat().st_size
+    return nfiles, nbytes
+
+
+
+class StageTimer:
+    """Total time of each stage"""
+
+    def __init__(self):
+        self.seconds = {}
+
+    def time(self, stage, function, *args, **kwargs):
+        """Call a function, and add its time to the stage"""
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+
+
+def lidc_stages(paths, output_folder):
+    """Time the stages of the LIDC-IDRI segmentation task, returns {stage: seconds}"""
+    dataset_folder = paths['dataset_folder']
+    timer = StageTimer()
+    series = timer.time('scan', lambda: [(serie_path, dicom_index.build_z_index(serie_path))
+                                         for serie_path in sorted(Path(dataset_folder).glob('*/*/*'))])
+    rois = timer.time('parse', lambda: [(z_index, roi) for serie_path, z_index in series
+                                        for nodule in lidc_xml.iter_nodules(next(serie_path.glob('*.xml')))
+                                        if nodule.malignancy in [4, 5] for roi in nodule.rois])
+    rois = [(dicom_index.find_slice(z_index, roi.z_position), roi) for z_index, roi in rois]
+    slices = timer.time('decode', lambda: {path: pydicom.dcmread(path) for path, _roi in rois if path is not None})
+    for dicom in slices.values():
+        timer.time('decode', lambda: dicom.pixel_array)
+    images = timer.time('normalize', lambda: {path: normalize_dicom.get_normalized_array(dicom) for path, dicom in slices.items()})
+    masks = timer.time('rasterize', lambda: [segmentation_mask.create_segmentation_mask(slices[path], roi.contour, None, conversion=False)
+                                             for path, roi in rois if path is not None])
+    timer.time('write', write_arrays, output_folder, list(images.values()) + masks)
+    return timer.seconds
+
+
+
+def head_neck_stages(paths, output_folder):
+    """Time the stages of the Head-Neck-PET-CT script (GTV of each RTSTRUCT), returns {stage: seconds}"""
+    dataset_folder = paths['dataset_folder']
+    head_neck = runpy.run_path(str(SCRIPTS_FOLDER / 'Head-Neck-PET-CT' / 'head-neck_preprocessing.py'), run_name='benchmark')
+    roi_names = pd.concat(pd.read_excel(paths['roinames_excel'], sheet_name=None), ignore_index=True)
+    roi_names = dict(zip(roi_names['Patient'], roi_names['Name GTV Primary']))
+    timer = StageTimer()
+    # Modality of the first file of each series, and SOPInstanceUID index of the images series
+    def scan():
+        rt_paths, sop_index = [], {}
+        for serie_path in sorted(Path(dataset_folder).glob('*/*/*')):
+            dicom_path = next(Path.iterdir(serie_path))
+            if pydicom.dcmread(dicom_path, stop_before_pixels=True, specific_tags=[dicom_index.MODALITY]).Modality == 'RTSTRUCT':
+                rt_paths.append((dicom_path, roi_names[serie_path.relative_to(dataset_folder).parts[0]]))
+            else:
+                sop_index.update(dicom_index.build_sop_index(serie_path))
+        return rt_paths, sop_index
+    rt_paths, sop_index = timer.time('scan', scan)
+    contours = timer.time('parse', lambda: [contour for rt_path, roi_name in rt_paths
+                                            for contour in head_neck['get_roi_contours'](pydicom.dcmread(rt_path), roi_name)])
+    slices = timer.time('decode', lambda: {uid: pydicom.dcmread(sop_index[uid][0]) for uid, _contour in contours})
+    for dicom in slices.values():
+        timer.time('decode', lambda: dicom.pixel_array)
+    images = timer.time('normalize', lambda: [normalize_dicom.get_normalized_array(dicom) for dicom in slices.values()])
+    masks = timer.time('rasterize', lambda: [segmentation_mask.create_segmentation_mask(slices[uid], contour, None, conversion=True)
+                                             for uid, contour in contours])
+    timer.time('write', write_arrays, output_folder, images + masks)
+    return timer.seconds
+
+
+
+def brats_stages(paths, output_folder):
+    """Time the stages of the BraTS2019 script (whole volumes, 'float32' images), returns {stage: seconds}"""
+    dataset_folder = paths['dataset_folder']
+    brats = runpy.run_path(str(SCRIPTS_FOLDER / 'BraTS2019' / 'BraTS2019_preprocessing.py'), run_name='benchmark')
+    timer = StageTimer()
+    volume_paths = timer.time('scan', lambda: sorted(path for path in Path(dataset_folder).glob('*/*/*') if '.nii' in path.name))
+    volumes = timer.time('parse', lambda: [brats['open_volume'](path) for path in volume_paths])
+    slabs = timer.time('decode', lambda: [(brats['read_slab'](volume, 0, volume.shape[2]), scaling) for volume, scaling in volumes])
+    # Real values in float32, as read_slab() with image_dtype 'float32'
+    images = timer.time('normalize', lambda: [slab.astype(np.float32) * np.float32(scaling['slope']) + np.float32(scaling['intercept'])
+                                              if scaling is not None else slab.astype(np.float32) for slab, scaling in slabs])
+    timer.time('write', write_arrays, output_folder, [image for slab in images for image in slab])
+    return timer.seconds
+
+
+
+def busi_stages(paths, output_folder):
+    """Time the stages of the BUSI scripts, returns {stage: seconds}"""
+    dataset_folder = paths['dataset_folder']
+    timer = StageTimer()
+    images = timer.time('scan', lambda: [image for category in ['benign', 'malignant']
+                                         for image in busi_engine.list_images(Path(dataset_folder) / category)])
+    arrays = timer.time('decode', lambda: [busi_engine.load_gray(path) for image_path, mask_paths in images
+                                           for path in [image_path] + mask_paths])
+    timer.time('write', write_arrays, output_folder, arrays)
+    return timer.seconds
+
+
+
+def write_arrays(output_folder, arrays):
+    """Save arrays as .npy files (one per array), as the 'npy' backend of the scripts"""
+    Path.mkdir(Path(output_folder), parents=True, exist_ok=True)
+    for index, array in enumerate(arrays):
+        array_store.save_array(output_folder, Path(output_folder) / f"{index}.npy", array)
+
+
+STAGES = {'LIDC-IDRI': lidc_stages, 'Head-Neck-PET-CT': head_neck_stages, 'BraTS2019': brats_stages, 'BUSI': busi_stages}
+
+
+
+if __name__ == "__main__":
+    work_folder = Path(arguments['work_folder']).resolve()
+    datasets_folder = work_folder / 'datasets'
+    outputs_folder = work_folder / 'outputs'
+
+    # Generate the data sets used by the scripts
+    datasets = {SCRIPTS[name][1] for name in arguments['scripts'] if SCRIPTS[name][1] is not None}
+    if 'convert_to_0_1' in arguments['scripts']:
+        datasets.add('BUSI')
+    dataset_paths = {}
+    generation = {}
+    for dataset in sorted(datasets):
+        dataset_folder = datasets_folder / dataset
+        start = time.perf_counter()
+        if arguments['generate']:
+            shutil.rmtree(dataset_folder, ignore_errors=True)
+            dataset_paths[dataset] = synthetic_datasets.make_dataset(dataset, dataset_folder, arguments['npatients'], arguments['nslices'],
+                                                                     arguments['ncontours'], arguments['nreaders'], arguments['nimages'],
+                                                                     tuple(arguments['shape']), arguments['seed'])
+        else:
+            dataset_paths[dataset] = {'dataset_folder': str(dataset_folder)}
+            if dataset == 'Head-Neck-PET-CT':
+                dataset_paths[dataset]['roinames_excel'] = str(datasets_folder / f"{dataset}_INFO_GTVcontours_HN.xlsx")
+        nfiles, nbytes = count_files(dataset_folder)
+        generation[dataset] = {'seconds': time.perf_counter() - start, 'files': nfiles, 'bytes': nbytes}
+        print(f"{dataset}: {nfiles} files, {nbytes / 1024**2:.1f} MB", flush=True)
+
+    results = {
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+        'parameters': {key: value for key, value in arguments.items() if key not in ['work_folder', 'results_file']},
+        'datasets': generation,
+        'scripts': {},
+    }
+
+    # End to end runs, in a new output folder each time
+    for name in arguments['scripts']:
+        script_path, dataset, stdin = SCRIPTS[name]
+        runs = []
+        for run in range(arguments['repeat']):
+            output_folder = outputs_folder / name
+            shutil.rmtree(output_folder, ignore_errors=True)
+            if name == 'convert_to_0_1':
+                # Converted in place, a copy of the output of the last BUSI run
+                busi_output = outputs_folder / 'BUSI'
+                if not busi_output.exists():
+                    raise RuntimeError("convert_to_0_1 converts the output of BUSI, benchmark BUSI first")
+                shutil.copytree(busi_output, output_folder)
+                new_arguments = {'root_folder': str(output_folder)}
+            else:
+                Path.mkdir(output_folder, parents=True)
+                new_arguments = {**dataset_paths[dataset], 'output_folder': str(output_folder)}
+            new_arguments.update(arguments['script_arguments'].get(name, {}))
+
+            seconds, process = run_script(ROOT / script_path, new_arguments, stdin)
+            if process.returncode != 0:
+                print(process.stdout[-2000:], process.stderr[-4000:], sep='\n')
+                raise RuntimeError(f"{name} failed (return code {process.returncode})")
+            runs.append(seconds)
+            print(f"{name} run {run + 1}: {seconds:.2f} s", flush=True)
+
+        nfiles, nbytes = count_files(outputs_folder / name)
+        results['scripts'][name] = {'seconds': runs, 'best': min(runs), 'output_files': nfiles, 'output_bytes': nbytes}
+
+    # Stages, in this process
+    if arguments['stages']:
+        # Compile the fill of the masks (if numba is installed) before it is timed
+        segmentation_mask.rasterize_polygon(np.array([[0, 0], [2, 0], [2, 2]]), 4, 4)
+        for dataset in sorted(datasets & set(STAGES)):
+            stages_folder = outputs_folder / f"stages_{dataset}"
+            shutil.rmtree(stages_folder, ignore_errors=True)
+            seconds = STAGES[dataset](dataset_paths[dataset], stages_folder)
+            shutil.rmtree(stages_folder, ignore_errors=True)
+            results.setdefault('stages', {})[dataset] = seconds
+            print(f"{dataset} stages: " + ', '.join(f"{stage} {value:.3f} s" for stage, value in seconds.items()), flush=True)
+
+    if arguments['results_file'] is not None:
+        with open(arguments['results_file'], mode='w') as file:
+            json.dump(results, file, indent=4)
+        print(f"\nResults saved in {arguments['results_file']}")
+    else:
+        print(json.dumps(results, indent=4))
@@ -0,0 +1,424 @@
+import numpy as np
+import pandas as pd
+import pydicom
+import nibabel as nib
+from PIL import Image
+from pathlib import Path
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid, CTImageStorage, PositronEmissionTomographyImageStorage, RTStructureSetStorage
+
+
+arguments = {
+    'output_folder': "benchmarks/synthetic",
+    'datasets': ['LIDC-IDRI', 'Head-Neck-PET-CT', 'BraTS2019', 'BUSI'], # Data sets to generate, in output_folder/<name>
+    'npatients': 4, # Number of patients (LIDC-IDRI, Head-Neck-PET-CT, BraTS2019), half HGG and half LGG for BraTS2019
+    'nslices': 32, # Number of slices of each series / volume
+    'ncontours': 4, # Number of contours: nodules per reader (LIDC-IDRI), slices of the GTV (Head-Neck-PET-CT)
+    'nreaders': 4, # Number of readers of each LIDC-IDRI nodule
+    'nimages': 40, # Number of images of each BUSI category
+    'shape': (128, 128), # (rows, columns) of the slices and images
+    'seed': 0, # Seed of the random values, the same parameters give the same files (except the DICOM UIDs)
+    }
+
+
+"""
+Description: generators of small synthetic data sets with the structure of the real ones,
+to run (and benchmark) the preprocessing scripts without the clinical data:
+    - LIDC-IDRI         : DICOM CT series, with the XML file of the readers (nodules contoured by several readers)
+    - Head-Neck-PET-CT  : DICOM CT and PET series, an RTSTRUCT contouring the GTV (and another ROI), and the roi names excel file
+    - BraTS2019         : NIfTI volumes of the four modalities and the segmentation (labels 1, 2, 4), HGG and LGG
+    - BUSI              : PNG images (RGB) and masks (one or more per image), benign / malignant / normal
+The pixel values are random (noise and brighter lesions): the files exercise the code paths and the sizes, not the content.
+Params:
+    output_folder   - Required  : folder of the generated data sets
+    datasets        - Required  : names of the data sets to generate
+    npatients       - Required  : number of patients
+    nslices         - Required  : number of slices of each series / volume
+    ncontours       - Required  : number of nodules per reader (LIDC-IDRI), of contoured slices (Head-Neck-PET-CT)
+    nreaders        - Required  : number of readers of the LIDC-IDRI nodules
+    nimages         - Required  : number of images of each BUSI category
+    shape           - Required  : shape of the slices and images
+    seed            - Required  : seed of the random values
+Returns:
+    - No return value
+"""
+
+# Position of the first pixel and spacing (in mm) of the DICOM slices
+ORIGIN = (-200.0, -200.0)
+PIXEL_SPACING = 0.8
+SLICE_THICKNESS = 2.5
+
+
+def random_contour(center, radii, rng, npoints=48):
+    """Get a closed contour around a center, an ellipse with a random (smooth) radius
+    @params:
+        center    - Required : (x, y) center of the contour
+        radii     - Required : (x, y) mean radii
+        rng       - Required : NumPy random Generator
+        npoints   - Optional : number of points
+    Returns:
+        - (npoints, 2) float array of the (x, y) points
+    """
+    angles = np.linspace(0, 2 * np.pi, npoints, endpoint=False)
+    # Sum of a few harmonics, so that the contour is irregular but not self-intersecting
+    scale = 1 + sum(rng.uniform(-0.08, 0.08) * np.cos(k * angles + rng.uniform(0, 2 * np.pi)) for k in range(2, 5))
+    return np.stack([center[0] + radii[0] * scale * np.cos(angles),
+                     center[1] + radii[1] * scale * np.sin(angles)], axis=1)
+
+
+
+def write_dicom_slice(path, z_position, series_uid, modality, shape, rng, lesions=()):
+    """Write one DICOM slice (CT or PET), with the tags read by the preprocessing scripts
+    @params:
+        path         - Required : path of the DICOM file
+        z_position   - Required : z position of the slice (in mm)
+        series_uid   - Required : SeriesInstanceUID
+        modality     - Required : 'CT' or 'PT'
+        shape        - Required : (rows, columns)
+        rng          - Required : NumPy random Generator
+        lesions      - Optional : (x, y) points of contours (in pixels), filled with brighter values
+    Returns:
+        - SOPInstanceUID of the slice
+    """
+    sop_class = CTImageStorage if modality == 'CT' else PositronEmissionTomographyImageStorage
+    sop_uid = generate_uid()
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = sop_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = Dataset()
+    dataset.file_meta = meta
+    dataset.SOPClassUID = sop_class
+    dataset.SOPInstanceUID = sop_uid
+    dataset.SeriesInstanceUID = series_uid
+    dataset.Modality = modality
+    dataset.ImagePositionPatient = [ORIGIN[0], ORIGIN[1], float(z_position)]
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.PixelSpacing = [PIXEL_SPACING, PIXEL_SPACING]
+    dataset.SliceThickness = SLICE_THICKNESS
+    dataset.Rows, dataset.Columns = shape
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    if modality == 'CT':
+        # Stored values of an int16 CT, in Hounsfield units after the rescale
+        dataset.PixelRepresentation = 1
+        dataset.RescaleSlope, dataset.RescaleIntercept = 1, -1024
+        dataset.WindowCenter, dataset.WindowWidth = -600, 1500
+        pixels = rng.integers(0, 1400, size=shape)
+        lesion_value = 1100
+    else:
+        dataset.PixelRepresentation = 0
+        dataset.RescaleSlope, dataset.RescaleIntercept = 0.5, 0
+        dataset.WindowCenter, dataset.WindowWidth = 15000, 30000
+        pixels = rng.integers(0, 8000, size=shape)
+        lesion_value = 30000
+
+    rows, columns = np.mgrid[0:shape[0], 0:shape[1]]
+    for contour in lesions:
+        center, radius = contour.mean(axis=0), np.abs(contour - contour.mean(axis=0)).max()
+        pixels[(columns - center[0]) ** 2 + (rows - center[1]) ** 2 <= radius ** 2] += lesion_value
+    dtype = np.int16 if modality == 'CT' else np.uint16
+    dataset.PixelData = pixels.astype(dtype).tobytes()
+    dataset.save_as(path, enforce_file_format=True)
+    return sop_uid
+
+
+
+def make_lidc(dataset_folder, npatients, nslices, nnodules, nreaders, shape, seed=0):
+    """Generate an LIDC-IDRI data set: patient/study/series folders, with the DICOM slices and the XML file
+    @params:
+        dataset_folder   - Required : Path to the data set folder
+        npatients        - Required : number of patients (one series each)
+        nslices          - Required : number of slices of each series
+        nnodules         - Required : number of nodules of each patient (malignancy 1 to 5), contoured by each reader
+        nreaders         - Required : number of reading sessions (readers) of the XML file
+        shape            - Required : (rows, columns) of the slices
+        seed             - Optional : seed of the random values
+    """
+    rng = np.random.default_rng(seed)
+    for patient in range(npatients):
+        serie_path = Path(dataset_folder) / f"LIDC-IDRI-{patient:04d}" / generate_uid() / generate_uid()
+        serie_path.mkdir(parents=True, exist_ok=True)
+        z_positions = -SLICE_THICKNESS * np.arange(nslices)
+
+        # Nodules: center (pixels), radii, first slice and number of slices, malignancy
+        nodules = []
+        for nodule in range(nnodules):
+            extent = int(rng.integers(2, min(6, nslices) + 1))
+            nodules.append({
+                'center': rng.uniform(0.25, 0.75, size=2) * shape[::-1],
+                'radii': rng.uniform(0.03, 0.08, size=2) * min(shape),
+                'first': int(rng.integers(0, nslices - extent + 1)),
+                'extent': extent,
+                'malignancy': nodule % 5 + 1,
+            })
+
+        # Contours of each reader (a few pixels apart from the other readers), and the lesions of each slice
+        contours = {}
+        lesions = [[] for _ in range(nslices)]
+        for reader in range(nreaders):
+            for index, nodule in enumerate(nodules):
+                shift = rng.normal(0, 1.5, size=2)
+                for i in range(nodule['first'], nodule['first'] + nodule['extent']):
+                    contour = random_contour(nodule['center'] + shift, nodule['radii'], rng)
+                    contour = np.clip(np.rint(contour), 0, np.array(shape[::-1]) - 1).astype(int)
+                    contours[(reader, index, i)] = contour
+                    if reader == 0:
+                        lesions[i].append(contour)
+
+        series_uid = generate_uid()
+        sop_uids = [write_dicom_slice(serie_path / f"{i + 1:06d}.dcm", z_positions[i], series_uid, 'CT', shape, rng, lesions[i])
+                    for i in range(nslices)]
+
+        sessions = []
+        for reader in range(nreaders):
+            elements = []
+            for index, nodule in enumerate(nodules):
+                rois = []
+                for i in range(nodule['first'], nodule['first'] + nodule['extent']):
+                    edge_maps = ''.join(f"<edgeMap><xCoord>{x}</xCoord><yCoord>{y}</yCoord></edgeMap>"
+                                        for x, y in contours[(reader, index, i)])
+                    rois.append(f"<roi><imageZposition>{z_positions[i]:.6f}</imageZposition><imageSOP_UID>{sop_uids[i]}</imageSOP_UID>"
+                                f"<inclusion>TRUE</inclusion>{edge_maps}</roi>")
+                elements.append(f"<unblindedReadNodule><noduleID>Nodule {index + 1:03d}</noduleID><characteristics>"
+                                f"<subtlety>3</subtlety><malignancy>{nodule['malignancy']}</malignancy></characteristics>"
+                                f"{''.join(rois)}</unblindedReadNodule>")
+            # Nodule < 3mm (no characteristics) and non-nodule, skipped by the scripts
+            x, y = (int(value) for value in rng.integers(0, min(shape), size=2))
+            elements.append(f"<unblindedReadNodule><noduleID>small-{reader}</noduleID><roi><imageZposition>{z_positions[0]:.6f}</imageZposition>"
+                            f"<imageSOP_UID>{sop_uids[0]}</imageSOP_UID><inclusion>TRUE</inclusion>"
+                            f"<edgeMap><xCoord>{x}</xCoord><yCoord>{y}</yCoord></edgeMap></roi></unblindedReadNodule>")
+            elements.append(f"<nonNodule><nonNoduleID>non-{reader}</nonNoduleID><imageZposition>{z_positions[-1]:.6f}</imageZposition>"
+                            f"<locus><xCoord>{x}</xCoord><yCoord>{y}</yCoord></locus></nonNodule>")
+            sessions.append(f"<readingSession><annotationVersion>3.12</annotationVersion><servicingRadiologistID>{reader}</servicingRadiologistID>"
+                            f"{''.join(elements)}</readingSession>")
+
+        with open(serie_path / "069.xml", mode='w') as file:
+            file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                       f'<LidcReadMessage xmlns="http://www.nih.gov" uid="{generate_uid()}">'
+                       f"<ResponseHeader><Version>1.8.1</Version><SeriesInstanceUid>{series_uid}</SeriesInstanceUid></ResponseHeader>"
+                       f"{''.join(sessions)}</LidcReadMessage>\n")
+
+
+
+def write_rtstruct(path, referenced_series_uid, sop_uids, rois):
+    """Write an RTSTRUCT referencing an images series
+    @params:
+        path                    - Required : path of the DICOM file
+        referenced_series_uid   - Required : SeriesInstanceUID of the contoured images
+        sop_uids                - Required : SOPInstanceUID of each slice of the images series
+        rois                    - Required : dictionary {ROI name: list of (slice index, (N, 3) contour points in mm)}
+    """
+    sop_uid = generate_uid()
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = RTStructureSetStorage
+    meta.MediaStorageSOPInstanceUID = sop_uid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dataset = Dataset()
+    dataset.file_meta = meta
+    dataset.SOPClassUID = RTStructureSetStorage
+    dataset.SOPInstanceUID = sop_uid
+    dataset.SeriesInstanceUID = generate_uid()
+    dataset.Modality = 'RTSTRUCT'
+
+    referenced_series = Dataset()
+    referenced_series.SeriesInstanceUID = referenced_series_uid
+    referenced_study = Dataset()
+    referenced_study.RTReferencedSeriesSequence = Sequence([referenced_series])
+    referenced_frame = Dataset()
+    referenced_frame.RTReferencedStudySequence = Sequence([referenced_study])
+    dataset.ReferencedFrameOfReferenceSequence = Sequence([referenced_frame])
+
+    structure_set_rois = []
+    roi_contours = []
+    for number, (name, contours) in enumerate(rois.items(), start=1):
+        structure_set_roi = Dataset()
+        structure_set_roi.ROINumber = number
+        structure_set_roi.ROIName = name
+        structure_set_rois.append(structure_set_roi)
+
+        contour_sequence = []
+        for index, points in contours:
+            contour_image = Dataset()
+            contour_image.ReferencedSOPInstanceUID = sop_uids[index]
+            contour = Dataset()
+            contour.ContourImageSequence = Sequence([contour_image])
+            contour.ContourGeometricType = 'CLOSED_PLANAR'
+            contour.NumberOfContourPoints = len(points)
+            contour.ContourData = [f"{value:.4f}" for value in points.ravel()]
+            contour_sequence.append(contour)
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = number
+        roi_contour.ContourSequence = Sequence(contour_sequence)
+        roi_contours.append(roi_contour)
+
+    dataset.StructureSetROISequence = Sequence(structure_set_rois)
+    dataset.ROIContourSequence = Sequence(roi_contours)
+    dataset.save_as(path, enforce_file_format=True)
+
+
+
+def make_head_neck(dataset_folder, roinames_excel, npatients, nslices, ncontours, shape, seed=0):
+    """Generate a Head-Neck-PET-CT data set: patient/study/series folders (CT, PET, RTSTRUCT), and the roi names excel file
+    @params:
+        dataset_folder   - Required : Path to the data set folder
+        roinames_excel   - Required : Path of the excel file of the GTV names (one sheet per center)
+        npatients        - Required : number of patients
+        nslices          - Required : number of slices of the CT and PET series
+        ncontours        - Required : number of CT slices contoured in the GTV ROI (and in the other ROI)
+        shape            - Required : (rows, columns) of the slices
+        seed             - Optional : seed of the random values
+    """
+    rng = np.random.default_rng(seed)
+    centers = ['CHUM', 'CHUS', 'HGJ', 'HMR']
+    rows = {center: [] for center in centers}
+    for patient in range(npatients):
+        center = centers[patient % len(centers)]
+        patient_id = f"HN-{center}-{patient:03d}"
+        gtv_name = 'GTV' if patient % 2 == 0 else 'GTV-P'
+        rows[center].append({'Patient': patient_id, 'Name GTV Primary': gtv_name})
+        study_path = Path(dataset_folder) / patient_id / generate_uid()
+        z_positions = -SLICE_THICKNESS * np.arange(nslices)
+
+        # GTV contours (mm) on consecutive slices, and a second ROI on the same slices
+        first = int(rng.integers(0, nslices - min(ncontours, nslices) + 1))
+        rois = {gtv_name: [], 'Body': []}
+        lesions = [[] for _ in range(nslices)]
+        center_pixels = rng.uniform(0.3, 0.7, size=2) * shape[::-1]
+        for i in range(first, first + min(ncontours, nslices)):
+            contour = random_contour(center_pixels, rng.uniform(0.05, 0.1, size=2) * min(shape), rng)
+            lesions[i].append(contour)
+            body = random_contour(np.array(shape[::-1]) / 2, 0.45 * np.array(shape[::-1]), rng)
+            for name, points in [(gtv_name, contour), ('Body', body)]:
+                points_mm = np.column_stack([ORIGIN[0] + PIXEL_SPACING * points[:, 0], ORIGIN[1] + PIXEL_SPACING * points[:, 1],
+                                             np.full(len(points), z_positions[i])])
+                rois[name].append((i, points_mm))
+
+        uids = {}
+        for modality in ['CT', 'PT']:
+            serie_path = study_path / f"{modality}-{generate_uid()}"
+            serie_path.mkdir(parents=True, exist_ok=True)
+            series_uid = generate_uid()
+            uids[modality] = (series_uid, [write_dicom_slice(serie_path / f"1-{i + 1:03d}.dcm", z_positions[i], series_uid, modality,
+                                                             shape, rng, lesions[i]) for i in range(nslices)])
+
+        rt_path = study_path / f"RTSTRUCT-{generate_uid()}"
+        rt_path.mkdir(parents=True, exist_ok=True)
+        write_rtstruct(rt_path / "1-1.dcm", uids['CT'][0], uids['CT'][1], rois)
+
+    with pd.ExcelWriter(roinames_excel) as writer:
+        for center in centers:
+            pd.DataFrame(rows[center], columns=['Patient', 'Name GTV Primary']).to_excel(writer, sheet_name=center, index=False)
+
+
+
+def make_brats(dataset_folder, npatients, nslices, shape, seed=0, compressed=False):
+    """Generate a BraTS2019 data set: HGG and LGG folders, with one folder of NIfTI volumes per patient
+    @params:
+        dataset_folder   - Required : Path to the data set folder
+        npatients        - Required : number of patients (the first half HGG, the second half LGG)
+        nslices          - Required : number of slices of the volumes
+        shape            - Required : (x, y) of the slices
+        seed             - Optional : seed of the random values
+        compressed       - Optional : save .nii.gz files (as the released data set) instead of .nii
+    """
+    rng = np.random.default_rng(seed)
+    extension = '.nii.gz' if compressed else '.nii'
+    x, y, z = np.mgrid[0:shape[0], 0:shape[1], 0:nslices]
+    for patient in range(npatients):
+        grade = 'HGG' if patient < (npatients + 1) // 2 else 'LGG'
+        name = f"BraTS19_{grade}_{patient:03d}_1"
+        patient_path = Path(dataset_folder) / grade / name
+        patient_path.mkdir(parents=True, exist_ok=True)
+
+        # Tumor: an ellipsoid with nested regions, edema (2) / enhancing tumor (4) / necrosis (1)
+        center = rng.uniform(0.35, 0.65, size=3) * np.array([shape[0], shape[1], nslices])
+        radii = rng.uniform(0.1, 0.2, size=3) * np.array([shape[0], shape[1], nslices])
+        distance = np.sqrt(((x - center[0]) / radii[0]) ** 2 + ((y - center[1]) / radii[1]) ** 2 + ((z - center[2]) / radii[2]) ** 2)
+        segmentation = np.zeros(distance.shape, dtype=np.int16)
+        segmentation[distance <= 1] = 2
+        segmentation[distance <= 0.6] = 4
+        segmentation[distance <= 0.3] = 1
+
+        affine = np.diag([-1.0, -1.0, 1.0, 1.0])
+        nib.save(nib.Nifti1Image(segmentation, affine), patient_path / f"{name}_seg{extension}")
+        for modality in ['t1', 't1ce', 't2', 'flair']:
+            volume = rng.integers(0, 1500, size=distance.shape) + 1500 * (distance <= 1)
+            nib.save(nib.Nifti1Image(volume.astype(np.int16), affine), patient_path / f"{name}_{modality}{extension}")
+
+
+
+def make_busi(dataset_folder, nimages, shape, seed=0, multiple_masks=0.1):
+    """Generate a BUSI data set: benign, malignant and normal folders, with the PNG images and masks
+    @params:
+        dataset_folder   - Required : Path to the data set folder
+        nimages          - Required : number of images of each category
+        shape            - Required : (rows, columns) of the images
+        seed             - Optional : seed of the random values
+        multiple_masks   - Optional : fraction of the (benign and malignant) images with two masks
+    """
+    rng = np.random.default_rng(seed)
+    rows, columns = np.mgrid[0:shape[0], 0:shape[1]]
+    for category in ['benign', 'malignant', 'normal']:
+        category_path = Path(dataset_folder) / category
+        category_path.mkdir(parents=True, exist_ok=True)
+        for i in range(1, nimages + 1):
+            image = rng.integers(0, 160, size=shape)
+            # No lesion in the normal images, (empty) masks anyway as in the released data set
+            nlesions = 0 if category == 'normal' else 2 if rng.random() < multiple_masks else 1
+            masks = []
+            for _ in range(max(nlesions, 1)):
+                mask = np.zeros(shape, dtype=np.uint8)
+                if nlesions > 0:
+                    center = rng.uniform(0.2, 0.8, size=2) * shape
+                    radii = rng.uniform(0.05, 0.15, size=2) * shape
+                    mask[((rows - center[0]) / radii[0]) ** 2 + ((columns - center[1]) / radii[1]) ** 2 <= 1] = 255
+                    image[mask > 0] //= 3
+                masks.append(mask)
+
+            # The images are saved as RGB (as most of the released images), the masks as grayscale
+            Image.fromarray(np.repeat(image.astype(np.uint8)[..., None], 3, axis=2), mode='RGB').save(category_path / f"{category} ({i}).png")
+            for index, mask in enumerate(masks):
+                suffix = '_mask' if index == 0 else f'_mask_{index}'
+                Image.fromarray(mask, mode='L').save(category_path / f"{category} ({i}){suffix}.png")
+
+
+
+def make_dataset(name, dataset_folder, npatients=4, nslices=32, ncontours=4, nreaders=4, nimages=40, shape=(128, 128), seed=0):
+    """Generate one of the data sets, with the parameters of the __main__ arguments
+    @params:
+        name             - Required : 'LIDC-IDRI', 'Head-Neck-PET-CT', 'BraTS2019' or 'BUSI'
+        dataset_folder   - Required : Path to the data set folder (the Head-Neck-PET-CT excel file is written next to it)
+    Returns:
+        - Dictionary of the paths to give to the preprocessing script (dataset_folder, and roinames_excel for Head-Neck-PET-CT)
+    """
+    dataset_folder = Path(dataset_folder)
+    dataset_folder.mkdir(parents=True, exist_ok=True)
+    paths = {'dataset_folder': str(dataset_folder)}
+    if name == 'LIDC-IDRI':
+        make_lidc(dataset_folder, npatients, nslices, ncontours, nreaders, shape, seed)
+    elif name == 'Head-Neck-PET-CT':
+        paths['roinames_excel'] = str(dataset_folder.parent / f"{dataset_folder.name}_INFO_GTVcontours_HN.xlsx")
+        make_head_neck(dataset_folder, paths['roinames_excel'], npatients, nslices, ncontours, shape, seed)
+    elif name == 'BraTS2019':
+        make_brats(dataset_folder, npatients, nslices, shape, seed)
+    elif name == 'BUSI':
+        make_busi(dataset_folder, nimages, shape, seed)
+    else:
+        raise ValueError(f"Unknown data set {name}")
+    return paths
+
+
+
+if __name__ == "__main__":
+    for name in arguments['datasets']:
+        paths = make_dataset(name, Path(arguments['output_folder']) / name, arguments['npatients'], arguments['nslices'],
+                             arguments['ncontours'], arguments['nreaders'], arguments['nimages'], tuple(arguments['shape']),
+                             arguments['seed'])
+        print(f"{name}: {paths}")
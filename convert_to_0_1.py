@@ -1,29 +1,189 @@
 import numpy as np
+import json
 import os
+import sys
+from pathlib import Path
+from functools import partial
 
-root_folder = "./test_folder"
+# Modules shared by the preprocessing scripts
+sys.path.append(str(Path(__file__).resolve().parent / 'preprocessing_scripts'))
+import parallel_driver
+
+
+arguments = {
+    'root_folder': "./test_folder",
+    'dtype': 'float32', # dtype of the converted arrays, 'float32', 'float64', or 'keep' to keep the files and record a scale factor
+    'workers': None, # Number of processes checking (and converting) different files in parallel, None uses all the CPUs
+    'dry_run': False, # Only report the files that would be converted, and the size difference
+    }
+
+
+"""
+Description: this script converts the arrays of an output folder to [0,1], following the dtype policy of the
+output folder ('dtypes.json' header written by the preprocessing scripts, see preprocessing_scripts/dtype_policy.py):
+    - uint8 images, and binary masks whose max value is > 1 (0/255): divided by 255
+    - label maps (masks of a header with 'labels', e.g. BraTS2019 {0, 1, 2, 4}): divided by the largest label
+      (as the 'float64' masks of BraTS2019), whatever their max value, while they are still integers
+    - images saved with image_dtype 'native', 'float32' or 'float64' (Hounsfield units, NIfTI intensities),
+      and bit-packed masks: kept as they are, they are not 8 bits values
+The outputs of the previous versions (no header) are converted as before: arrays whose max value is > 1 are divided by 255.
+The arrays are checked through memory maps (only their values are read, no copy),
+and the converted files are replaced atomically (temporary file, then rename).
+With dtype 'keep', the files are not modified: the scale factor (1/255, 1/largest label) of each file to convert
+is recorded in 'convert_to_0_1.json' in the root folder, and must be applied when the arrays are loaded.
+Params:
+    root_folder   - Required  : folder explored recursively
+    dtype         - Required  : 'float32', 'float64' (previous behavior, twice the size) or 'keep'
+    workers       - Required  : number of worker processes (each file is processed independently)
+    dry_run       - Required  : report what would change, without modifying anything
+Returns:
+    - No return value
+"""
+
+SCALES_NAME = 'convert_to_0_1.json'
+HEADER_NAME = 'dtypes.json'
 
-def main():
-    modified_files = 0
-    maintained_files = 0
+
+def get_divisor(file_name, header):
+    """Get how the values of an array are brought to [0,1], following the dtype policy of its output folder
+    @params:
+        file_name   - Required : name of the .npy file
+        header      - Required : 'dtypes.json' header of the output folder, None for the outputs of previous versions
+    Returns:
+        - Divisor of the values, None if the array is kept as it is
+        - True if the array is always divided (label maps), False if only when its max value is > 1
+    """
+    if header is None:
+        return 255, False
+    if '_mask' in file_name:
+        # Bit-packed masks are not pixel values
+        if header['mask_dtype'] == 'packbits':
+            return None, False
+        if header.get('labels'):
+            return max(header['labels']), True
+        return 255, False
+    # Native / real values, not 8 bits windowed values
+    if header.get('image_dtype', 'uint8') != 'uint8':
+        return None, False
+    return 255, False
+
+
+
+def list_files(root_folder):
+    """List the .npy files to check, with the divisor of their values (see get_divisor())
+    @params:
+        root_folder   - Required : folder explored recursively
+    Returns:
+        - List of tuples (path, divisor, always) of the files to check
+        - Number of files skipped
+    """
+    files_to_check = []
+    skipped = 0
+    # Header of each folder, from the 'dtypes.json' of the output folder containing it
+    headers = {}
+    # Without trailing separator, the parent of each walked folder is os.path.dirname() of it
+    root_folder = os.path.normpath(root_folder)
 
     # Recursively explore all subfolders
     for (root, dirs, files) in os.walk(root_folder, topdown=True):
-        # Act on each npy file
+        headers[root] = headers.get(os.path.dirname(root))
+        if HEADER_NAME in files:
+            with open(os.path.join(root, HEADER_NAME), mode='r') as file:
+                headers[root] = json.load(file)
         for file in [f for f in files if f.endswith(".npy")]:
-            # Load file
-            ary = np.load(root + '/' + file)
-            # Check max and min value
-            max_val, min_val = np.max(ary), np.min(ary)
-            # Convert to [0,1] if necessary
-            if max_val > 1:
-                ary = ary / 255
-                modified_files += 1
-                np.save(root + '/' + file, ary)
-            else:
-                maintained_files += 1
-    print(f"Files modified: {modified_files}")
-    print(f"Files maintained: {maintained_files}")
+            divisor, always = get_divisor(file, headers[root])
+            if divisor is None:
+                skipped += 1
+                continue
+            files_to_check.append((root + '/' + file, divisor, always))
+    return files_to_check, skipped
+
+
+
+def convert_file(file_to_check, dtype, dry_run):
+    """Check the values of one array, and convert it to [0,1] if needed
+    @params:
+        file_to_check   - Required : tuple (path to the .npy file, divisor, always), see list_files()
+        dtype           - Required : 'float32', 'float64' or 'keep'
+        dry_run         - Required : do not modify the file
+    Returns:
+        - Dictionary with the counters modified and maintained, the sizes of the modified files before and after
+          the conversion (bytes), and the scale factors ('keep')
+    """
+    path, divisor, always = file_to_check
+    maintained = {'modified': 0, 'maintained': 1}
+    # Memory map: the header is parsed, the values are read from the page cache without a copy
+    array = np.load(path, mmap_mode='r')
+    # Boolean masks are already in [0,1]
+    if array.dtype == np.bool_ or array.size == 0:
+        return maintained
+    if always:
+        # Label maps are divided once, while they are integers (not again if the script runs twice)
+        if array.dtype.kind not in 'iu':
+            return maintained
+    # Check max value
+    elif np.max(array) <= 1:
+        return maintained
+
+    result = {'modified': 1, 'maintained': 0, 'bytes_before': os.path.getsize(path)}
+    if dtype == 'keep':
+        result['bytes_after'] = result['bytes_before']
+        result['scales'] = [[path, 1 / divisor]]
+        return result
+
+    # Same values as the previous version (division in float64), cast to the wanted dtype
+    header_size = result['bytes_before'] - array.nbytes
+    result['bytes_after'] = header_size + array.size * np.dtype(dtype).itemsize
+    if dry_run:
+        return result
+
+    converted = np.divide(array, divisor, dtype=np.float64).astype(dtype, copy=False)
+    del array
+    # Atomic replacement, the file is never partially written
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, mode='wb') as file:
+        np.save(file, converted)
+    os.replace(temporary_path, path)
+    result['bytes_after'] = os.path.getsize(path)
+    return result
+
+
+
+def main():
+    root_folder = arguments['root_folder']
+    dtype = arguments['dtype']
+    if dtype not in ['float32', 'float64', 'keep']:
+        raise ValueError(f"Unknown dtype {dtype}")
+
+    files_to_check, skipped = list_files(root_folder)
+    # Many small work units, sent by chunks to the workers
+    results = parallel_driver.run(partial(convert_file, dtype=dtype, dry_run=arguments['dry_run']), files_to_check,
+                                  arguments['workers'], chunksize=256)
+    results = parallel_driver.merge_results(results)
+
+    modified_files = results.get('modified', 0)
+    maintained_files = results.get('maintained', 0) + skipped
+    bytes_before = results.get('bytes_before', 0)
+    bytes_after = results.get('bytes_after', 0)
+
+    # Scale factors of the files kept as they are, relative to the root folder
+    if dtype == 'keep' and not arguments['dry_run']:
+        scales = {os.path.relpath(path, root_folder): scale for path, scale in results.get('scales', [])}
+        with open(Path(root_folder) / SCALES_NAME, mode='w') as file:
+            json.dump({'description': "Multiply these arrays by their scale when loading them", 'scales': scales},
+                      file, indent=4)
+
+    if arguments['dry_run']:
+        print("Dry run, no file modified")
+        print(f"Files to modify: {modified_files}")
+        print(f"Files to maintain: {maintained_files}")
+        print(f"Size of the files to modify: {bytes_before} bytes, after conversion: {bytes_after} bytes " +\
+              f"({bytes_after - bytes_before:+} bytes)")
+    else:
+        print(f"Files modified: {modified_files}")
+        print(f"Files maintained: {maintained_files}")
+        print(f"Size of the modified files: {bytes_before} bytes before, {bytes_after} bytes after " +\
+              f"({bytes_after - bytes_before:+} bytes)")
 
 
 
@@ -0,0 +1,115 @@
+import re
+import sys
+import numpy as np
+from PIL import Image
+from pathlib import Path
+from fnmatch import fnmatch
+
+# Modules shared by all the preprocessing scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import array_store
+import dtype_policy
+
+
+"""
+Description: conversion engine shared by the BUSI scripts (busi_preprocessing.py and busi_preprocessing_jonas.py).
+The category folders are listed once, and each image is converted with its masks in one work unit:
+PNG decoding, vectorized merge of the masks, and save with the array_store backend.
+"""
+
+IMAGE_PATTERN = re.compile(r"^([a-z]+) \(([0-9]+)\).png$")
+
+
+def list_images(category_path):
+    """List the images of a category folder with their masks, reading the folder only once
+    @params:
+        category_path   - Required : Path to the category folder (benign, malignant or normal)
+    Returns:
+        - List of tuples (image path, list of the mask paths), in the order of the folder
+    """
+    image_paths = []
+    # Dictionary {image name without extension: list of the mask paths}
+    mask_paths = {}
+    # iterdir() returns the files in the same order as glob()
+    for path in Path.iterdir(category_path):
+        name = path.name
+        if fnmatch(name, "*(*).png"):
+            image_paths.append(path)
+        elif fnmatch(name, "*_mask*.png"):
+            mask_paths.setdefault(name[:name.index('_mask')], []).append(path)
+
+    return [(image_path, mask_paths.get(image_path.stem, [])) for image_path in image_paths]
+
+
+
+def load_gray(path):
+    """Open a PNG file and convert it to a uint8 array (L for Luminance, 8-bits pixels, 1-channel)"""
+    with Image.open(path) as image:
+        return np.asarray(image.convert('L'))
+
+
+
+def merge_masks(masks, mode='or'):
+    """Merge the masks of one image, pixel-wise with whole-array operations
+    @params:
+        masks   - Required : list of uint8 arrays of the same shape
+        mode    - Optional : 'or' keeps the first non-zero value of each pixel (elementwise 'a or b' of the masks),
+                             'label' gives the pixels of the i-th mask the label i + 1 (first mask wins if they overlap)
+    """
+    if mode == 'or':
+        merged = masks[0].copy()
+        for mask in masks[1:]:
+            np.copyto(merged, mask, where=(merged == 0))
+        return merged
+    elif mode == 'label':
+        merged = np.zeros(masks[0].shape, dtype=np.uint8)
+        for label, mask in enumerate(masks, start=1):
+            merged[(merged == 0) & (mask != 0)] = label
+        return merged
+    else:
+        raise ValueError(f"Unknown merge mode {mode}")
+
+
+
+def convert_image(image_path, mask_paths, images_output_path, masks_output_path, output_folder,
+                  merge=None, mask_dtype='uint8', backend='npy', statistics=None):
+    """Save the image and its masks as numpy arrays
+    @params:
+        image_path           - Required : Path to the image PNG file
+        mask_paths           - Required : list of the Paths to its mask PNG files
+        images_output_path   - Required : Path to the images output folder
+        masks_output_path    - Required : Path to the masks output folder
+        output_folder        - Required : Path to the output folder
+        merge                - Optional : None saves each mask ('_mask0', '_mask1'...), 'or' or 'label' saves
+                                          one merged mask ('_mask0'), see merge_masks()
+        mask_dtype           - Optional : dtype of the masks (see dtype_policy)
+        backend              - Optional : 'npy' or 'shards' (see array_store)
+        statistics           - Optional : dataset_statistics.DatasetStatistics updated with the image and its masks
+    Returns:
+        - Number of masks saved, None if the file name is not an image name
+    """
+    match = IMAGE_PATTERN.search(image_path.name)
+    if not match:
+        return None
+    # group(1,2) returns a tuple containing both groups submatches for the regex
+    category, number = match.group(1,2)
+
+    # Convert and save the image
+    file_name = f"{category}{number}"
+    image = load_gray(image_path)
+    array_store.save_array(output_folder, images_output_path / f"{file_name}.npy", image, backend)
+    if statistics is not None:
+        statistics.add_image('image', image)
+
+    masks = [load_gray(mask_path) for mask_path in mask_paths]
+    if merge is not None and len(masks) > 0:
+        masks = [merge_masks(masks, merge)]
+
+    for index, mask in enumerate(masks):
+        if statistics is not None:
+            statistics.add_mask(mask)
+        mask = dtype_policy.encode_mask(mask, mask_dtype)
+        array_store.save_array(output_folder, masks_output_path / f"{file_name}_mask{index}.npy", mask, backend)
+
+    array_store.commit(output_folder, backend)
+    return len(masks)
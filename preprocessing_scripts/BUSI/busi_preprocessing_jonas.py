@@ -1,7 +1,14 @@
-import numpy as np
-from PIL import Image
 from pathlib import Path
-import re
+import sys
+from functools import partial
+import busi_engine
+
+# Modules shared by all the preprocessing scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import parallel_driver
+import array_store
+import dtype_policy
+import dataset_statistics
 
 
 arguments = {
@@ -9,6 +16,10 @@ arguments = {
     'dataset_folder': "/media/jonas/Seagate Expansion Drive/Memoria/master_thesis/Dataset_BUSI_with_GT",
     # 'output_folder': "dataset_processing/busi/output",
     'output_folder': "/media/jonas/Seagate Expansion Drive/Memoria/master_thesis/Dataset_BUSI_output",
+    'workers': None, # Number of processes (or threads) working on different images in parallel, None uses all the CPUs
+    'pool': 'thread', # 'thread' (PNG decoding releases the GIL) or 'process'
+    'output_backend': 'npy', # 'npy' for one file per array, 'shards' to pack the arrays in output_folder/shards (see array_store)
+    'mask_dtype': 'uint8', # 'uint8' (0/255, as the PNG), 'bool', 'packbits' (8 pixels per byte) or 'float64' (see dtype_policy)
     }
 
 
@@ -19,6 +30,10 @@ in the given output folder
 Params:
     dataset_folder   - Required  : folder containing the BUSI dataset
     output_folder    - Required  : output folder
+    workers          - Required  : number of workers (each image is processed independently)
+    pool             - Required  : 'thread' or 'process', pool of the workers
+    output_backend   - Required  : 'npy' or 'shards', how the arrays are stored (see array_store)
+    mask_dtype       - Required  : dtype of the masks, 'uint8', 'bool', 'packbits' or 'float64' (see dtype_policy)
 Returns:
     - No return value
 """
@@ -33,100 +48,90 @@ Benignant and malignant tumor are created in different folders, and 'normal' ima
 
 Images and masks are saved in the save folder
 """
-# Get the arguments
-dataset_folder = Path(arguments['dataset_folder'])
-output_folder = Path(arguments['output_folder'])
-
-# The slash operator '/' in the pathlib module is similar to os.path.join()
-# images_output_path = output_folder / "img"
-# masks_output_path = output_folder / "masks"
-# Path.mkdir(images_output_path, exist_ok=True)
-# Path.mkdir(masks_output_path, exist_ok=True)
-Path.mkdir(output_folder, exist_ok=True)
-Path.mkdir(output_folder / 'normal', exist_ok=True)
-Path.mkdir(output_folder / 'malignant', exist_ok=True)
-Path.mkdir(output_folder / 'benign', exist_ok=True)
-
-
-# Define elementwise 'or' to merge masks, as vfunc
-def elwise_or(a, b):
-    return a or b
-
-vfunc_or = np.vectorize(elwise_or)
-
-
-# benign, malignant and normal
-categories_names = Path.iterdir(dataset_folder)
-
-ntotal = 0
-
-for category_path in categories_names:
-    # name returns a string representing the final path component
-    # normal category have no tumors
-    if category_path.name == 'normal':
-        # TODO: Save randomly (or alternately) in begnignant/malignant folder
-         # -> Better to do it with train/test/val preprocessing script
-        images_output_path = output_folder / "normal"
-    elif category_path.name == 'malignant':
-        images_output_path = output_folder / "malignant"
-    elif category_path.name == 'benign':
-        images_output_path = output_folder / "benign"
-
+def process_image(image_infos, output_folder):
+    """Save the image and its merged masks as numpy arrays, in the same folder
+    @params:
+        image_infos     - Required : tuple (Path to the image PNG file, list of the Paths to its masks,
+                                     Path to the output folder of the image category)
+        output_folder   - Required : Path to the output folder
+    """
+    image_path, mask_paths, images_output_path = image_infos
     # Save masks with images
     masks_output_path = images_output_path
 
-    # glob() matches files with the given pattern
-    # It returns a generator containing the matched paths
-    image_paths_list = category_path.glob("*(*).png")
-
-    # Need to cast to list because generators do not have len()
-    ntotal = ntotal + len(list(Path.iterdir(category_path)))
-
-    for image_path in image_paths_list:
-        image_name = image_path.name
-        match = re.search(r"^([a-z]+) \(([0-9]+)\).png$", image_name)
-        if match:
-            # group(1,2) returns a tuple containing both groups submatches for the regex
-            category, number = match.group(1,2)
-
-            # Open, convert and save the image
-            file_name = f"{category}{number}"
-            destination_path = images_output_path / Path(file_name).with_suffix('.npy')
-            image = Image.open(image_path)
-            # L for Luminance, 8-bits pixels, 1-channel
-            image = image.convert('L')
-            np.save(destination_path, image)
-
-            # Merge masks (elementwise or)
-            mask_paths = category_path.glob(f"{category} ({number})_mask*.png")
-            masks = []
-            for index, mask_path in enumerate(mask_paths):
-                # Open, convert and save the mask
-                mask_name = file_name + f"_mask{index}"
-                # mask_destination_path = masks_output_path / Path(mask_name).with_suffix('.npy')
-                mask = Image.open(mask_path)
-                # L for Luminance, 8-bits pixels, 1-channel
-                mask = mask.convert('L')
-                masks.append([mask_name, mask])
-
-            if len(masks) == 1:
-                np.save(masks_output_path / masks[0][0], masks[0][1])
-            elif len(masks) > 1:
-                mask_name = masks[0][0]
-                mask = np.asarray(masks[0][1])
-                for i in range(1, len(masks)):
-                    mask = vfunc_or(mask, np.asarray(masks[i][1]))
-                np.save(masks_output_path / mask_name, mask)
-            else:
-                print(f'No mask found for file {file_name}!!')
-
-            print('.', end='', flush=True)
-
-
-# Sanity checks
-# print(f"\nTotal numbers of slices (ntotal): {ntotal}")
-# nimg = len(list(Path.iterdir(images_output_path)))
-# nmasks = len(list(Path.iterdir(masks_output_path)))
-# print(f"Expected: nimg + nmasks == ntotal")
-# print(f"{nimg} + {nmasks} = {nimg + nmasks} (expected {ntotal})")
-# assert (nimg + nmasks) == ntotal, "File numbers do not match!"
+    # Statistics of the image and its masks, merged with the other images at the end
+    statistics = dataset_statistics.DatasetStatistics()
+    # Merge masks (elementwise or)
+    nmasks = busi_engine.convert_image(image_path, mask_paths, images_output_path, masks_output_path, output_folder,
+                                       merge='or', mask_dtype=arguments['mask_dtype'], backend=arguments['output_backend'],
+                                       statistics=statistics)
+    if nmasks is not None:
+        if nmasks == 0:
+            print(f'No mask found for file {image_path.name}!!')
+        print('.', end='', flush=True)
+
+    return {'statistics': [statistics.to_dict()]}
+
+
+
+
+# Main
+if __name__ == "__main__":
+    # Get the arguments
+    dataset_folder = Path(arguments['dataset_folder'])
+    output_folder = Path(arguments['output_folder'])
+    # Images are uint8 (L mode PNG)
+    dtype_policy.check_policy('uint8', arguments['mask_dtype'])
+
+    # The slash operator '/' in the pathlib module is similar to os.path.join()
+    # images_output_path = output_folder / "img"
+    # masks_output_path = output_folder / "masks"
+    # Path.mkdir(images_output_path, exist_ok=True)
+    # Path.mkdir(masks_output_path, exist_ok=True)
+    Path.mkdir(output_folder, exist_ok=True)
+    Path.mkdir(output_folder / 'normal', exist_ok=True)
+    Path.mkdir(output_folder / 'malignant', exist_ok=True)
+    Path.mkdir(output_folder / 'benign', exist_ok=True)
+
+
+    # benign, malignant and normal
+    categories_names = Path.iterdir(dataset_folder)
+
+    ntotal = 0
+    # Each image is an independent work unit, (image path, mask paths, output folder of its category)
+    work_units = []
+
+    for category_path in categories_names:
+        # name returns a string representing the final path component
+        # normal category have no tumors
+        if category_path.name == 'normal':
+            # TODO: Save randomly (or alternately) in begnignant/malignant folder
+             # -> Better to do it with train/test/val preprocessing script
+            images_output_path = output_folder / "normal"
+        elif category_path.name == 'malignant':
+            images_output_path = output_folder / "malignant"
+        elif category_path.name == 'benign':
+            images_output_path = output_folder / "benign"
+
+        # Images and their masks, the folder is read once
+        work_units.extend((image_path, mask_paths, images_output_path)
+                          for image_path, mask_paths in busi_engine.list_images(category_path))
+
+        # Need to cast to list because generators do not have len()
+        ntotal = ntotal + len(list(Path.iterdir(category_path)))
+
+    results = parallel_driver.run(partial(process_image, output_folder=output_folder), work_units, arguments['workers'],
+                                  pool=arguments['pool'], chunksize=16)
+    results = parallel_driver.merge_results(results)
+    dtype_policy.save_header(output_folder, 'uint8', arguments['mask_dtype'])
+    # Intensity and mask statistics of the whole data set, computed while the arrays were written
+    dataset_statistics.save_summary(output_folder, dataset_statistics.merge(results.get('statistics', [])), image_dtype='uint8')
+
+
+    # Sanity checks
+    # print(f"\nTotal numbers of slices (ntotal): {ntotal}")
+    # nimg = len(list(Path.iterdir(images_output_path)))
+    # nmasks = len(list(Path.iterdir(masks_output_path)))
+    # print(f"Expected: nimg + nmasks == ntotal")
+    # print(f"{nimg} + {nmasks} = {nimg + nmasks} (expected {ntotal})")
+    # assert (nimg + nmasks) == ntotal, "File numbers do not match!"
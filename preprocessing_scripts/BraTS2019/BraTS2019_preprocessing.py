@@ -4,14 +4,32 @@ from xml.dom import minidom
 from pathlib import Path
 import nibabel as nib
 import os
+import sys
 from tqdm import tqdm
+from functools import partial
+
+# Modules shared by all the preprocessing scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import parallel_driver
+import checkpoint
+import array_store
+import dtype_policy
+import dataset_statistics
 
 
 
 arguments = {
     'dataset_folder': "/media/jonas/Seagate Expansion Drive/Memoria/master_thesis/DSetsCristophe/HealthyCopy/BraTS2019",
     'output_folder': "/media/jonas/Seagate Expansion Drive/Memoria/master_thesis/Dataset_BraTS2019_output",
-    'min_mask_pixels': 20, # Minimum number of 'active' pixels in a mask to be kept
+    'min_mask_pixels': 20, # Minimum number of 'active' pixels in a mask to be kept, slices with fewer (but not 0) are dropped
+    'workers': None, # Number of processes working on different patients in parallel, None uses all the CPUs
+    'resume': True, # Skip the patients completed by a previous run with the same parameters (see output_folder/manifest.jsonl)
+    'output_backend': 'npy', # 'npy' for one file per array, 'shards' to pack the arrays in output_folder/shards (see array_store)
+    'image_dtype': 'native', # 'native' for the stored values (int16), 'float32', or 'float64' (values of get_fdata())
+    'mask_dtype': 'uint8', # 'uint8' labels (0, 1, 2, 4), 'bool', 'packbits' (one plane per label) or 'float64' (labels / 4)
+    'layout': 'modalities', # 'modalities' for one file per modality, 'stacked' for one (4, H, W) file per slice
+    'slab_size': 16, # Number of slices read at once from the memory-mapped volumes, None reads whole volumes
+    'histogram_range': (0, 8192), # (min, max) of the intensity histograms in output_folder/statistics.json (values as saved)
     }
 
 
@@ -21,11 +39,21 @@ and creates numpy arrays in the given output folder
 Params:
     dataset_folder   - Required  : folder containing the data set
     output_folder    - Required  : output folders
+    min_mask_pixels  - Required  : slices whose mask has between 1 and min_mask_pixels-1 pixels are not saved
+    workers          - Required  : number of worker processes (each patient is processed independently)
+    resume           - Required  : resume an interrupted run, only the patients not completed are processed
+    output_backend   - Required  : 'npy' or 'shards', how the arrays are stored (see array_store)
+    image_dtype      - Required  : dtype of the images, 'native', 'float32' or 'float64' (see dtype_policy)
+    mask_dtype       - Required  : dtype of the masks, 'uint8', 'bool', 'packbits' or 'float64' (see dtype_policy)
+    layout           - Required  : 'modalities' (one folder per modality) or 'stacked' (channels t1, t1ce, t2, flair)
+    slab_size        - Required  : number of slices read at once, bounds the memory used by each worker
+    histogram_range  - Required  : range of the 256 bins of the intensity histograms (see dataset_statistics)
 Returns:
     - No return value
 
 
-In the output folder, the results are separated as follows:
+In the output folder, the results are separated as follows (with the 'shards' backend, these paths are the keys
+of the arrays in output_folder/shards, see array_store.ShardReader):
 
 - Output_folder
     - HGG
@@ -66,66 +94,280 @@ In the output folder, the results are separated as follows:
         - mask
             - filename_slice_W.npy
             - filename_slice_Z.npy
+        - stacked           -> With the 'stacked' layout, instead of the 4 modality folders
+            - empty_mask
+                - filename_slice_X.npy  -> (4, H, W) array, channels t1, t1ce, t2, flair (see 'channels' in dtypes.json)
+            - with_mask
+                - filename_slice_W.npy
+        - index
+            - filename.csv  -> One row per slice: foreground and per-label pixel counts, bounding box of the mask,
+                               and folder of the slice ('with_mask', 'empty_mask' or 'dropped')
 
 """
 
 
 
-# Get the arguments
-dataset_folder = Path(arguments['dataset_folder'])
-output_folder = Path(arguments['output_folder'])
+# Modalities, in the order of the channels of the 'stacked' layout
+MODALITIES = ['t1', 't1ce', 't2', 'flair']
+
+# Labels of the segmentation masks (1: necrotic and non-enhancing tumor core, 2: peritumoral edema, 4: enhancing tumor)
+LABELS = [1, 2, 4]
+
+
+
+def open_volume(volume_path):
+    """Open a NIfTI volume without reading its data
+    @params:
+        volume_path   - Required : path to the NIfTI file
+    Returns:
+        - Array (x, y, z) of the stored values (e.g. int16): a read-only memory map for uncompressed files,
+          an array read once for compressed files (.nii.gz)
+        - Dictionary {'slope', 'intercept'} to get the real values (real = slope * stored + intercept),
+          None if the stored values are the real values
+    """
+    volume = nib.load(volume_path)
+    # The array proxy knows where the data is, without reading it
+    proxy = volume.dataobj
+    slope, intercept = float(proxy.slope), float(proxy.inter)
+    scaling = None if (slope, intercept) == (1.0, 0.0) else {'slope': slope, 'intercept': intercept}
+
+    if str(volume_path).endswith('.nii'):
+        # The data is stored (in Fortran order) after the header, the OS reads only the slices that are used
+        stored = np.memmap(volume_path, dtype=proxy.dtype, mode='r', offset=int(proxy.offset),
+                           shape=proxy.shape, order=proxy.order)
+    else:
+        stored = volume.dataobj.get_unscaled()
+    return stored, scaling
+
+
+
+def read_slab(volume, first, last, image_dtype='native', scaling=None):
+    """Read the slices [first, last[ of a volume
+    @params:
+        volume        - Required : array (x, y, z) returned by open_volume()
+        first         - Required : first slice of the slab
+        last          - Required : end of the slab (excluded)
+        image_dtype   - Optional : 'native' for the stored values, 'float32' or 'float64' for the real values
+        scaling       - Optional : scaling returned by open_volume()
+    Returns:
+        - C-contiguous array (slices, x, y), slab[i] is the slice volume[:,:,first+i]
+    """
+    # Transposed once for the whole slab, each slice is then contiguous (no strided copy when it is saved)
+    slab = np.ascontiguousarray(np.transpose(volume[:, :, first:last], (2, 0, 1)))
+    if image_dtype == 'native':
+        return slab
+
+    # Same values as get_fdata()
+    slab = slab.astype(image_dtype)
+    if scaling is not None:
+        slab *= scaling['slope']
+        slab += scaling['intercept']
+    return slab
 
 
-# Create folders
-for grade in ['HGG', 'LGG']:
-    # Images folder
-    for type in ['t1', 't1ce', 't2', 'flair']:
-        for mask_type in ['empty_mask', 'with_mask']:
-            os.makedirs(f'{output_folder}/{grade}/{type}/{mask_type}', exist_ok=True)
-    # Mask folder
-    os.makedirs(f'{output_folder}/{grade}/mask', exist_ok=True)
 
+def mask_statistics(mask, first, min_mask_pixels):
+    """Compute the statistics of all the slices of a mask slab at once
+    @params:
+        mask              - Required : uint8 array (slices, x, y) returned by read_slab()
+        first             - Required : index of the first slice of the slab
+        min_mask_pixels   - Required : slices with fewer foreground pixels (but not 0) are dropped
+    Returns:
+        - DataFrame with one row per slice: slice, foreground, label_1, label_2, label_4,
+          row_min, row_max, col_min, col_max (-1 for an empty mask), folder
+    """
+    nslices = mask.shape[0]
+    # Count of each label value in each slice, in one pass: bincount of (slice index * 256 + label)
+    pixels = mask.reshape(nslices, -1)
+    counts = np.bincount((np.arange(nslices)[:, None] * 256 + pixels).ravel(), minlength=nslices * 256)
+    counts = counts.reshape(nslices, 256)
+    foreground = pixels.shape[1] - counts[:, 0]
 
-# HGG / LGG
-for grade_path in Path.iterdir(dataset_folder):
+    # Bounding box, from the rows and the columns that contain foreground pixels
+    is_foreground = mask > 0
+    rows = is_foreground.any(axis=2)
+    cols = is_foreground.any(axis=1)
+    empty = foreground == 0
+    bounding_box = {
+        'row_min': np.argmax(rows, axis=1),
+        'row_max': rows.shape[1] - 1 - np.argmax(rows[:, ::-1], axis=1),
+        'col_min': np.argmax(cols, axis=1),
+        'col_max': cols.shape[1] - 1 - np.argmax(cols[:, ::-1], axis=1),
+    }
+    for name in bounding_box:
+        bounding_box[name][empty] = -1
+
+    # Folder of each slice
+    folder = np.where(empty, 'empty_mask', np.where(foreground < min_mask_pixels, 'dropped', 'with_mask'))
+
+    return pd.DataFrame({
+        'slice': np.arange(first, first + nslices),
+        'foreground': foreground,
+        **{f'label_{label}': counts[:, label] for label in LABELS},
+        **bounding_box,
+        'folder': folder,
+    })
+
+
+
+def process_patient(patient_path, grade_name, output_folder):
+    """Save the slices of the four modalities, and the non-empty masks, of one patient
+    @params:
+        patient_path    - Required : Path to the patient folder
+        grade_name      - Required : 'HGG' or 'LGG'
+        output_folder   - Required : Path to the output folder
+    Returns:
+        - Dictionary with the counters nb_with_mask, nb_empty_mask and nb_dropped, the list of the files saved,
+          the scaling of the 'native' volumes, and the statistics of the saved slices and masks
+    """
     # Count added
     nb_with_mask = 0
     nb_empty_mask = 0
-    # Get grade name
-    grade_name = str(grade_path).split('/')[-1]
-    # Patient
-    if not os.path.isdir(grade_path): continue
-    for patient_path in Path.iterdir(grade_path):
-        patient_name = str(patient_path).split('/')[-1]
-        # Load data
-        mask = nib.load(f'{patient_path}/{patient_name}_seg.nii').get_fdata()
-        t1 = nib.load(f'{patient_path}/{patient_name}_t1.nii').get_fdata()
-        t1ce = nib.load(f'{patient_path}/{patient_name}_t1ce.nii').get_fdata()
-        t2 = nib.load(f'{patient_path}/{patient_name}_t2.nii').get_fdata()
-        flair = nib.load(f'{patient_path}/{patient_name}_flair.nii').get_fdata()
-        # Iterate over each slice
-        for slice in tqdm(range(mask.shape[2])):
-            # Check if the mask is empty or not
-            is_mask = np.max(mask[:,:,slice]) > 0
-            # mask_pixels = len(mask[:,:,slice][mask[:,:,slice] > 0])
-            if is_mask: # and mask_pixels >= arguments['min_mask_pixels']:
+    nb_dropped = 0
+    files = []
+    normalization = []
+    # Statistics of the saved slices (per modality) and masks, computed slab by slab
+    dataset_stats = dataset_statistics.DatasetStatistics(value_range=arguments['histogram_range'])
+    # Atomic save (temporary file and rename, or shards), returns the saved array key
+    save = lambda path, array: files.append(array_store.save_array(output_folder, path, array, arguments['output_backend']))
+
+    patient_name = str(patient_path).split('/')[-1]
+    # Open the volumes, the data is read slab by slab
+    mask_volume, _scaling = open_volume(f'{patient_path}/{patient_name}_seg.nii')
+    volumes = {}
+    scalings = {}
+    for modality in MODALITIES:
+        volumes[modality], scalings[modality] = open_volume(f'{patient_path}/{patient_name}_{modality}.nii')
+        if scalings[modality] is not None and arguments['image_dtype'] == 'native':
+            normalization.append([f'{grade_name}/{patient_name}_{modality}', scalings[modality]])
+
+    nslices = mask_volume.shape[2]
+    slab_size = arguments['slab_size'] or nslices
+    min_mask_pixels = arguments['min_mask_pixels'] or 0
+    # Statistics of the slabs, gathered in a list
+    statistics = []
+    for first in range(0, nslices, slab_size):
+        last = min(first + slab_size, nslices)
+        # The labels of the mask are small integers
+        mask = read_slab(mask_volume, first, last).astype(np.uint8)
+        images = {modality: read_slab(volumes[modality], first, last, arguments['image_dtype'], scalings[modality])
+                  for modality in MODALITIES}
+        if arguments['layout'] == 'stacked':
+            # (slices, 4, x, y), stacked once for the whole slab, channels in the order of MODALITIES
+            stacked = np.stack([images[modality] for modality in MODALITIES], axis=1)
+
+        # Statistics of all the slices of the slab, they decide the folder of each slice
+        statistics.append(mask_statistics(mask, first, min_mask_pixels))
+        folders = statistics[-1]['folder'].to_numpy()
+        # Intensities of the saved slices, and labels of the saved masks, one batch per slab
+        for modality in MODALITIES:
+            dataset_stats.add_image(modality, images[modality][folders != 'dropped'])
+        dataset_stats.add_mask(mask[folders == 'with_mask'], labels=LABELS)
+
+        # Iterate over each slice of the slab, i is the index in the slab
+        for i, slice in enumerate(range(first, last)):
+            folder = folders[i]
+            if folder == 'dropped':
+                nb_dropped += 1
+                continue
+
+            # Save slices, one file per modality, or one file with the 4 modalities
+            if arguments['layout'] == 'stacked':
+                save(f'{output_folder}/{grade_name}/stacked/{folder}/{patient_name}_slice_{slice}.npy', stacked[i])
+            else:
+                for modality in MODALITIES:
+                    save(f'{output_folder}/{grade_name}/{modality}/{folder}/{patient_name}_slice_{slice}_{modality}.npy',
+                         images[modality][i])
+
+            if folder == 'with_mask':
                 nb_with_mask += 1
-                # Save slices
-                np.save(f'{output_folder}/{grade_name}/t1/with_mask/{patient_name}_slice_{slice}_t1.npy', t1[:,:,slice])
-                np.save(f'{output_folder}/{grade_name}/t1ce/with_mask/{patient_name}_slice_{slice}_t1ce.npy', t1ce[:,:,slice])
-                np.save(f'{output_folder}/{grade_name}/t2/with_mask/{patient_name}_slice_{slice}_t2.npy', t2[:,:,slice])
-                np.save(f'{output_folder}/{grade_name}/flair/with_mask/{patient_name}_slice_{slice}_flair.npy', flair[:,:,slice])
                 # Save mask
-                np.save(f'{output_folder}/{grade_name}/mask/{patient_name}_slice_{slice}_mask.npy', mask[:,:,slice]/4)
+                if arguments['mask_dtype'] == 'float64':
+                    # Previous format, labels / 4
+                    save(f'{output_folder}/{grade_name}/mask/{patient_name}_slice_{slice}_mask.npy', mask[i]/4)
+                else:
+                    save(f'{output_folder}/{grade_name}/mask/{patient_name}_slice_{slice}_mask.npy',
+                         dtype_policy.encode_mask(mask[i], arguments['mask_dtype'], labels=LABELS))
             else:
-                nb_with_mask += 1
-                # Save slices
-                np.save(f'{output_folder}/{grade_name}/t1/empty_mask/{patient_name}_slice_{slice}_t1.npy', t1[:,:,slice])
-                np.save(f'{output_folder}/{grade_name}/t1ce/empty_mask/{patient_name}_slice_{slice}_t1ce.npy', t1ce[:,:,slice])
-                np.save(f'{output_folder}/{grade_name}/t2/empty_mask/{patient_name}_slice_{slice}_t2.npy', t2[:,:,slice])
-                np.save(f'{output_folder}/{grade_name}/flair/empty_mask/{patient_name}_slice_{slice}_flair.npy', flair[:,:,slice])
+                nb_empty_mask += 1
+
+    # Index of the slices of this patient, for the sampling of the slices
+    index_path = Path(output_folder) / grade_name / 'index' / f'{patient_name}.csv'
+    pd.concat(statistics, ignore_index=True).to_csv(index_path, index=False)
+
+    # The arrays of this patient are on disk before it is recorded as completed
+    array_store.commit(output_folder, arguments['output_backend'])
+
+    return {'nb_with_mask': nb_with_mask, 'nb_empty_mask': nb_empty_mask, 'nb_dropped': nb_dropped, 'files': files,
+            'normalization': normalization, 'statistics': [dataset_stats.to_dict()]}
+
+
+
+
+# Main
+if __name__ == "__main__":
+    # Get the arguments
+    dataset_folder = Path(arguments['dataset_folder'])
+    output_folder = Path(arguments['output_folder'])
+
+
+    dtype_policy.check_policy(arguments['image_dtype'], arguments['mask_dtype'],
+                              image_dtypes=['native', 'float32', 'float64'])
+
+    # Create folders
+    for grade in ['HGG', 'LGG']:
+        # Images folder, one per modality, or one for the stacked modalities
+        types = ['stacked'] if arguments['layout'] == 'stacked' else MODALITIES
+        for type in types:
+            for mask_type in ['empty_mask', 'with_mask']:
+                os.makedirs(f'{output_folder}/{grade}/{type}/{mask_type}', exist_ok=True)
+        # Mask folder
+        os.makedirs(f'{output_folder}/{grade}/mask', exist_ok=True)
+        # Slices index folder
+        os.makedirs(f'{output_folder}/{grade}/index', exist_ok=True)
+
+
+    # Parameters that change the outputs, a patient completed with other parameters is processed again
+    parameters = {'layout': arguments['layout'], 'min_mask_pixels': arguments['min_mask_pixels'], 'output_backend': arguments['output_backend'], 'image_dtype': arguments['image_dtype'],
+                  'mask_dtype': arguments['mask_dtype'], 'histogram_range': arguments['histogram_range']}
+    # Scaling of the 'native' volumes {grade/patient_modality: {'slope', 'intercept'}}
+    normalization = {}
+    # Statistics of the work units of both grades
+    unit_statistics = []
+
+    # HGG / LGG, each patient is an independent work unit
+    grades = {str(grade_path).split('/')[-1]: list(Path.iterdir(grade_path))
+              for grade_path in Path.iterdir(dataset_folder) if os.path.isdir(grade_path)}
+    unit_key = lambda grade_name, patient_path: f'{grade_name}/{patient_path.name}'
+
+    # One progress bar for all the patients, updated in this process when a worker completes a patient
+    manifest = checkpoint.load_manifest(output_folder) if arguments['resume'] else {}
+    progress = tqdm(total=sum(len(patients) for patients in grades.values()), unit='patient',
+                    initial=sum(checkpoint.is_completed(manifest, unit_key(grade_name, patient_path), parameters)
+                                for grade_name, patients in grades.items() for patient_path in patients))
+
+    for grade_name, patients in grades.items():
+        results = checkpoint.run(partial(process_patient, grade_name=grade_name, output_folder=output_folder),
+                                 patients, partial(unit_key, grade_name), parameters,
+                                 output_folder, arguments['workers'], arguments['resume'],
+                                 on_result=lambda _patient_path, _result: progress.update())
+        results = parallel_driver.merge_results(results)
+        normalization.update(results.get('normalization', []))
+        unit_statistics.extend(results.get('statistics', []))
+        # Count added
+        nb_with_mask = results.get('nb_with_mask', 0)
+        nb_empty_mask = results.get('nb_empty_mask', 0)
+        nb_dropped = results.get('nb_dropped', 0)
 
-    print(f'{nb_with_mask} images with masks added for {grade_name}')
-    print(f'{nb_empty_mask} images without masks added for {grade_name}')
+        print(f'{nb_with_mask} images with masks added for {grade_name}')
+        print(f'{nb_empty_mask} images without masks added for {grade_name}')
+        print(f'{nb_dropped} images dropped (masks with less than {arguments["min_mask_pixels"]} pixels) for {grade_name}')
+    progress.close()
 
-        # print(mask.shape)
+    # Record the dtypes, the layout (channels order), the labels of the masks and the scaling of the 'native' volumes
+    dtype_policy.save_header(output_folder, arguments['image_dtype'], arguments['mask_dtype'],
+                             layout=arguments['layout'], channels=MODALITIES if arguments['layout'] == 'stacked' else None,
+                             labels=LABELS, normalization=normalization)
+    # Intensity (per modality) and mask statistics of the whole data set
+    dataset_statistics.save_summary(output_folder, dataset_statistics.merge(unit_statistics),
+                                    image_dtype=arguments['image_dtype'], labels=LABELS)
@@ -1,20 +1,48 @@
+import json
 import pydicom
 import numpy as np
 import normalize_dicom
 import segmentation_mask
+import dicom_index
 import pandas as pd
+import sys
 from pathlib import Path
+from functools import partial
+
+# Modules shared by all the preprocessing scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import parallel_driver
+import array_store
+import dtype_policy
+import dataset_statistics
+import repair_log
 
 
 arguments = {
     'dataset_folder': "/media/jonas/Seagate Expansion Drive/Memoria/master_thesis/DSetsCristophe/HealthyCopy/Head-Neck-PET-CT/Head-Neck-PET-CT",
     'roinames_excel': "/media/jonas/Seagate Expansion Drive/Memoria/master_thesis/DSetsCristophe/HealthyCopy/Head-Neck-PET-CT/INFO_GTVcontours_HN.xlsx",
     'output_folder': "/media/jonas/Seagate Expansion Drive/Memoria/master_thesis/Dataset_HNPC_output",
+    'windows': None, # None for one channel (first DICOM window), or windows of the (C, H, W) images, e.g. 'preset', ['CT', 'dicom']
+    'workers': None, # Number of processes working on different patients (or RTStructs) in parallel, None uses all the CPUs
+    'output_backend': 'npy', # 'npy' for one file per array, 'shards' to pack the arrays in output_folder/shards (see array_store)
+    'image_dtype': 'uint8', # 'uint8' for windowed images, 'native' for the stored values (e.g. int16, see output_folder/dtypes.json)
+    'mask_dtype': 'uint8', # 'uint8', 'bool', 'packbits' (8 pixels per byte) or 'float64' (see dtype_policy)
+    'mask_mode': 'slices', # 'slices' for one image and mask per contour, 'volume' for (Z, H, W) image and mask volumes per RTStruct
+    'fill_method': 'polygon', # 'polygon' (even-odd fill of the contours), or 'span' (previous method, repairs logged in output_folder/segmentationMasksLogs)
+    'histogram_range': (0, 256), # (min, max) of the intensity histograms in output_folder/statistics.json, e.g. (-1024, 3072) for 'native' CT images
     }
 # arguments = {
 #     'dataset_folder': "preprocessing_scripts/Head-Neck-PET-CT/data",
 #     'roinames_excel': "preprocessing_scripts/Head-Neck-PET-CT/INFO_GTVcontours_HN.xlsx",
 #     'output_folder': "preprocessing_scripts/Head-Neck-PET-CT/output",
+#     'windows': None,
+#     'workers': None,
+#     'output_backend': 'npy',
+#     'image_dtype': 'uint8',
+#     'mask_dtype': 'uint8',
+#     'mask_mode': 'slices',
+#     'fill_method': 'polygon',
+#     'histogram_range': (0, 256),
 #     }
 
 
@@ -26,86 +54,96 @@ Params:
     dataset_folder   - Required  : folder containing the data set
     roinames_excel   - Required  : excel file containing the roi names information (given with the dataset)
     output_folder    - Required  : output folders
+    windows          - Required  : None, or windows (see normalize_dicom.get_windows()) to create multi-channel images (resolved once per series)
+    workers          - Required  : number of worker processes (patients, then RTStructs, are processed independently)
+    output_backend   - Required  : 'npy' or 'shards', how the arrays are stored (see array_store)
+    image_dtype      - Required  : dtype of the images, 'uint8' or 'native' (see dtype_policy)
+    mask_dtype       - Required  : dtype of the masks, 'uint8', 'bool', 'packbits' or 'float64' (see dtype_policy)
+    mask_mode        - Required  : 'slices' or 'volume' (slices sorted by position, see output_folder/volumes.json)
+    fill_method      - Required  : 'polygon' or 'span', how the masks are filled (see segmentation_mask)
+    histogram_range  - Required  : range of the 256 bins of the intensity histograms (see dataset_statistics)
 Returns:
     - No return value
 """
-# Get the arguments
-dataset_folder = Path(arguments['dataset_folder'])
-roinames_excel = Path(arguments['roinames_excel'])
-output_folder = Path(arguments['output_folder'])
-
-# The slash operator '/' in the pathlib module is similar to os.path.join()
-img_output_path = output_folder / 'img'
-mask_output_path = output_folder / 'masks'
-Path.mkdir(img_output_path, exist_ok=True)
-Path.mkdir(mask_output_path, exist_ok=True)
-
-print("\nGetting series UID and paths...\n", flush=True)
-
-# Initialization
-metadata_df = pd.DataFrame(columns=['Patient ID', 'Series UID', 'Modality', 'Associated series UID', 'Path', 'Roi name'])
 
-# Import and combine the four excel sheets into a DataFrame
-# Source : https://www.statology.org/combine-multiple-excel-sheets-pandas/
-roi_excel_df = pd.concat(pd.read_excel(roinames_excel, sheet_name=None), ignore_index=True)
 
-errors = []
-
-# iterdir() is similar to os.listdir()
-# Returns a generator object (function that behaves like an iterator)
-for patient_path in Path.iterdir(dataset_folder):
+# Slices of the volumes (mask_mode 'volume'), in the output folder
+VOLUMES_NAME = 'volumes.json'
+
+# Dicom tags
+MODALITY = (0x8,0x60)
+SERIES_INSTANCE_UID = (0x20,0xe)
+REF_FRAME = (0x3006,0x10)
+REF_STUDY = (0x3006,0x12)
+REF_SERIES = (0x3006,0x14)
+STRUCTURE_SET_ROI = (0x3006,0x20)
+ROI_NUMBER = (0x3006,0x22)
+ROI_NAME = (0x3006,0x26)
+ROI_CONTOUR_SEQUENCE = (0x3006,0x39)
+CONTOUR_SEQUENCE = (0x3006,0x40)
+CONTOUR_DATA = (0x3006,0x50)
+REF_ROI_NUMBER = (0x3006,0x84)
+CONTOUR_IMAGE = (0x3006,0x16)
+REF_SERIES_UID = (0x8,0x1155)
+SOP_INSTANCE_UID = (0x8,0x18)
+
+# SOPInstanceUID indexes of the images series, built once per series (and per process) and shared by all contours
+# Dictionary {series UID: {SOPInstanceUID: (path, modality)}}
+series_indexes = {}
+# Positions of the slices of the images series (mask_mode 'volume'), built once per series (and per process)
+# Dictionary {series UID: list of (position, SOPInstanceUID, path)}
+series_positions = {}
+
+
+
+def scan_patient(patient_path, roi_names, roinames_excel):
+    """Get the modality, the series UID (and the referenced series UID for RTStructs) of all series of one patient
+    @params:
+        patient_path     - Required : Path to the patient folder
+        roi_names        - Required : dictionary {patient ID: roi name}
+        roinames_excel   - Required : Path to the excel file containing the roi names (for the errors)
+    Returns:
+        - Dictionary with the errors list and the metadata rows list
+    """
+    metadata_rows = []
+    errors = []
+
+    # name returns a string representing the final path component
+    patient_ID = patient_path.name
+
+    # Get the roi name for this patient
+    roi_name = roi_names.get(patient_ID)
+    if roi_name is None:
+        errors.append(f"{patient_ID} has no roi name in {roinames_excel}")
+        roi_name = ''
 
     for patient_study_path in Path.iterdir(patient_path):
 
         for patient_study_serie_path in Path.iterdir(patient_study_path):
-            # name returns a string representing the final path component
-            patient_ID = patient_path.name
-
             # Open the first DICOM, and get the modality and the series UID
+            # Only the header is read, and only the needed tags are parsed
             dicom_path = next(Path.iterdir(patient_study_serie_path))
-            dicom = pydicom.dcmread(dicom_path)
-            # Dicom tags
-            MODALITY = (0x8,0x60)
-            SERIES_INSTANCE_UID = (0x20,0xe)
+            dicom = pydicom.dcmread(dicom_path, stop_before_pixels=True,
+                                    specific_tags=[MODALITY, SERIES_INSTANCE_UID, REF_FRAME])
             modality = dicom[MODALITY].value
             serie_UID = dicom[SERIES_INSTANCE_UID].value
 
-            # Get the roi name for this patient
-            roi_name = roi_excel_df.loc[roi_excel_df['Patient'] == patient_ID, 'Name GTV Primary'].item()
-
             # Check the modality
             if modality in ['CT', 'PT']:
-                # Add the row to the dataframe with informations
-                metadata_df = metadata_df.append({
-                    'Patient ID': patient_ID,
-                    'Series UID': serie_UID,
-                    'Modality': modality,
-                    'Associated series UID': '',
-                    'Path': patient_study_serie_path,
-                    'Roi name': roi_name,
-                }, ignore_index=True)
+                # Add the row with informations
+                metadata_rows.append([patient_ID, serie_UID, modality, '', patient_study_serie_path, roi_name])
 
                 print('.', end='', flush=True)
                 continue
 
             elif modality == 'RTSTRUCT':
                 # Get the image referenced UID
-                REF_FRAME = (0x3006,0x10)
-                REF_STUDY = (0x3006,0x12)
-                REF_SERIES = (0x3006,0x14)
                 # Use index 0, because dicom[] returns a list
                 referenced_series = dicom[REF_FRAME][0][REF_STUDY][0][REF_SERIES][0]
                 images_ref_UID = referenced_series[SERIES_INSTANCE_UID].value
 
-                # Add the row to the dataframe with informations
-                metadata_df = metadata_df.append({
-                    'Patient ID': patient_ID,
-                    'Series UID': serie_UID,
-                    'Modality': modality,
-                    'Associated series UID': images_ref_UID,
-                    'Path': dicom_path,
-                    'Roi name': roi_name,
-                }, ignore_index=True)
+                # Add the row with informations
+                metadata_rows.append([patient_ID, serie_UID, modality, images_ref_UID, dicom_path, roi_name])
 
                 print('.', end='', flush=True)
                 continue
@@ -119,92 +157,348 @@ for patient_path in Path.iterdir(dataset_folder):
                 print('x', end='', flush=True)
                 continue
 
+    return {'errors': errors, 'metadata_rows': metadata_rows}
 
-print("\nCreating images and masks...\n", flush=True)
 
-# RTStruct, images (CT + PET) separated in two dataframes
-RT_df = metadata_df[metadata_df['Modality'] == 'RTSTRUCT']
-images_df = metadata_df[(metadata_df['Modality'] == 'CT') |
-                          (metadata_df['Modality'] == 'PT')]
-
-# iterrows() iterates over DataFrame rows as (index, Series) pairs
-for nrow, row_data in RT_df.iterrows():
-    # Gather data
-    patient_id, RT_series_UID, _modality, associated_series_UID, RT_path, ROI_name = row_data
-
-    # Dicom tags for further use
-    STRUCTURE_SET_ROI = (0x3006,0x20)
-    ROI_NUMBER = (0x3006,0x22)
-    ROI_NAME = (0x3006,0x26)
-    ROI_CONTOUR_SEQUENCE = (0x3006,0x39)
-    CONTOUR_SEQUENCE = (0x3006,0x40)
-    CONTOUR_DATA = (0x3006,0x50)
-    REF_ROI_NUMBER = (0x3006,0x84)
-    CONTOUR_IMAGE = (0x3006,0x16)
-    REF_SERIES_UID = (0x8,0x1155)
-    SOP_INSTANCE_UID = (0x8,0x18)
-
-    # Open the RTStruct file and get the structure set ROI
-    dicom_RT = pydicom.dcmread(RT_path)
-    struct_set_ROI = dicom_RT[STRUCTURE_SET_ROI]
 
+def get_roi_contours(dicom_RT, ROI_name):
+    """Get the contours of the wanted ROI of an RTStruct
+    @params:
+        dicom_RT   - Required : RTStruct (Pydicom)
+        ROI_name   - Required : name of the ROI
+    Returns:
+        - List of tuples (referenced image SOPInstanceUID, (N, 3) contour points in mm), in the order of the file
+    """
     # Initialization
     ROI_number = ''
 
-    for roi in struct_set_ROI:
+    for roi in dicom_RT[STRUCTURE_SET_ROI]:
         # Check if the ROI name correspond
         if roi[ROI_NAME].value == ROI_name:
             ROI_number = roi[ROI_NUMBER].value
             break
 
+    roi_contours = []
     for ROI_contour in dicom_RT[ROI_CONTOUR_SEQUENCE]:
         # Check if it is the ROI contour we want
         if ROI_contour[REF_ROI_NUMBER].value == ROI_number:
 
             for contour_sequence in ROI_contour[CONTOUR_SEQUENCE]:
-                # Get the contour data, reshape and delete z coordinate
+                # Get the contour data, reshape to (N, 3) points (the z coordinate is ignored by the conversion)
                 contour_data = contour_sequence[CONTOUR_DATA].value
-                contour_data = np.array(contour_data).reshape(-1,3)
-                contour_data = np.delete(contour_data, -1, 1)
-                contour_data = contour_data.astype('float')
+                contour_data = np.array(contour_data, dtype='float').reshape(-1,3)
 
-                # Get the referenced image UID and the corresponding path
+                # Get the referenced image UID
                 ref_image_UID = contour_sequence[CONTOUR_IMAGE][0][REF_SERIES_UID].value
-                series_images_path = Path(images_df.loc[images_df['Series UID'] == associated_series_UID, 'Path'].item())
-
-                for image_path in Path.iterdir(series_images_path):
-                    # Open the image DICOM and get its UID
-                    dicom_image = pydicom.dcmread(image_path)
-                    instance_UID = dicom_image[SOP_INSTANCE_UID].value
-
-                    # Check if it is the image that we want
-                    if instance_UID == ref_image_UID:
-                        # Convert and save the image
-                        slice_array = normalize_dicom.get_normalized_array(dicom_image)
-                        modality = images_df.loc[images_df['Series UID'] == associated_series_UID, 'Modality'].item()
-                        dest_fname_img = f"{patient_id}_modality-{modality}_UID-{instance_UID}_{nrow}"
-                        dest_path_img = img_output_path / (dest_fname_img + '.npy')
-                        np.save(dest_path_img, slice_array)
-
-                        # Create segmentation mask and save it
-                        dest_fname_mask = dest_fname_img + '_mask'
-                        dest_path_mask = mask_output_path / (dest_fname_mask + '.npy')
-                        mask_array = segmentation_mask.create_segmentation_mask(dicom_image, contour_data, output_folder, conversion=True)
-                        np.save(dest_path_mask, mask_array)
-
-                        print('v', end='', flush=True)
-                        break
-                    else:
-                        print('.', end='', flush=True)
-                        continue
-
-
-# Sanity checks
-print("\nList of errors :")
-print(errors)
-
-nimg = len(list(Path.iterdir(img_output_path)))
-nmask = len(list(Path.iterdir(mask_output_path)))
-print(f"\nExpected: nimg = nmask")
-print(f"{nimg} = {nmask}")
-assert nimg == nmask, "File numbers do not match!"
+                roi_contours.append((ref_image_UID, contour_data))
+
+    return roi_contours
+
+
+
+def process_RT(RT_infos, output_folder):
+    """Save the images and segmentation masks of all the contours of the wanted ROI of one RTStruct
+    @params:
+        RT_infos        - Required : tuple (RTStruct row number, patient ID, associated series UID,
+                                     RTStruct path, ROI name, path of the associated images series)
+        output_folder   - Required : Path to the output folder
+    Returns:
+        - Dictionary with the errors list, the number of exported images (nexported),
+          the normalization parameters of the 'native' images, the statistics of the saved images and masks,
+          and the records of the masks repairs
+    """
+    nrow, patient_id, associated_series_UID, RT_path, ROI_name, series_images_path = RT_infos
+
+    # The slash operator '/' in the pathlib module is similar to os.path.join()
+    img_output_path = output_folder / 'img'
+    mask_output_path = output_folder / 'masks'
+
+    errors = []
+    nexported = 0
+    normalization = []
+    repairs = []
+    # Statistics of each saved image (per modality, CT or PT) and its mask, computed while they are written
+    # Several contours can reference the same image, the files (and their statistics) are then replaced
+    slices_statistics = {}
+
+    # Contours of the wanted ROI, with the UID of the image they reference
+    dicom_RT = pydicom.dcmread(RT_path)
+    roi_contours = get_roi_contours(dicom_RT, ROI_name)
+
+    # Index the referenced images series (headers only), if not already done by a previous RTStruct
+    if associated_series_UID not in series_indexes:
+        series_indexes[associated_series_UID] = dicom_index.build_sop_index(series_images_path)
+    sop_index = series_indexes[associated_series_UID]
+    # Windows of the multi-channel images, resolved once: all the slices of the series have the same channels
+    series_windows = normalize_dicom.get_series_windows(min(path for path, _modality in sop_index.values()), arguments['windows']) \
+                     if len(sop_index) > 0 else None
+    # Statistics of each channel (window) of the multi-channel images
+    channel_names = normalize_dicom.get_channel_names(series_windows) if arguments['image_dtype'] != 'native' else None
+
+    for ref_image_UID, contour_data in roi_contours:
+        # Get the path of the referenced image
+        image_info = sop_index.get(ref_image_UID)
+
+        if image_info is None:
+            errors.append(f"{RT_path} references image {ref_image_UID} not found in series {associated_series_UID}")
+            print('x', end='', flush=True)
+            continue
+
+        # Open the image DICOM (with pixel data) only for the image that we want
+        image_path, modality = image_info
+        dicom_image = pydicom.dcmread(image_path)
+        instance_UID = dicom_image[SOP_INSTANCE_UID].value
+
+        # Convert and save the image
+        if arguments['image_dtype'] == 'native':
+            slice_array, slice_normalization = normalize_dicom.get_native_array(dicom_image)
+        else:
+            slice_array = normalize_dicom.get_normalized_array(dicom_image, windows=series_windows)
+        dest_fname_img = f"{patient_id}_modality-{modality}_UID-{instance_UID}_{nrow}"
+        dest_path_img = img_output_path / (dest_fname_img + '.npy')
+        image_key = array_store.save_array(output_folder, dest_path_img, slice_array, arguments['output_backend'])
+        if arguments['image_dtype'] == 'native':
+            normalization.append([image_key, slice_normalization])
+        slices_statistics[image_key] = dataset_statistics.DatasetStatistics(value_range=arguments['histogram_range'])
+        slices_statistics[image_key].add_image(modality, slice_array, channels=channel_names)
+
+        # Create segmentation mask and save it
+        dest_fname_mask = dest_fname_img + '_mask'
+        dest_path_mask = mask_output_path / (dest_fname_mask + '.npy')
+        mask_repairs = []
+        mask_array = segmentation_mask.create_segmentation_mask(dicom_image, contour_data, output_folder, conversion=True,
+                                                                fill_method=arguments['fill_method'],
+                                                                repairs=mask_repairs)
+        repairs.extend({'patient': patient_id, 'image': image_key, **record} for record in mask_repairs)
+        slices_statistics[image_key].add_mask(mask_array)
+        mask_array = dtype_policy.encode_mask(mask_array, arguments['mask_dtype'])
+        array_store.save_array(output_folder, dest_path_mask, mask_array, arguments['output_backend'])
+
+        nexported += 1
+        print('v', end='', flush=True)
+
+    array_store.commit(output_folder, arguments['output_backend'])
+
+    return {'errors': errors, 'nexported': nexported, 'normalization': normalization, 'repairs': repairs,
+            'statistics': [dataset_statistics.merge(slices_statistics.values()).to_dict()]}
+
+
+
+def read_slice(dicom_image, windows):
+    """Get the image of a slice, and its normalization parameters if it is saved 'native' (None otherwise)"""
+    if arguments['image_dtype'] == 'native':
+        return normalize_dicom.get_native_array(dicom_image)
+    return normalize_dicom.get_normalized_array(dicom_image, windows=windows), None
+
+
+
+def process_RT_volume(RT_infos, output_folder):
+    """Save the images and the segmentation mask of the wanted ROI of one RTStruct as (Z, H, W) volumes
+    The contours are grouped by referenced image, each image is decoded once, and all its contours are filled
+    in the same mask slice. The volume contains all the slices of the series between the first and the last
+    contoured slices, sorted by their position (see dicom_index.slice_position()): the slices without contour
+    get an empty mask, so the volume is contiguous
+    @params:
+        RT_infos        - Required : tuple (RTStruct row number, patient ID, associated series UID,
+                                     RTStruct path, ROI name, path of the associated images series)
+        output_folder   - Required : Path to the output folder
+    Returns:
+        - Dictionary with the errors list, the number of exported contours (nexported), the normalization
+          parameters of the 'native' slices, the statistics of the saved volumes, the records of the masks repairs,
+          and the slices of the volume (SOPInstanceUID, position and contoured flag of each slice)
+    """
+    nrow, patient_id, associated_series_UID, RT_path, ROI_name, series_images_path = RT_infos
+
+    # The slash operator '/' in the pathlib module is similar to os.path.join()
+    img_output_path = output_folder / 'img'
+    mask_output_path = output_folder / 'masks'
+
+    errors = []
+    nexported = 0
+    repairs = []
+    statistics = dataset_statistics.DatasetStatistics(value_range=arguments['histogram_range'])
+
+    # Contours of the wanted ROI, grouped by referenced image {SOPInstanceUID: list of (N, 3) contours}
+    dicom_RT = pydicom.dcmread(RT_path)
+    contours = {}
+    for ref_image_UID, contour_data in get_roi_contours(dicom_RT, ROI_name):
+        contours.setdefault(ref_image_UID, []).append(contour_data)
+
+    # Index the referenced images series (headers only), if not already done by a previous RTStruct
+    if associated_series_UID not in series_indexes:
+        series_indexes[associated_series_UID] = dicom_index.build_sop_index(series_images_path)
+    sop_index = series_indexes[associated_series_UID]
+    if associated_series_UID not in series_positions:
+        series_positions[associated_series_UID] = dicom_index.build_position_index(series_images_path)
+    positions = series_positions[associated_series_UID]
+    # Windows of the multi-channel images, resolved once: all the slices of the series have the same channels
+    series_windows = normalize_dicom.get_series_windows(min(path for path, _modality in sop_index.values()), arguments['windows']) \
+                     if len(sop_index) > 0 else None
+    # Statistics of each channel (window) of the multi-channel images
+    channel_names = normalize_dicom.get_channel_names(series_windows) if arguments['image_dtype'] != 'native' else None
+
+    # Each referenced image is decoded once {SOPInstanceUID: (image, normalization)}, {SOPInstanceUID: (mask, repairs)}
+    images = {}
+    masks = {}
+    modality = None
+    for ref_image_UID, image_contours in contours.items():
+        image_info = sop_index.get(ref_image_UID)
+        if image_info is None:
+            errors.append(f"{RT_path} references image {ref_image_UID} not found in series {associated_series_UID}")
+            print('x', end='', flush=True)
+            continue
+
+        image_path, modality = image_info
+        dicom_image = pydicom.dcmread(image_path)
+        images[ref_image_UID] = read_slice(dicom_image, series_windows)
+
+        # All the contours of the slice in one mask (multi-part contour, filled with the even-odd rule)
+        mask_repairs = []
+        mask_array = segmentation_mask.create_segmentation_mask(dicom_image, image_contours, output_folder, conversion=True,
+                                                                fill_method=arguments['fill_method'],
+                                                                repairs=mask_repairs)
+        masks[ref_image_UID] = (mask_array, mask_repairs)
+        nexported += len(image_contours)
+        print('v', end='', flush=True)
+
+    # All the slices of the series between the first and the last contoured slices, sorted by position
+    contoured_positions = [position for position, sop_uid, _path in positions if sop_uid in masks]
+    if len(contoured_positions) == 0:
+        return {'errors': errors, 'nexported': nexported}
+    volume_slices = [(position, sop_uid, path) for position, sop_uid, path in positions
+                     if contoured_positions[0] <= position <= contoured_positions[-1]]
+
+    # (position, SOPInstanceUID, image, mask, normalization, repairs), the slices without contour get an empty mask
+    slices = []
+    for position, sop_uid, path in volume_slices:
+        if sop_uid not in images:
+            images[sop_uid] = read_slice(pydicom.dcmread(path), series_windows)
+        slice_array, slice_normalization = images[sop_uid]
+        mask_array, mask_repairs = masks.get(sop_uid, (None, []))
+        if mask_array is None:
+            mask_array = np.zeros(slice_array.shape[-2:], dtype=np.uint8)
+        slices.append((position, sop_uid, slice_array, mask_array, slice_normalization, mask_repairs))
+
+    # Stack the slices
+    try:
+        image_volume = np.stack([slice[2] for slice in slices])
+        mask_volume = np.stack([slice[3] for slice in slices])
+    except ValueError:
+        errors.append(f"{RT_path} references images of different shapes, no volume saved")
+        return {'errors': errors, 'nexported': 0}
+
+    dest_fname_img = f"{patient_id}_modality-{modality}_series-{associated_series_UID}_{nrow}"
+    image_key = array_store.save_array(output_folder, img_output_path / (dest_fname_img + '.npy'), image_volume,
+                                       arguments['output_backend'])
+    statistics.add_image(modality, image_volume, channels=channel_names)
+    statistics.add_mask(mask_volume)
+    mask_volume = dtype_policy.encode_mask(mask_volume, arguments['mask_dtype'])
+    array_store.save_array(output_folder, mask_output_path / (dest_fname_img + '_mask.npy'), mask_volume,
+                           arguments['output_backend'])
+
+    array_store.commit(output_folder, arguments['output_backend'])
+
+    for slice in slices:
+        repairs.extend({'patient': patient_id, 'image': image_key, **record} for record in slice[5])
+    # The normalization of a volume is the list of the parameters of its slices
+    normalization = [[image_key, [slice[4] for slice in slices]]] if arguments['image_dtype'] == 'native' else []
+    volume = {'sop_uids': [slice[1] for slice in slices], 'positions': [slice[0] for slice in slices],
+              'contoured': [slice[1] in masks for slice in slices]}
+
+    return {'errors': errors, 'nexported': nexported, 'normalization': normalization, 'repairs': repairs,
+            'statistics': [statistics.to_dict()], 'volumes': [[image_key, volume]]}
+
+
+
+
+# Main
+if __name__ == "__main__":
+    # Get the arguments
+    dataset_folder = Path(arguments['dataset_folder'])
+    roinames_excel = Path(arguments['roinames_excel'])
+    output_folder = Path(arguments['output_folder'])
+
+    dtype_policy.check_policy(arguments['image_dtype'], arguments['mask_dtype'], image_dtypes=['uint8', 'native'])
+
+    # The slash operator '/' in the pathlib module is similar to os.path.join()
+    img_output_path = output_folder / 'img'
+    mask_output_path = output_folder / 'masks'
+    Path.mkdir(img_output_path, exist_ok=True)
+    Path.mkdir(mask_output_path, exist_ok=True)
+
+    # Multi-channel images: record the channels order
+    if arguments['windows'] is not None:
+        normalize_dicom.save_windows_header(output_folder, arguments['windows'])
+
+    print("\nGetting series UID and paths...\n", flush=True)
+
+    # Import and combine the four excel sheets into a DataFrame
+    # Source : https://www.statology.org/combine-multiple-excel-sheets-pandas/
+    roi_excel_df = pd.concat(pd.read_excel(roinames_excel, sheet_name=None), ignore_index=True)
+    # Dictionary {patient ID: roi name}, to avoid searching the DataFrame for each series
+    roi_names = dict(zip(roi_excel_df['Patient'], roi_excel_df['Name GTV Primary']))
+
+    # iterdir() is similar to os.listdir()
+    # Returns a generator object (function that behaves like an iterator)
+    # Each patient is an independent work unit
+    patients = list(Path.iterdir(dataset_folder))
+    results = parallel_driver.run(partial(scan_patient, roi_names=roi_names, roinames_excel=roinames_excel),
+                                  patients, arguments['workers'])
+    results = parallel_driver.merge_results(results)
+    errors = results.get('errors', [])
+
+    # Rows are gathered in lists, and the DataFrame is created once at the end
+    metadata_columns = ['Patient ID', 'Series UID', 'Modality', 'Associated series UID', 'Path', 'Roi name']
+    metadata_df = pd.DataFrame(results.get('metadata_rows', []), columns=metadata_columns)
+
+
+    print("\nCreating images and masks...\n", flush=True)
+
+    # RTStruct, images (CT + PET) separated in two dataframes
+    RT_df = metadata_df[metadata_df['Modality'] == 'RTSTRUCT']
+    images_df = metadata_df[(metadata_df['Modality'] == 'CT') |
+                              (metadata_df['Modality'] == 'PT')]
+    # Dictionary {series UID: series path}
+    images_paths = dict(zip(images_df['Series UID'], images_df['Path']))
+
+    # iterrows() iterates over DataFrame rows as (index, Series) pairs
+    # Each RTStruct is an independent work unit, the row number keeps the file names identical to a serial run
+    RT_infos = []
+    for nrow, row_data in RT_df.iterrows():
+        # Gather data
+        patient_id, RT_series_UID, _modality, associated_series_UID, RT_path, ROI_name = row_data
+        RT_infos.append((nrow, patient_id, associated_series_UID, RT_path, ROI_name, Path(images_paths[associated_series_UID])))
+
+    # One image and one mask per contour, or one volume per RTStruct
+    process_function = process_RT_volume if arguments['mask_mode'] == 'volume' else process_RT
+    # Repairs of the masks, in one log for this run (written as each RTStruct is completed), with a summary per patient
+    repairs = repair_log.RepairLog(output_folder)
+    results = parallel_driver.run(partial(process_function, output_folder=output_folder), RT_infos, arguments['workers'],
+                                  on_result=repairs.log_result)
+    repairs.close()
+    results = parallel_driver.merge_results(results)
+    errors = errors + results.get('errors', [])
+    nexported = results.get('nexported', 0)
+
+    # Record the dtypes, and how to normalize the 'native' images {image key: parameters}
+    dtype_policy.save_header(output_folder, arguments['image_dtype'], arguments['mask_dtype'],
+                             normalization=dict(results.get('normalization', [])))
+    # Slices of each volume {image key: {'sop_uids', 'positions'}}, in their own file
+    if arguments['mask_mode'] == 'volume':
+        with open(Path(output_folder) / VOLUMES_NAME, mode='w') as file:
+            json.dump({'mask_mode': arguments['mask_mode'], 'volumes': dict(results.get('volumes', []))}, file, indent=4)
+    # Intensity (per modality) and mask statistics of the whole data set
+    dataset_statistics.save_summary(output_folder, dataset_statistics.merge(results.get('statistics', [])),
+                                    image_dtype=arguments['image_dtype'])
+
+
+    # Sanity checks
+    print("\nList of errors :")
+    print(errors)
+    print(f"\nTotal numbers of exported contours (nexported): {nexported}")
+
+    nimg = array_store.count_arrays(output_folder, img_output_path, arguments['output_backend'])
+    nmask = array_store.count_arrays(output_folder, mask_output_path, arguments['output_backend'])
+    print(f"\nExpected: nimg = nmask")
+    print(f"{nimg} = {nmask}")
+    assert nimg == nmask, "File numbers do not match!"
@@ -1,7 +1,64 @@
 import pydicom
 import numpy as np
-import pandas as pd
-from pathlib import Path
+from functools import lru_cache
+
+# Optional compiled fast path to fill the polygons spans
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+@lru_cache(maxsize=4096)
+def _inverse_affine(_uid, Sx, Sy, Di, Dj, Xx, Xy, Yx, Yy):
+    """Inverse of the mm to image coordinates transform of one slice, cached by SOPInstanceUID
+    (the geometry values are part of the key too, so two slices can never share a wrong transform)"""
+    # Equations in matrix form ax = b, see mm_to_imagecoordinates()
+    a = np.array([[Xx * Di, Yx * Dj], [Xy * Di, Yy * Dj]])
+    inverse = np.linalg.inv(a)
+    # The cached array is shared, protect it against modifications
+    inverse.flags.writeable = False
+    return inverse, np.array([Sx, Sy])
+
+
+
+def get_image_transform(image):
+    """Get the transform from mm to image coordinates of the given slice
+    @params:
+        image    - Required : image (Pydicom) corresponding to one specific slice
+    Returns:
+        inverse  - 2x2 NumPy array, inverse of the matrix of the equations in mm_to_imagecoordinates()
+        origin   - 1D NumPy array containing the x and y position (in mm) of the first pixel
+    """
+    # All these variables are extracted from following DICOM tags
+    IMAGE_POSITION = (0x20,0x32)
+    PIXEL_SPACING = (0x28,0x30)
+    IMAGE_ORIENTATION = (0x20,0x37)
+    UID = (0x8,0x18)
+
+    Sx, Sy, _Sz = image[IMAGE_POSITION].value
+    Di, Dj = image[PIXEL_SPACING].value
+    Xx, Xy, _Xz, Yx, Yy, _Yz = image[IMAGE_ORIENTATION].value
+
+    return _inverse_affine(image[UID].value, float(Sx), float(Sy), float(Di), float(Dj),
+                           float(Xx), float(Xy), float(Yx), float(Yy))
+
+
+
+def mm_to_imagecoordinates_array(image, points):
+    """Convert all the given points locations in mm to corresponding column and row indices, at once
+    @params:
+        image    - Required : image (Pydicom) corresponding to one specific slice
+        points   - Required : (N, 2) or (N, 3) array containing the x and y (and z) coordinates (in mm) of the points,
+                              for example the reshaped ContourData of a contour
+    Returns:
+        - (N, 2) float NumPy array containing the (not rounded) column and row indices of each point
+    """
+    inverse, origin = get_image_transform(image)
+    points = np.asarray(points, dtype=np.float64).reshape(len(points), -1)
+    # Solve the equations for all the points with one matrix multiplication: x = a^-1 (b)
+    return (points[:, :2] - origin) @ inverse.T
+
 
 
 def mm_to_imagecoordinates(image, point):
@@ -17,44 +74,258 @@ def mm_to_imagecoordinates(image, point):
     # The two equations to solve for i and j are the following :
     # (Xx * Di)*i (Yx * Dj)*j = Px - Sx
     # (Xy * Di)*i (Yy * Dj)*j = Py - Sy
+    i, j = mm_to_imagecoordinates_array(image, [point[:2]])[0]
 
-    # All these variables are extracted from following DICOM tags
-    IMAGE_POSITION = (0x20,0x32)
-    PIXEL_SPACING = (0x28,0x30)
-    IMAGE_ORIENTATION = (0x20,0x37)
+    return [round(i), round(j)]
 
-    Sx, Sy, _Sz = image[IMAGE_POSITION].value
-    Di, Dj = image[PIXEL_SPACING].value
-    Xx, Xy, _Xz, Yx, Yy, _Yz = image[IMAGE_ORIENTATION].value
-    Px, Py = point
 
-    # Equations in matrix form ax = b
-    a = np.array([[Xx * Di, Yx * Dj], [Xy * Di, Yy * Dj]])
-    b = np.array([Px - Sx, Py - Sy])
 
-    i, j = np.linalg.solve(a, b)
+def contour_parts(contour_data):
+    """Split the given contour data in a list of (N, 2) arrays, one per closed polygon
+    @params:
+        contour_data   - Required : 2D array containing contour points (N, 2) or (N, 3),
+                                    or list of such arrays (multi-part contour)
+    """
+    try:
+        points = np.asarray(contour_data, dtype=np.float64)
+    except ValueError:
+        # Ragged list of polygons with different numbers of points
+        return [np.asarray(part, dtype=np.float64).reshape(len(part), -1) for part in contour_data]
 
-    return [round(i), round(j)]
+    if points.ndim == 3:
+        return list(points)
+    if points.ndim == 2:
+        return [points]
+    return [points.reshape(-1, 2)]
+
+
+
+def _polygons_edges(parts):
+    """Get the start and end points of every edge of the given closed polygons"""
+    x0 = np.concatenate([part[:, 0] for part in parts])
+    y0 = np.concatenate([part[:, 1] for part in parts])
+    # Each polygon is closed: the last point is linked to the first one
+    x1 = np.concatenate([np.roll(part[:, 0], -1) for part in parts])
+    y1 = np.concatenate([np.roll(part[:, 1], -1) for part in parts])
+    return x0, y0, x1, y1
+
+
+
+def _expand_ranges(starts, counts):
+    """Vectorized equivalent of np.concatenate([np.arange(s, s + c) for s, c in zip(starts, counts)])
+    Returns the index of the range of each element, and the elements"""
+    range_index = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return range_index, starts[range_index] + offsets
+
+
+
+def _scanline_spans(x0, y0, x1, y1, nrow, ncol):
+    """Compute the inside spans of the polygons on each row (even-odd rule)
+    Returns the row index, the first and the last column index of each span"""
+    # Horizontal edges never cross a scanline
+    keep = y0 != y1
+    x0, y0, x1, y1 = x0[keep], y0[keep], x1[keep], y1[keep]
 
+    # Scanline r crosses an edge if min(y0, y1) <= r < max(y0, y1) (half-open, so vertices are counted once)
+    first_row = np.clip(np.ceil(np.minimum(y0, y1)), 0, nrow).astype(np.int64)
+    stop_row = np.clip(np.ceil(np.maximum(y0, y1)), 0, nrow).astype(np.int64)
+    counts = np.maximum(stop_row - first_row, 0)
 
+    # One crossing per (edge, scanline) pair, at the x position of the edge on this scanline
+    edge, rows = _expand_ranges(first_row, counts)
+    xs = x0[edge] + (rows - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
 
-def create_segmentation_mask(image, contour_data, output_folder, conversion):
+    # Sort the crossings by row, then by x: consecutive pairs are inside spans
+    order = np.lexsort((xs, rows))
+    rows, xs = rows[order], xs[order]
+    rows, x_in, x_out = rows[0::2], xs[0::2], xs[1::2]
+
+    # Pixels whose center is inside the span
+    first_col = np.clip(np.ceil(x_in), 0, ncol).astype(np.int64)
+    last_col = np.clip(np.floor(x_out), -1, ncol - 1).astype(np.int64)
+    valid = first_col <= last_col
+    return rows[valid], first_col[valid], last_col[valid]
+
+
+
+def _fill_spans_numpy(nrow, ncol, rows, first_col, last_col):
+    """Fill the spans using a difference array and a cumulative sum over each row"""
+    width = ncol + 1
+    size = nrow * width
+    difference = np.bincount(rows * width + first_col, minlength=size) - \
+                 np.bincount(rows * width + last_col + 1, minlength=size)
+    return np.cumsum(difference.reshape(nrow, width), axis=1)[:, :ncol] > 0
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _fill_spans_compiled(nrow, ncol, rows, first_col, last_col):
+        """Fill the spans directly, only touching the pixels inside the polygons"""
+        mask = np.zeros((nrow, ncol), dtype=np.bool_)
+        for k in range(rows.shape[0]):
+            mask[rows[k], first_col[k]:last_col[k] + 1] = True
+        return mask
+
+
+
+def _draw_outline(mask, x0, y0, x1, y1):
+    """Draw the edges of the polygons (in place), so that the contour itself is part of the mask"""
+    nrow, ncol = mask.shape
+    # Enough samples per edge to touch every pixel on the line
+    counts = (np.ceil(np.maximum(np.abs(x1 - x0), np.abs(y1 - y0))) + 1).astype(np.int64)
+    edge, steps = _expand_ranges(np.zeros(len(counts), dtype=np.int64), counts)
+    t = steps / np.maximum(counts[edge] - 1, 1)
+    xs = np.rint(x0[edge] + t * (x1[edge] - x0[edge])).astype(np.int64)
+    ys = np.rint(y0[edge] + t * (y1[edge] - y0[edge])).astype(np.int64)
+    inside = (xs >= 0) & (xs < ncol) & (ys >= 0) & (ys < nrow)
+    mask[ys[inside], xs[inside]] = True
+
+
+
+def rasterize_polygon(contour_data, nrow, ncol, dtype=np.uint8, compiled=True):
+    """Fill the polygon(s) given by the contour points with the even-odd rule, in one pass
+    @params:
+        contour_data   - Required : 2D array containing contour points (x = column, y = row),
+                                    or list of such arrays (multi-part contour, holes are supported)
+        nrow           - Required : number of rows of the mask
+        ncol           - Required : number of columns of the mask
+        dtype          - Optional : dtype of the returned mask (uint8, bool, float64...)
+        compiled       - Optional : use the compiled (numba) fast path if numba is installed
+    """
+    parts = [part for part in contour_parts(contour_data) if len(part) > 0]
+    if len(parts) == 0:
+        return np.zeros((nrow, ncol), dtype=dtype)
+
+    x0, y0, x1, y1 = _polygons_edges(parts)
+    rows, first_col, last_col = _scanline_spans(x0, y0, x1, y1, nrow, ncol)
+
+    if compiled and numba is not None:
+        mask = _fill_spans_compiled(nrow, ncol, rows, first_col, last_col)
+    else:
+        mask = _fill_spans_numpy(nrow, ncol, rows, first_col, last_col)
+
+    _draw_outline(mask, x0, y0, x1, y1)
+
+    return mask.astype(dtype, copy=False)
+
+
+
+def create_segmentation_mask(image, contour_data, output_folder, conversion, fill_method='polygon', dtype=np.uint8,
+                             repairs=None):
     """Get normalized NumPy array segmentation mask from DICOM file and contour data
     @params:
         image          - Required : image (Pydicom) corresponding to one specific slice
-        contour_data   - Required : 2D array containing contours points of the segmentation
-        output_folder  - Required : Path to the output folder that will contain the log files
+        contour_data   - Required : 2D array containing contours points of the segmentation, in mm (N, 2) or (N, 3)
+                                    if conversion is needed, else in image coordinates (N, 2)
+                                    (or list of 2D arrays for a multi-part contour)
+        output_folder  - Required : Path to the output folder (not used anymore, the repairs are given in repairs,
+                                    see repair_log)
         conversion     - Required : Boolean that indicates if conversion from mm to image coordinates is needed
+        fill_method    - Optional : 'polygon' fills the contour with the even-odd rule (handles concave
+                                    and multi-part contours), 'span' fills each row from its min to its
+                                    max white pixel, with data mitigation and imputation (previous method)
+        dtype          - Optional : dtype of the returned 0/1 mask (uint8, bool, float64...)
+        repairs        - Optional : list, the records of the repairs done by the span fill are appended to it
     """
-    # Create and open a log text file
-    # The slash operator '/' in the pathlib module is similar to os.path.join()
-    logs_folder_path = Path(output_folder) / "segmentationMasksLogs"
-    Path.mkdir(logs_folder_path, exist_ok=True)
-    # Unique file name
+    # BEWARE : The x-coordinate corresponds to the COLUMN index,
+    # and the y-coordinate corresponds to the ROW index
+    # The polygon fill uses the sub-pixel coordinates, the span fill the rounded ones
+    if conversion:
+        contour_data = [mm_to_imagecoordinates_array(image, part) for part in contour_parts(contour_data)]
+
+    if fill_method == 'polygon':
+        return rasterize_polygon(contour_data, image.Rows, image.Columns, dtype=dtype)
+    elif fill_method == 'span':
+        # All the parts are merged, the span fill does not make the difference
+        points = np.rint(np.concatenate(contour_parts(contour_data))[:, :2]).astype(np.int64)
+        seg_mask, mask_repairs = _span_fill_mask(image, points)
+        if repairs is not None:
+            repairs.extend(mask_repairs)
+        return seg_mask.astype(dtype, copy=False)
+    else:
+        raise ValueError(f"Unknown fill method {fill_method}")
+
+
+
+# Span fill: arbitrarily threshold that tells when a value should be considered as an error
+# Here tolerate 5% errors
+ERROR_THRESHOLD = 0.05
+
+
+def _absurd(average, value):
+    """Check (elementwise) if the values differ from the average of their neighbours by more than ERROR_THRESHOLD
+    A zero average gives an infinite (absurd) or undefined (not absurd) relative error, as in the previous method"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.abs((average - value) / np.asarray(average, dtype=np.float64)) > ERROR_THRESHOLD
+
+
+
+def _correct_absurd_values(mins, maxs):
+    """Correct the absurd min or max value of the middle row of each triple of consecutive rows
+    The triples are checked in order, and a corrected row is the first row of the next triple: the test is done
+    on all the triples at once with shifted arrays, then only the triples following a correction are checked again
+    @params:
+        mins   - Required : 1D array of the min white column index of each row
+        maxs   - Required : 1D array of the max white column index of each row
+    Returns:
+        - Corrected mins and maxs (new arrays)
+        - Correction of each triple, 0 for none, 1 for the min and 2 for the max of the middle row
+        - Averages of the min and max values of the first and third rows of each triple
+    """
+    # Values of the first row of each triple, once corrected by the previous triple
+    new_mins, new_maxs = mins.copy(), maxs.copy()
+    if len(mins) < 3:
+        return new_mins, new_maxs, np.zeros(0, dtype=np.int8), mins[:0], maxs[:0]
+
+    # Mean of two non negative integers, truncated as np.mean(dtype=np.int32)
+    average_mins = (mins[:-2] + mins[2:]) // 2
+    average_maxs = (maxs[:-2] + maxs[2:]) // 2
+    # The max is only checked if the min is not absurd
+    corrections = np.where(_absurd(average_mins, mins[1:-1]), 1,
+                           np.where(_absurd(average_maxs, maxs[1:-1]), 2, 0)).astype(np.int8)
+    new_mins[1:-1] = np.where(corrections == 1, average_mins, mins[1:-1])
+    new_maxs[1:-1] = np.where(corrections == 2, average_maxs, maxs[1:-1])
+
+    # Triples whose first row was corrected, checked again in order
+    corrected = np.flatnonzero(corrections)
+    def next_triple(triple):
+        """First triple after the given one (included) whose first row was corrected by the initial test"""
+        index = np.searchsorted(corrected, triple)
+        return corrected[index] + 1 if index < len(corrected) else len(corrections)
+    triple = next_triple(0)
+    while triple < len(corrections):
+        average_mins[triple] = (new_mins[triple] + mins[triple + 2]) // 2
+        average_maxs[triple] = (new_maxs[triple] + maxs[triple + 2]) // 2
+        if _absurd(average_mins[triple], mins[triple + 1]):
+            corrections[triple] = 1
+        elif _absurd(average_maxs[triple], maxs[triple + 1]):
+            corrections[triple] = 2
+        else:
+            corrections[triple] = 0
+        new_mins[triple + 1] = average_mins[triple] if corrections[triple] == 1 else mins[triple + 1]
+        new_maxs[triple + 1] = average_maxs[triple] if corrections[triple] == 2 else maxs[triple + 1]
+        # The next triple depends on this one only if its first row was corrected
+        triple = triple + 1 if corrections[triple] else next_triple(triple + 1)
+
+    return new_mins, new_maxs, corrections, average_mins, average_maxs
+
+
+
+def _span_fill_mask(image, contour_points):
+    """Create the mask by filling each row from its min to its max contour pixel (previous method)
+    @params:
+        image           - Required : image (Pydicom) corresponding to one specific slice
+        contour_points  - Required : 2D array containing contours points in image coordinates
+    Returns:
+        - Mask (float64 NumPy array)
+        - List of the repair records (dictionaries), 'row_missing' for the rows added
+          and 'absurd_value' for the min or max values corrected
+    """
+    # The records are identified by the SOPInstanceUID of the slice
     UID = (0x8, 0x18)
-    file_name = Path(f"{image[UID].value}_logs.txt")
-    file_path = logs_folder_path / file_name
-    file = open(file_path, mode='w')
+    sop_uid = str(image[UID].value)
+    repairs = []
 
     # Initialization
     nrow = image.Rows
@@ -62,99 +333,56 @@ def create_segmentation_mask(image, contour_data, output_folder, conversion):
     # Black pixel is of value 0
     seg_mask = np.zeros((nrow, ncol))
 
-    # Draw contour
-    for point in contour_data:
-        # BEWARE : The x-coordinate corresponds to the COLUMN index,
-        # and the y-coordinate corresponds to the ROW index
-        if conversion:
-            x, y = mm_to_imagecoordinates(image, point)
-        else:
-            x, y = point
-        # White pixel is of value 1
-        seg_mask[y][x] = 1
+    # Draw contour, white pixel is of value 1
+    contour_points = np.asarray(contour_points, dtype=np.int64).reshape(-1, 2)
+    seg_mask[contour_points[:, 1], contour_points[:, 0]] = 1
+
+    # White boundaries of the rows containing white pixels: row index, min and max white column index
+    white = seg_mask == 1
+    present_rows = np.flatnonzero(white.any(axis=1))
+    if len(present_rows) == 0:
+        return seg_mask, repairs
+    present_mins = np.argmax(white[present_rows], axis=1)
+    present_maxs = ncol - 1 - np.argmax(white[present_rows, ::-1], axis=1)
 
 
     # -- DATA MITIGATION AND IMPUTATION in two parts --
     # 1) Check and add if empty lines
+    # After the imputation, all the rows between the first and the last white rows have boundaries
+    rows = np.arange(present_rows[0], present_rows[-1] + 1)
+    # Index of the first present row >= each row, and of the previous one
+    next_present = np.searchsorted(present_rows, rows)
+    previous_present = np.maximum(next_present - 1, 0)
+    is_present = present_rows[next_present] == rows
+    # Missing rows get the means of the neighbours boundaries (truncated as np.mean(dtype=np.int32))
+    mins = np.where(is_present, present_mins[next_present],
+                    (present_mins[previous_present] + present_mins[next_present]) // 2)
+    maxs = np.where(is_present, present_maxs[next_present],
+                    (present_maxs[previous_present] + present_maxs[next_present]) // 2)
 
-    # White boundaries for each row of the image
-    # Will contain lists [row mask index, min white column index, max white column index]
-    white_boundaries = []
-    # Source : https://stackoverflow.com/questions/34126230/getting-indices-of-a-specific-value-in-numpy-array
-    white_indices = lambda row : np.argwhere(row == 1).flatten()
-    min_mask = lambda row : np.min(white_indices(row))
-    max_mask = lambda row : np.max(white_indices(row))
-
-    for index, row in enumerate(seg_mask):
-        # Row is full black
-        if white_indices(row).size == 0:
-            continue
-        else:
-            white_boundaries.append([index, min_mask(row), max_mask(row)])
+    for i in np.flatnonzero(~is_present):
+        repairs.append({'event': 'row_missing', 'sop_uid': sop_uid, 'row': int(rows[i]),
+                        'min': int(mins[i]), 'max': int(maxs[i])})
 
-    # To ensure the right order
-    white_boundaries.sort(key=lambda x : x[0])
 
-    # Iteration taking 2 tuples at a time
-    for first, second in zip(white_boundaries, white_boundaries[1:]):
-        first_index, first_min, first_max = first
-        second_index, second_min, second_max = second
+    # 2) Check for absurd values, and correct them
+    new_mins, new_maxs, corrections, average_mins, average_maxs = _correct_absurd_values(mins, maxs)
 
-        # Check if rows are missing
-        if abs(first_index - second_index) != 1:
-            # Compute min and max means of the neighbours boundaries
-            average_min = np.mean([first_min, second_min], dtype=np.int32)
-            average_max = np.mean([first_max, second_max], dtype=np.int32)
-            # Complete missing lines
-            for i in range(first_index + 1, second_index):
-                file.write(f"Row {i} is missing\n")
-                white_boundaries.append([i, average_min, average_max])
+    for triple in np.flatnonzero(corrections):
+        # Values of the rows when the triple is checked: the first row is already corrected
+        if corrections[triple] == 1:
+            this_error, values, new_values, average = 'min', mins, new_mins, average_mins[triple]
+        else:
+            this_error, values, new_values, average = 'max', maxs, new_maxs, average_maxs[triple]
+        first, second, third = int(new_values[triple]), int(values[triple + 1]), int(values[triple + 2])
+        repairs.append({'event': 'absurd_value', 'sop_uid': sop_uid, 'bound': this_error,
+                        'rows': [int(rows[triple]), int(rows[triple + 1]), int(rows[triple + 2])],
+                        'before': [first, second, third],
+                        'after': [first, int(average), third]})
 
-    # To ensure the right order
-    white_boundaries.sort(key=lambda x : x[0])
 
+    # Fill the mask, the spans of the rows whose corrected min is after the max are empty
+    valid = new_mins <= new_maxs
+    seg_mask[_fill_spans_numpy(nrow, ncol, rows[valid], new_mins[valid], new_maxs[valid])] = 1
 
-    # 2) Check for absurd values, and correct them
-    # Arbitrarily threshold that tells when a value should be considered as an error
-    # Here tolerate 5% errors
-    ERROR_THRESHOLD = 0.05
-    # Iteration taking 3 tuples at a time
-    for boundaries_index, (first_b, second_b, third_b) in enumerate(
-        zip(white_boundaries, white_boundaries[1:], white_boundaries[2:])
-    ):
-
-        keys = ['index', 'min', 'max']
-        first = dict(zip(keys, first_b))
-        second = dict(zip(keys, second_b))
-        third = dict(zip(keys, third_b))
-        average = {
-            'min': np.mean([first['min'], third['min']], dtype=np.int32),
-            'max': np.mean([first['max'], third['max']], dtype=np.int32),
-        }
-
-        # Check if values of middle row are absurd
-        this_error = None
-        if abs((average['min'] - second['min']) / average['min']) > ERROR_THRESHOLD:
-            this_error = 'min'
-        elif abs((average['max'] - second['max']) / average['max']) > ERROR_THRESHOLD:
-            this_error = 'max'
-
-        if this_error:
-            white_boundaries[boundaries_index+1][1 if this_error == 'min' else 2] = average[this_error]
-            file.write(f"Rows {first['index']} - {second['index']} - {third['index']} " +\
-            f"have {this_error} absurd value. " +\
-            f"Before: {first[this_error]} - {second[this_error]} - {third[this_error]}. " +\
-            f"After: {first[this_error]} - {average[this_error]} - {third[this_error]}\n")
-
-
-    # Fill the mask
-    for row_index, min_white, max_white in white_boundaries:
-        seg_mask[row_index, min_white:max_white+1] = 1
-
-    file.close()
-    # Similar to os.stat()
-    if file_path.stat().st_size == 0:
-        # unlink() from pathlib is similar to os.remove()
-        Path.unlink(file_path)
-
-    return seg_mask
+    return seg_mask, repairs
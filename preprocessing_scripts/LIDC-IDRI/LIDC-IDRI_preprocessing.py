@@ -1,15 +1,39 @@
+import json
 import pydicom
 import numpy as np
 import normalize_dicom
 import segmentation_mask
-import pandas as pd
-from xml.dom import minidom
+import dicom_index
+import lidc_xml
+import consensus
+import sys
 from pathlib import Path
+from functools import partial
+
+# Modules shared by all the preprocessing scripts
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import parallel_driver
+import checkpoint
+import array_store
+import dtype_policy
+import dataset_statistics
+import repair_log
 
 
 arguments = {
     'dataset_folder': "preprocessing_scripts/LIDC-IDRI/data",
     'output_folder': "preprocessing_scripts/LIDC-IDRI/output",
+    'z_tolerance': 0.01, # Maximal distance (in mm) between the XML imageZposition and the slice position
+    'windows': None, # None for one channel (first DICOM window), or windows of the (C, H, W) images, e.g. 'preset', ['CT', 'dicom']
+    'workers': None, # Number of processes working on different series in parallel, None uses all the CPUs
+    'resume': True, # Skip the series completed by a previous run with the same parameters (see output_folder/manifest.jsonl)
+    'output_backend': 'npy', # 'npy' for one file per array, 'shards' to pack the arrays in output_folder/shards (see array_store)
+    'image_dtype': 'uint8', # 'uint8' for windowed images, 'native' for the stored values (e.g. int16, see output_folder/dtypes.json)
+    'mask_dtype': 'uint8', # 'uint8', 'bool', 'packbits' (8 pixels per byte) or 'float64' (see dtype_policy)
+    'consensus': None, # None for one image and mask per reader ROI, or levels of the readers consensus masks, e.g. ['union', 'majority', 'intersection']
+    'consensus_distance': 20, # Maximal distance (in pixels) between the centers of the nodules of different readers to be grouped
+    'fill_method': 'polygon', # 'polygon' (even-odd fill of the contours), or 'span' (previous method, repairs logged in output_folder/segmentationMasksLogs)
+    'histogram_range': (0, 256), # (min, max) of the intensity histogram in output_folder/statistics.json, e.g. (-1024, 3072) for 'native' images
     }
 
 
@@ -19,258 +43,462 @@ and creates numpy arrays in the given output folder
 Params:
     dataset_folder   - Required  : folder containing the data set
     output_folder    - Required  : output folders
+    z_tolerance      - Required  : tolerance (in mm) used to match the slices z position
+    windows          - Required  : None, or windows (see normalize_dicom.get_windows()) to create multi-channel images (resolved once per series)
+    workers          - Required  : number of worker processes (each series is processed independently)
+    resume           - Required  : resume an interrupted run, only the series not completed are processed
+    output_backend   - Required  : 'npy' or 'shards', how the arrays are stored (see array_store)
+    image_dtype      - Required  : dtype of the images, 'uint8' or 'native' (see dtype_policy)
+    mask_dtype       - Required  : dtype of the masks, 'uint8', 'bool', 'packbits' or 'float64' (see dtype_policy)
+    consensus        - Required  : None, or consensus levels (see consensus.LEVELS): the nodules of the readers
+                                   are grouped (all the readers, then the groups of mean malignancy > 3 are kept),
+                                   and each slice of a nodule is saved once, with one mask per level
+                                   (segmentation task only, masks in masks/<level>, readers in output_folder/consensus.json)
+    consensus_distance - Required : distance (in pixels) used to group the nodules of the readers
+    fill_method      - Required  : 'polygon' or 'span', how the masks are filled (see segmentation_mask)
+    histogram_range  - Required  : range of the 256 bins of the intensity histogram (see dataset_statistics)
 Returns:
     - No return value
 """
-# Ask the user which task he wants
-task = input("\n Please enter task. Localization (l) or segmentation (s)? ")
-while task not in ['l', 's']:
-    task = input("\n Please enter a valid task. Localization (l) or segmentation (s)? ")
-if task == 'l': task = 'localization'
-elif task == 's': task = 'segmentation'
-print(f"\n Starting {task} task:")
-
-
-# Get the arguments
-dataset_folder = Path(arguments['dataset_folder'])
-output_folder = Path(arguments['output_folder'])
-
-# The slash operator '/' in the pathlib module is similar to os.path.join()
-if task == 'localization':
-    localization_path = output_folder / 'localization'
-    Path.mkdir(localization_path, exist_ok=True)
-    true_output_path = localization_path / 'True'
-    false_output_path = localization_path / 'False'
-    Path.mkdir(true_output_path, exist_ok=True)
-    Path.mkdir(false_output_path, exist_ok=True)
-elif task == 'segmentation':
-    segmentation_path = output_folder / 'segmentation'
-    Path.mkdir(segmentation_path, exist_ok=True)
-    img_output_path = segmentation_path / 'img'
-    mask_output_path = segmentation_path / 'masks'
-    Path.mkdir(img_output_path, exist_ok=True)
-    Path.mkdir(mask_output_path, exist_ok=True)
-else:
-    assert False, "Task misspelled"
-
-# nnodules incremented at run time
-nnodules = 0
-nexported = 0
-nnot_found_slices = 0
-errors = []
-
-# iterdir() is similar to os.listdir()
-# Returns a generator object (function that behaves like an iterator)
-for patient_path in Path.iterdir(dataset_folder):
-
-    for patient_visit_path in Path.iterdir(patient_path):
-
-        for patient_visit_serie_path in Path.iterdir(patient_visit_path):
-            # Check if this visit contains DX or CR scans
-            # Need to cast to list because generators do not have len()
-            if len(list(Path.iterdir(patient_visit_serie_path))) <= 10:
-                print("\nDX or CR serie found, skip this visit")
-                continue
 
-            # glob() matches files with the given pattern
-            # It returns a generator containing the matched paths
-            # Cast to a list for the following use
-            xml_list = list(patient_visit_serie_path.glob("*.xml"))
-            xml_len = len(xml_list)
-            if xml_len != 1:
-                errors.append(f"{patient_visit_serie_path} has {xml_len} XML files")
-                continue
-            xml_path = xml_list[0]
 
-            print("\nParsing XML file:\n", flush=True)
+# Consensus levels and readers of the consensus images, in the output folder
+CONSENSUS_NAME = 'consensus.json'
+
+
+def get_output_paths(output_folder, task):
+    """Get the output folders of the given task
+    @params:
+        output_folder   - Required : Path to the output folder
+        task            - Required : 'localization' or 'segmentation'
+    Returns:
+        - Dictionary {name: Path}, parents before children
+    """
+    # The slash operator '/' in the pathlib module is similar to os.path.join()
+    if task == 'localization':
+        localization_path = output_folder / 'localization'
+        return {
+            'localization': localization_path,
+            'True': localization_path / 'True',
+            'False': localization_path / 'False',
+        }
+    elif task == 'segmentation':
+        segmentation_path = output_folder / 'segmentation'
+        output_paths = {
+            'segmentation': segmentation_path,
+            'img': segmentation_path / 'img',
+            'masks': segmentation_path / 'masks',
+        }
+        # One masks folder per consensus level
+        for level in arguments['consensus'] or []:
+            output_paths[f'masks_{level}'] = segmentation_path / 'masks' / level
+        return output_paths
+    else:
+        assert False, "Task misspelled"
+
+
+
+def process_consensus(patient_path, nodules, z_index, windows, output_paths, output_folder, statistics):
+    """Group the nodules of the readers, and save each slice of a nodule once, with one consensus mask per level
+    The nodules of all the readers are grouped, and the groups whose mean malignancy is <= 3 are then skipped
+    @params:
+        patient_path    - Required : Path to the patient folder
+        nodules         - Required : list of the lidc_xml.Nodule records of all the readers, whatever their malignancy
+        z_index         - Required : index of the slices of the series (see dicom_index.build_z_index())
+        windows         - Required : windows of the series (see normalize_dicom.get_series_windows()), or None
+        output_paths    - Required : output folders (see get_output_paths())
+        output_folder   - Required : Path to the output folder
+        statistics      - Required : dataset_statistics.DatasetStatistics of the series, updated with the saved arrays
+    Returns:
+        - Dictionary with the errors list, the counters nnodules, nexported and nnot_found_slices (rois of the kept
+          groups), the list of the files saved, the normalization parameters of the 'native' images, the records
+          of the masks repairs, and the readers of each saved image
+    """
+    errors = []
+    nnodules = 0
+    nexported = 0
+    nnot_found_slices = 0
+    files = []
+    normalization = []
+    repairs = []
+    readers = []
+    levels = arguments['consensus']
+    # Statistics of each channel (window) of the multi-channel images
+    channel_names = normalize_dicom.get_channel_names(windows) if arguments['image_dtype'] != 'native' else None
+
+    groups = consensus.group_nodules(nodules, arguments['consensus_distance'], arguments['z_tolerance'])
+    for group_index, group in enumerate(groups):
+        # Not a tumor for the readers, skip it (the group keeps its index, the file names do not depend on the others)
+        malignancy = consensus.group_malignancy(group)
+        if malignancy is not None and malignancy <= 3:
+            continue
+        nnodules += sum(len(nodule.rois) for nodule in group)
+
+        # Rois of the readers of this nodule on each slice {DICOM path: {reading session: list of rois}}
+        slices_rois = {}
+        for nodule in group:
+            for roi in nodule.rois:
+                dicom_path = dicom_index.find_slice(z_index, roi.z_position, arguments['z_tolerance'])
+                if dicom_path is None:
+                    errors.append(f"{patient_path} slice in position z {roi.z_position} not found")
+                    nnot_found_slices += 1
+                    print('.', end='', flush=True)
+                    continue
+                slices_rois.setdefault(dicom_path, {}).setdefault(nodule.reading_session, []).append(roi)
+                nexported += 1
+
+        for dicom_path, readers_rois in slices_rois.items():
+            # Load the whole dicom (with pixel data) once for all the readers
+            dcm = pydicom.dcmread(dicom_path)
+            if arguments['image_dtype'] == 'native':
+                slice_array, slice_normalization = normalize_dicom.get_native_array(dcm)
+            else:
+                slice_array = normalize_dicom.get_normalized_array(dcm, windows=windows)
+
+            # Mask of each reader of the slice (all its rois, holes included), (R, H, W)
+            mask_repairs = []
+            reader_masks = np.stack([
+                segmentation_mask.create_segmentation_mask(dcm, [roi.contour for roi in rois], output_folder, conversion=False,
+                                                           fill_method=arguments['fill_method'], repairs=mask_repairs)
+                for rois in readers_rois.values()])
+            # The readers of the nodule without contour on this slice vote for the background
+            masks = consensus.consensus_masks(reader_masks, len(group), levels)
+
+            pos_z = next(iter(readers_rois.values()))[0].z_position
+            # The series keeps the names of the series of the same patient unique
+            dest_fname = f"{patient_path.name}_series-{dcm.SeriesInstanceUID}_nodule-{group_index}_pos-{pos_z}"
+            for level in levels:
+                mask_array = dtype_policy.encode_mask(masks[level], arguments['mask_dtype'])
+                files.append(array_store.save_array(output_folder, output_paths[f'masks_{level}'] / (dest_fname + '_mask'),
+                                                    mask_array, arguments['output_backend']))
+            files.append(array_store.save_array(output_folder, output_paths['img'] / dest_fname, slice_array,
+                                                arguments['output_backend']))
+            if arguments['image_dtype'] == 'native':
+                normalization.append([files[-1], slice_normalization])
+            statistics.add_image('CT', slice_array, channels=channel_names)
+            # Statistics of the masks of the first level
+            statistics.add_mask(masks[levels[0]])
+            repairs.extend({'patient': patient_path.name, 'image': files[-1], **record} for record in mask_repairs)
+            readers.append([files[-1], {'nodule_ids': [nodule.nodule_id for nodule in group], 'readers': len(group),
+                                        'slice_readers': len(readers_rois), 'malignancy': malignancy}])
+            print('v', end='', flush=True)
+
+    return {
+        'errors': errors,
+        'nnodules': nnodules,
+        'nexported': nexported,
+        'nnot_found_slices': nnot_found_slices,
+        'files': files,
+        'normalization': normalization,
+        'repairs': repairs,
+        'readers': readers,
+    }
+
 
-            # parse() does not take Path() objects, so convert it to string
-            file = minidom.parse(str(xml_path))
 
-            # Create a dataframe to store informations about all nodules for this series
+def process_serie(serie_paths, task, output_folder):
+    """Parse the XML file of one series, and save the images (and masks) of all its nodules
+    @params:
+        serie_paths     - Required : tuple (patient path, series path)
+        task            - Required : 'localization' or 'segmentation'
+        output_folder   - Required : Path to the output folder
+    Returns:
+        - Dictionary with the errors list, the counters nnodules, nexported and nnot_found_slices,
+          the list of the files saved, the normalization parameters of the 'native' images, the statistics
+          of the saved images and masks, the records of the masks repairs, and the readers of the consensus images
+    """
+    patient_path, patient_visit_serie_path = serie_paths
+
+    output_paths = get_output_paths(output_folder, task)
+    if task == 'localization':
+        localization_path = output_paths['localization']
+    elif task == 'segmentation':
+        img_output_path = output_paths['img']
+        mask_output_path = output_paths['masks']
+    else:
+        assert False, "Task misspelled"
+
+    # Counters of this series
+    nnodules = 0
+    nexported = 0
+    nnot_found_slices = 0
+    errors = []
+    files = []
+    normalization = []
+    repairs = []
+    # Statistics of the saved images and masks, computed while they are written
+    statistics = dataset_statistics.DatasetStatistics(value_range=arguments['histogram_range'])
+
+    # Check if this visit contains DX or CR scans
+    # Need to cast to list because generators do not have len()
+    if len(list(Path.iterdir(patient_visit_serie_path))) <= 10:
+        print("\nDX or CR serie found, skip this visit")
+        return {'errors': errors}
+
+    # glob() matches files with the given pattern
+    # It returns a generator containing the matched paths
+    # Cast to a list for the following use
+    xml_list = list(patient_visit_serie_path.glob("*.xml"))
+    xml_len = len(xml_list)
+    if xml_len != 1:
+        errors.append(f"{patient_visit_serie_path} has {xml_len} XML files")
+        return {'errors': errors}
+    xml_path = xml_list[0]
+
+    print("\nParsing XML file:\n", flush=True)
+
+    # Rows of the nodules of this series, one per slice (roi), gathered in a list
+    # localization: (nodule ID, x pos, y pos, z pos, diagnosis), segmentation: (nodule ID, contour data, z pos)
+    nodules_rows = []
+    segmentation_nodules = []
+
+    # Nodules of all 4 reading sessions, read one at a time (nodules < 3mm, without characteristics, are skipped)
+    for nodule in lidc_xml.iter_nodules(xml_path):
+        # Get the nodule ID and malignancy (None if unknown)
+        nodule_id = nodule.nodule_id
+        malignancy = nodule.malignancy
+
+        if task == 'localization':
+            # Initialization
+            # Then set the diagnosis depending on the malignancy
+            diagnosis = ''
+            if malignancy in [1, 2]:
+                diagnosis = 'False'
+            # Uncertain diagnosis, skip this nodule
+            elif malignancy == 3:
+                continue
+            elif malignancy in [4, 5]:
+                diagnosis = 'True'
+            else:
+                errors.append(f"{patient_visit_serie_path} has nodule {nodule_id} with unknown malignancy")
+
+        elif task == 'segmentation':
+            if malignancy is None:
+                errors.append(f"{patient_visit_serie_path} has nodule {nodule_id} with unknow malignancy")
+            # Nodules of all the readers, grouped by the consensus before the malignancy is checked
+            segmentation_nodules.append(nodule)
+            # Not a tumor, skip it
+            if malignancy in [1, 2, 3]:
+                continue
+        else:
+            assert False, "Task misspelled"
+
+        # Each slice (roi) will be one row
+        for roi in nodule.rois:
             if task == 'localization':
-                nodules_df = pd.DataFrame(columns=['Nodule ID', 'x pos', 'y pos', 'z pos', 'Diagnosis'])
+                # Compute the center coordinates of the nodule in this slice
+                center_x = np.mean(roi.contour[:, 0], dtype=np.int32)
+                center_y = np.mean(roi.contour[:, 1], dtype=np.int32)
+                nodules_rows.append((nodule_id, center_x, center_y, roi.z_position, diagnosis))
             elif task == 'segmentation':
-                nodules_df = pd.DataFrame(columns=['Nodule ID', 'contour data', 'z pos'])
+                # Contour points (N, 2), x = column and y = row
+                nodules_rows.append((nodule_id, roi.contour, roi.z_position))
             else:
                 assert False, "Task misspelled"
 
-            # Search for all 4 reading sessions
-            reading_sessions = file.getElementsByTagName('readingSession')
-
-            for session in reading_sessions:
-                # Search for nodules
-                nodules = session.getElementsByTagName('unblindedReadNodule')
-
-                for nodule in nodules:
-                    # Nodules >=3mm have characteristics. If it is empty, we skip it
-                    if nodule.getElementsByTagName('characteristics') == []:
-                        print('.', end='', flush=True)
-                        continue
-                    # Get the nodule ID and malignancy,
-                    nodule_id = nodule.getElementsByTagName('noduleID')[0].firstChild.data
-                    malignancy = nodule.getElementsByTagName('malignancy')[0].firstChild.data
-
-                    if task == 'localization':
-                        # Initialization
-                        # Then set the diagnosis depending on the malignancy
-                        diagnosis = ''
-                        if malignancy in ['1','2']:
-                            diagnosis = 'False'
-                        # Uncertain diagnosis, skip this nodule
-                        elif malignancy == '3':
-                            continue
-                        elif malignancy in ['4','5']:
-                            diagnosis = 'True'
-                        else:
-                            errors.append(f"{patient_visit_serie_path} has nodule {nodule_id} with unknown malignancy")
-
-                    elif task == 'segmentation':
-                        if malignancy not in ['1', '2', '3', '4', '5']:
-                            errors.append(f"{patient_study_serie_path} has nodule {nodule_id} with unknow malignancy")
-                        # Not a tumor, skip it
-                        if malignancy in ['1','2','3']:
-                            continue
-                    else:
-                        assert False, "Task misspelled"
-
-                    # Search for all slices (roi)
-                    slices = nodule.getElementsByTagName('roi')
-                    # Each slice will be one row in nodules_df
-                    for slice in slices:
-                        # Initialization
-                        if task == 'localization':
-                            x_coords = []
-                            y_coords = []
-                        elif task == 'segmentation':
-                            contour_points = []
-                        else:
-                            assert False, "Task misspelled"
-
-                        # Get all edgeMaps
-                        edge_maps = slice.getElementsByTagName('edgeMap')
-                        for edge_map in edge_maps:
-                            # Add the values to the corresponding array
-                            x = int(edge_map.getElementsByTagName('xCoord')[0].firstChild.data)
-                            y = int(edge_map.getElementsByTagName('yCoord')[0].firstChild.data)
-                            if task == 'localization':
-                                x_coords = np.append(x_coords, x)
-                                y_coords = np.append(y_coords, y)
-                            elif task == 'segmentation':
-                                contour_points.append([x, y])
-                            else:
-                                assert False, "Task misspelled"
-
-                        if task == 'localization':
-                            # Compute the center coordinates of the nodule in this slice
-                            center_x = np.mean(x_coords, dtype=np.int32)
-                            center_y = np.mean(y_coords, dtype=np.int32)
-
-                        center_z = float(slice.getElementsByTagName('imageZposition')[0].firstChild.data)
-
-                        # Add a new row in the nodules dataframe
-                        if task == 'localization':
-                            nodules_df = nodules_df.append({
-                                'Nodule ID': nodule_id,
-                                'x pos': center_x,
-                                'y pos': center_y,
-                                'z pos': center_z,
-                                'Diagnosis': diagnosis,
-                            }, ignore_index=True)
-                        elif task == 'segmentation':
-                            nodules_df = nodules_df.append({
-                                'Nodule ID': nodule_id,
-                                'contour data': contour_points,
-                                'z pos': center_z,
-                            }, ignore_index=True)
-                        else:
-                            assert False, "Task misspelled"
-
-                        print('.', end='', flush=True)
-
-            # To check errors at the end
-            nnodules = nnodules + len(nodules_df)
-
-            print("\nSearching slices:\n", flush=True)
-
-            # Iteration over the nodules dataframe
-            for row_number, nodule_info in nodules_df.iterrows():
-                # Extract the infos for this row
-                if task == 'localization':
-                    nid, pos_x, pos_y, pos_z, diag = nodule_info
-                elif task == 'segmentation':
-                    nid, contour_data, pos_z = nodule_info
-                else:
-                    assert False, "Task misspelled"
-
-                # To check errors
-                sliceFound = False
-
-                dicom_paths_list = patient_visit_serie_path.glob("*.dcm")
-
-                for dicom_path in dicom_paths_list:
-                    # Load dicom and get the z position
-                    dcm = pydicom.dcmread(dicom_path)
-                    IMAGE_POSITION = (0x20,0x32)
-                    # Used for further comparison
-                    _x, _y, dcm_z_position = dcm[IMAGE_POSITION].value
-
-                    # Check if it is the slice that we want
-                    if dcm_z_position == pos_z:
-                        # Convert and save the image
-                        slice_array = normalize_dicom.get_normalized_array(dcm)
-                        if task == 'localization':
-                            # name returns a string representing the final path component
-                            # Add row_number at the end to avoid duplicates
-                            dest_fname_img = f"{patient_path.name}_nid-{nid}_pos-{pos_x}-{pos_y}_{row_number}.npy"
-                            dest_path_img = localization_path / diag / dest_fname_img
-                        elif task == 'segmentation':
-                            dest_fname_img = f"{patient_path.name}_nid-{nid}_pos-{pos_z}_{row_number}"
-                            dest_path_img = img_output_path / dest_fname_img
-                            # Save also mask for segmentation
-                            dest_fname_mask = dest_fname_img + '_mask'
-                            dest_path_mask = mask_output_path / dest_fname_mask
-                            # Contour points already converted, no conversion needed
-                            mask_array = segmentation_mask.create_segmentation_mask(dcm, contour_data, output_folder, conversion=False)
-                            # save() automatically appends .npy extension
-                            np.save(dest_path_mask, mask_array)
-                        else:
-                            assert False, "Task misspelled"
-                        np.save(dest_path_img, slice_array)
-
-                        # To count the errors
-                        sliceFound = True
-                        print('v', end='', flush=True)
-                        nexported += 1
-                        break
-                    else:
-                        print('.', end='', flush=True)
-
-                # If the slice was not found in the repository
-                if not sliceFound:
-                    errors.append(f"{patient_visit_serie_path} slice in position z {pos_z} not found")
-                    nnot_found_slices += 1
+            print('.', end='', flush=True)
+
+    # To check errors at the end
+    nnodules = nnodules + len(nodules_rows)
+
+    print("\nSearching slices:\n", flush=True)
+
+    # Read the headers of the series only once, and index the slices by z position
+    z_index = dicom_index.build_z_index(patient_visit_serie_path)
+    # Windows of the multi-channel images, resolved once: all the slices of the series have the same channels
+    series_windows = normalize_dicom.get_series_windows(z_index[1][0], arguments['windows']) if len(z_index[1]) > 0 else None
+    # Statistics of each channel (window) of the multi-channel images
+    channel_names = normalize_dicom.get_channel_names(series_windows) if arguments['image_dtype'] != 'native' else None
+
+    # Consensus of the readers, each slice of a nodule is saved once
+    if task == 'segmentation' and arguments['consensus'] is not None:
+        results = process_consensus(patient_path, segmentation_nodules, z_index, series_windows, output_paths, output_folder, statistics)
+        array_store.commit(output_folder, arguments['output_backend'])
+        # The rois of the nodules of the kept groups are counted, whatever the malignancy given by each reader
+        return {
+            **results,
+            'errors': errors + results['errors'],
+            'statistics': [statistics.to_dict()],
+        }
+
+    # Iteration over the nodules rows, the row number keeps the file names unique
+    for row_number, nodule_info in enumerate(nodules_rows):
+        # Extract the infos for this row
+        if task == 'localization':
+            nid, pos_x, pos_y, pos_z, diag = nodule_info
+        elif task == 'segmentation':
+            nid, contour_data, pos_z = nodule_info
+        else:
+            assert False, "Task misspelled"
+
+        # To check errors
+        sliceFound = False
+
+        dicom_path = dicom_index.find_slice(z_index, pos_z, arguments['z_tolerance'])
+
+        if dicom_path is not None:
+            # Load the whole dicom (with pixel data) only for the slice that we want
+            dcm = pydicom.dcmread(dicom_path)
+
+            # Repairs of the mask of this slice (span fill only)
+            mask_repairs = []
+
+            # Convert and save the image
+            if arguments['image_dtype'] == 'native':
+                slice_array, slice_normalization = normalize_dicom.get_native_array(dcm)
+            else:
+                slice_array = normalize_dicom.get_normalized_array(dcm, windows=series_windows)
+            statistics.add_image('CT', slice_array, channels=channel_names)
+            if task == 'localization':
+                # name returns a string representing the final path component
+                # Add row_number at the end to avoid duplicates
+                dest_fname_img = f"{patient_path.name}_nid-{nid}_pos-{pos_x}-{pos_y}_{row_number}.npy"
+                dest_path_img = localization_path / diag / dest_fname_img
+            elif task == 'segmentation':
+                dest_fname_img = f"{patient_path.name}_nid-{nid}_pos-{pos_z}_{row_number}"
+                dest_path_img = img_output_path / dest_fname_img
+                # Save also mask for segmentation
+                dest_fname_mask = dest_fname_img + '_mask'
+                dest_path_mask = mask_output_path / dest_fname_mask
+                # Contour points already converted, no conversion needed
+                mask_array = segmentation_mask.create_segmentation_mask(dcm, contour_data, output_folder, conversion=False,
+                                                                        fill_method=arguments['fill_method'],
+                                                                        repairs=mask_repairs)
+                statistics.add_mask(mask_array)
+                mask_array = dtype_policy.encode_mask(mask_array, arguments['mask_dtype'])
+                # save() automatically appends .npy extension
+                files.append(array_store.save_array(output_folder, dest_path_mask, mask_array, arguments['output_backend']))
+            else:
+                assert False, "Task misspelled"
+            files.append(array_store.save_array(output_folder, dest_path_img, slice_array, arguments['output_backend']))
+            if arguments['image_dtype'] == 'native':
+                normalization.append([files[-1], slice_normalization])
+            repairs.extend({'patient': patient_path.name, 'image': files[-1], **record} for record in mask_repairs)
+
+            # To count the errors
+            sliceFound = True
+            print('v', end='', flush=True)
+            nexported += 1
+        else:
+            print('.', end='', flush=True)
+
+        # If the slice was not found in the repository
+        if not sliceFound:
+            errors.append(f"{patient_visit_serie_path} slice in position z {pos_z} not found")
+            nnot_found_slices += 1
+
+    # The arrays of this series are on disk before it is recorded as completed
+    array_store.commit(output_folder, arguments['output_backend'])
+
+    return {
+        'errors': errors,
+        'nnodules': nnodules,
+        'nexported': nexported,
+        'nnot_found_slices': nnot_found_slices,
+        'files': files,
+        'normalization': normalization,
+        'statistics': [statistics.to_dict()],
+        'repairs': repairs,
+    }
+
 
 
-# Sanity checks
-print("\nList of errors :")
-print(errors)
-print(f"\nTotal numbers of nodules (nnodules): {nnodules}")
-print(f"Expected: nexported + nnot_found_slices == nnodules")
-print(f"{nexported} + {nnot_found_slices} = {nexported + nnot_found_slices} (expected {nnodules})")
-assert nexported + nnot_found_slices == nnodules, "Slices number do not match!"
-
-if task == 'localization':
-    ntrue = len(list(Path.iterdir(true_output_path)))
-    nfalse = len(list(Path.iterdir(false_output_path)))
-    print(f"\nExpected: ntrue + nfalse == nexported")
-    print(f"{ntrue} + {nfalse} = {ntrue + nfalse} (expected {nexported})")
-    assert ntrue + nfalse == nexported, "File numbers do not match!"
-elif task == 'segmentation':
-    nimg = len(list(Path.iterdir(img_output_path)))
-    nmask = len(list(Path.iterdir(mask_output_path)))
-    print(f"\nExpected: nimg = nmask")
-    print(f"{nimg} = {nmask}")
-    assert nimg == nmask, "File numbers do not match!"
-else:
-    assert False, "Task misspelled"
+# Main
+if __name__ == "__main__":
+    # Ask the user which task he wants
+    task = input("\n Please enter task. Localization (l) or segmentation (s)? ")
+    while task not in ['l', 's']:
+        task = input("\n Please enter a valid task. Localization (l) or segmentation (s)? ")
+    if task == 'l': task = 'localization'
+    elif task == 's': task = 'segmentation'
+    print(f"\n Starting {task} task:")
+
+
+    # Get the arguments
+    dataset_folder = Path(arguments['dataset_folder'])
+    output_folder = Path(arguments['output_folder'])
+
+    dtype_policy.check_policy(arguments['image_dtype'], arguments['mask_dtype'], image_dtypes=['uint8', 'native'])
+
+    # Create the output folders (parents first)
+    output_paths = get_output_paths(output_folder, task)
+    for output_path in output_paths.values():
+        Path.mkdir(output_path, exist_ok=True)
+
+    # Multi-channel images: record the channels order
+    if arguments['windows'] is not None:
+        normalize_dicom.save_windows_header(output_folder, arguments['windows'])
+
+    # iterdir() is similar to os.listdir()
+    # Returns a generator object (function that behaves like an iterator)
+    # Each series is an independent work unit
+    series = []
+    for patient_path in Path.iterdir(dataset_folder):
+
+        for patient_visit_path in Path.iterdir(patient_path):
+
+            for patient_visit_serie_path in Path.iterdir(patient_visit_path):
+                series.append((patient_path, patient_visit_serie_path))
+
+    # Parameters that change the outputs, a series completed with other parameters is processed again
+    parameters = {'task': task, 'z_tolerance': arguments['z_tolerance'], 'windows': arguments['windows'],
+                  'output_backend': arguments['output_backend'], 'image_dtype': arguments['image_dtype'],
+                  'mask_dtype': arguments['mask_dtype'], 'histogram_range': arguments['histogram_range'],
+                  'fill_method': arguments['fill_method'], 'consensus': arguments['consensus'],
+                  'consensus_distance': arguments['consensus_distance']}
+    serie_key = lambda serie: str(serie[1].relative_to(dataset_folder))
+
+    # Repairs of the masks, in one log for this run (written as each series is completed), with a summary per patient
+    # The repairs of the series completed by a previous run are in the log of that run
+    repairs = repair_log.RepairLog(output_folder)
+    results = checkpoint.run(partial(process_serie, task=task, output_folder=output_folder), series, serie_key,
+                             parameters, output_folder, arguments['workers'], arguments['resume'],
+                             on_result=repairs.log_result)
+    repairs.close()
+    results = parallel_driver.merge_results(results)
+
+    # Aggregated counters of all the series
+    errors = results.get('errors', [])
+    nnodules = results.get('nnodules', 0)
+    nexported = results.get('nexported', 0)
+    nnot_found_slices = results.get('nnot_found_slices', 0)
+
+    # Record the dtypes, and how to normalize the 'native' images {image key: parameters}
+    dtype_policy.save_header(output_folder, arguments['image_dtype'], arguments['mask_dtype'],
+                             normalization=dict(results.get('normalization', [])))
+    # Consensus levels, and the readers of each consensus image {image key: readers}, in their own file
+    if task == 'segmentation' and arguments['consensus'] is not None:
+        with open(output_folder / CONSENSUS_NAME, mode='w') as file:
+            json.dump({'levels': arguments['consensus'], 'readers': dict(results.get('readers', []))}, file, indent=4)
+
+    # Intensity and mask statistics of the whole data set (the completed series come from the manifest)
+    dataset_statistics.save_summary(output_folder, dataset_statistics.merge(results.get('statistics', [])),
+                                    image_dtype=arguments['image_dtype'])
+
+
+    # Sanity checks
+    print("\nList of errors :")
+    print(errors)
+    print(f"\nTotal numbers of nodules (nnodules): {nnodules}")
+    print(f"Expected: nexported + nnot_found_slices == nnodules")
+    print(f"{nexported} + {nnot_found_slices} = {nexported + nnot_found_slices} (expected {nnodules})")
+    assert nexported + nnot_found_slices == nnodules, "Slices number do not match!"
+
+    backend = arguments['output_backend']
+    if task == 'localization':
+        ntrue = array_store.count_arrays(output_folder, output_paths['True'], backend)
+        nfalse = array_store.count_arrays(output_folder, output_paths['False'], backend)
+        print(f"\nExpected: ntrue + nfalse == nexported")
+        print(f"{ntrue} + {nfalse} = {ntrue + nfalse} (expected {nexported})")
+        assert ntrue + nfalse == nexported, "File numbers do not match!"
+    elif task == 'segmentation':
+        nimg = array_store.count_arrays(output_folder, output_paths['img'], backend)
+        # One masks folder per consensus level
+        masks_paths = [output_paths[f'masks_{level}'] for level in arguments['consensus'] or []] or [output_paths['masks']]
+        for masks_path in masks_paths:
+            nmask = array_store.count_arrays(output_folder, masks_path, backend)
+            print(f"\nExpected: nimg = nmask")
+            print(f"{nimg} = {nmask}")
+            assert nimg == nmask, "File numbers do not match!"
+    else:
+        assert False, "Task misspelled"
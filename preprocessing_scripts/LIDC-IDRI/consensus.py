@@ -0,0 +1,116 @@
+import numpy as np
+
+
+"""
+Description: consensus of the LIDC-IDRI readers.
+The nodule IDs are only unique for one reader, so the nodules of the different reading sessions are grouped
+by position: a nodule joins the closest group with no nodule of the same reader, whose z range overlaps
+its own and whose center (in pixels) is close enough. The nodules of all the readers are grouped, whatever their
+malignancy, then the groups are selected on the malignancy of the group (see group_malignancy()), so that all
+the readers of a nodule count in the consensus. The masks of the readers of a group are then combined
+pixel-wise, for all the consensus levels at once.
+"""
+
+# Consensus levels, minimum fraction of the readers of the nodule
+#   union          : at least one reader
+#   majority       : at least half of the readers
+#   intersection   : all the readers
+LEVELS = ['union', 'majority', 'intersection']
+
+
+def nodule_extent(nodule):
+    """Get the center (x, y, in pixels) and the z range (in mm) of a nodule
+    @params:
+        nodule   - Required : lidc_xml.Nodule record
+    Returns:
+        - 1D NumPy array (x, y), mean of the points of the inclusion contours (the holes do not move the center)
+        - Tuple (min z, max z)
+        None if the nodule has no inclusion contour (a nodule without roi is valid in the XML files)
+    """
+    inclusions = [roi.contour for roi in nodule.rois if roi.inclusion and len(roi.contour) > 0]
+    if len(inclusions) == 0:
+        return None
+    z_positions = [roi.z_position for roi in nodule.rois]
+    return np.concatenate(inclusions).mean(axis=0), (min(z_positions), max(z_positions))
+
+
+
+def group_nodules(nodules, max_distance, z_tolerance=0.01):
+    """Group the nodules annotated by different readers
+    @params:
+        nodules        - Required : list of lidc_xml.Nodule records, the ones without inclusion contour are left out
+        max_distance   - Required : maximal distance (in pixels) between the centers of the nodules of a group
+        z_tolerance    - Optional : tolerance (in mm) used to compare the z ranges
+    Returns:
+        - List of groups, each a list of Nodule records of different readers (in the order of the nodules)
+    """
+    groups = []
+    # Center (mean of the centers of the nodules), z range and readers of each group
+    centers = []
+    z_ranges = []
+    readers = []
+    for nodule in nodules:
+        extent = nodule_extent(nodule)
+        if extent is None:
+            continue
+        center, (z_min, z_max) = extent
+        best, best_distance = None, None
+        for index, group in enumerate(groups):
+            if nodule.reading_session in readers[index]:
+                continue
+            group_min, group_max = z_ranges[index]
+            if z_min > group_max + z_tolerance or z_max < group_min - z_tolerance:
+                continue
+            distance = np.linalg.norm(center - centers[index])
+            if distance <= max_distance and (best is None or distance < best_distance):
+                best, best_distance = index, distance
+
+        if best is None:
+            groups.append([nodule])
+            centers.append(center)
+            z_ranges.append((z_min, z_max))
+            readers.append({nodule.reading_session})
+        else:
+            groups[best].append(nodule)
+            centers[best] = centers[best] + (center - centers[best]) / len(groups[best])
+            group_min, group_max = z_ranges[best]
+            z_ranges[best] = (min(group_min, z_min), max(group_max, z_max))
+            readers[best].add(nodule.reading_session)
+
+    return groups
+
+
+
+def group_malignancy(group):
+    """Get the malignancy of a group of nodules, mean of the malignancy of its readers
+    @params:
+        group   - Required : list of lidc_xml.Nodule records (see group_nodules())
+    Returns:
+        - Mean malignancy (1 to 5) of the readers who rated it, None if no reader rated it
+    """
+    malignancies = [nodule.malignancy for nodule in group if nodule.malignancy is not None]
+    if len(malignancies) == 0:
+        return None
+    return float(np.mean(malignancies))
+
+
+
+def consensus_masks(reader_masks, nreaders, levels=LEVELS):
+    """Combine the masks of the readers of one slice
+    @params:
+        reader_masks   - Required : (R, H, W) array, 0/1 mask of each reader who contoured the nodule on this slice
+        nreaders       - Required : number of readers of the nodule (readers without a contour on this slice
+                                    count as background votes)
+        levels         - Optional : consensus levels, see LEVELS
+    Returns:
+        - Dictionary {level: (H, W) uint8 mask}
+    """
+    # Number of readers who marked each pixel
+    votes = np.count_nonzero(reader_masks, axis=0)
+    thresholds = {'union': 1, 'majority': (nreaders + 1) // 2, 'intersection': nreaders}
+    for level in levels:
+        if level not in thresholds:
+            raise ValueError(f"Unknown consensus level {level}")
+    # All the levels at once, (L, H, W)
+    masks = votes >= np.array([thresholds[level] for level in levels]).reshape(-1, 1, 1)
+    return dict(zip(levels, masks.astype(np.uint8)))
@@ -0,0 +1,113 @@
+import pydicom
+import numpy as np
+from pathlib import Path
+
+
+# Dicom tags
+IMAGE_POSITION = (0x20,0x32)
+IMAGE_ORIENTATION = (0x20,0x37)
+SOP_INSTANCE_UID = (0x8,0x18)
+MODALITY = (0x8,0x60)
+
+
+def build_z_index(serie_path):
+    """Index the slices of a series by their z position, reading only the DICOM headers
+    @params:
+        serie_path   - Required : Path to the folder containing the DICOM files (*.dcm) of one series
+    Returns:
+        z_positions  - 1D sorted NumPy array containing the z position (in mm) of each slice
+        paths        - List of Paths, paths[i] is the DICOM file of the slice at z_positions[i]
+    """
+    z_positions = []
+    paths = []
+    for dicom_path in Path(serie_path).glob("*.dcm"):
+        # Header only: skip the pixel data and stop parsing after ImagePositionPatient
+        dcm = pydicom.dcmread(dicom_path, stop_before_pixels=True, specific_tags=[IMAGE_POSITION])
+        if IMAGE_POSITION not in dcm:
+            continue
+        _x, _y, z = dcm[IMAGE_POSITION].value
+        z_positions.append(float(z))
+        paths.append(dicom_path)
+
+    # Sort once, so that every lookup is a binary search
+    order = np.argsort(z_positions, kind='stable')
+    z_positions = np.asarray(z_positions, dtype=np.float64)[order]
+    paths = [paths[i] for i in order]
+
+    return z_positions, paths
+
+
+
+def find_slice(z_index, pos_z, tolerance=0.01):
+    """Get the path of the slice closest to the given z position
+    @params:
+        z_index      - Required : tuple (z_positions, paths) returned by build_z_index()
+        pos_z        - Required : z position (in mm) of the wanted slice
+        tolerance    - Optional : maximal distance (in mm) between pos_z and the slice position
+    Returns:
+        - Path of the DICOM file, or None if no slice is within the tolerance
+    """
+    z_positions, paths = z_index
+    if len(z_positions) == 0:
+        return None
+
+    # Index of the first position >= pos_z, the closest slice is either this one or the previous one
+    index = np.searchsorted(z_positions, pos_z)
+    candidates = [i for i in (index - 1, index) if 0 <= i < len(z_positions)]
+    closest = min(candidates, key=lambda i: abs(z_positions[i] - pos_z))
+
+    if abs(z_positions[closest] - pos_z) > tolerance:
+        return None
+    return paths[closest]
+
+
+
+def build_sop_index(serie_path):
+    """Index the images of a series by their SOPInstanceUID, reading only the DICOM headers
+    @params:
+        serie_path   - Required : Path to the folder containing the DICOM files of one series
+    Returns:
+        - Dictionary {SOPInstanceUID: (path, modality)}
+    """
+    sop_index = {}
+    for dicom_path in Path.iterdir(Path(serie_path)):
+        # Header only: skip the pixel data and only parse the two needed tags
+        dcm = pydicom.dcmread(dicom_path, stop_before_pixels=True, specific_tags=[SOP_INSTANCE_UID, MODALITY])
+        if SOP_INSTANCE_UID not in dcm:
+            continue
+        modality = dcm[MODALITY].value if MODALITY in dcm else None
+        sop_index[dcm[SOP_INSTANCE_UID].value] = (dicom_path, modality)
+
+    return sop_index
+
+
+
+def slice_position(dcm):
+    """Position (in mm) of a slice along the normal of its plane, to sort the slices of a series
+    @params:
+        dcm   - Required : DICOM dataset (Pydicom), at least with ImagePositionPatient and ImageOrientationPatient
+    """
+    Xx, Xy, Xz, Yx, Yy, Yz = [float(value) for value in dcm[IMAGE_ORIENTATION].value]
+    normal = np.cross([Xx, Xy, Xz], [Yx, Yy, Yz])
+    return float(np.dot(normal, [float(value) for value in dcm[IMAGE_POSITION].value]))
+
+
+
+def build_position_index(serie_path):
+    """Index the images of a series by their position along the normal of their plane, reading only the DICOM headers
+    @params:
+        serie_path   - Required : Path to the folder containing the DICOM files of one series
+    Returns:
+        - List of tuples (position, SOPInstanceUID, path), sorted by position
+    """
+    slices = []
+    for dicom_path in Path.iterdir(Path(serie_path)):
+        # Header only: skip the pixel data and only parse the three needed tags
+        dcm = pydicom.dcmread(dicom_path, stop_before_pixels=True,
+                              specific_tags=[SOP_INSTANCE_UID, IMAGE_POSITION, IMAGE_ORIENTATION])
+        if SOP_INSTANCE_UID not in dcm or IMAGE_POSITION not in dcm or IMAGE_ORIENTATION not in dcm:
+            continue
+        slices.append((slice_position(dcm), dcm[SOP_INSTANCE_UID].value, dicom_path))
+
+    slices.sort(key=lambda slice: slice[0])
+    return slices
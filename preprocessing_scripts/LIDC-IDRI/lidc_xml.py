@@ -0,0 +1,96 @@
+import numpy as np
+from collections import namedtuple
+from xml.etree import ElementTree
+
+
+"""
+Description: streaming reader of the LIDC-IDRI annotation XML files.
+The file is read with ElementTree.iterparse(): each nodule is converted to a record as soon as its end tag
+is parsed, then its elements are freed, so the memory used does not grow with the size of the file.
+"""
+
+# One nodule annotated by one reader
+#   reading_session : index of the reading session (reader) in the XML file
+#   nodule_id       : string, unique for one reader only
+#   malignancy      : int from 1 to 5, None if missing or unknown
+#   rois            : list of ROI records, one per slice
+Nodule = namedtuple('Nodule', ['reading_session', 'nodule_id', 'malignancy', 'rois'])
+
+# Contour of a nodule in one slice
+#   z_position      : float, imageZposition of the slice (in mm)
+#   sop_uid         : string, SOPInstanceUID of the slice ('' if missing)
+#   inclusion       : bool, False if the contour delimits a hole in the nodule
+#   contour         : int32 array (N, 2) of the contour points (x = column, y = row)
+ROI = namedtuple('ROI', ['z_position', 'sop_uid', 'inclusion', 'contour'])
+
+
+def _child_text(element, tag):
+    """Text of the first child with the given (qualified) tag, None if there is none"""
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return None
+    return child.text.strip()
+
+
+
+def _parse_roi(roi, ns):
+    """Convert a roi element to a ROI record (ns is the namespace of the tags, '{http://www.nih.gov}')"""
+    # Coordinates of all the edgeMaps, in the order of the file (iter() filters the tags in C)
+    x_coords = [x.text for x in roi.iter(f'{ns}xCoord')]
+    y_coords = [y.text for y in roi.iter(f'{ns}yCoord')]
+    contour = np.empty((len(x_coords), 2), dtype=np.int32)
+    contour[:, 0] = np.array(x_coords, dtype=np.int32)
+    contour[:, 1] = np.array(y_coords, dtype=np.int32)
+
+    return ROI(
+        z_position=float(_child_text(roi, f'{ns}imageZposition')),
+        sop_uid=_child_text(roi, f'{ns}imageSOP_UID') or '',
+        inclusion=(_child_text(roi, f'{ns}inclusion') or 'TRUE').upper() == 'TRUE',
+        contour=contour,
+    )
+
+
+
+def _parse_nodule(nodule, reading_session, ns):
+    """Convert an unblindedReadNodule element to a Nodule record"""
+    malignancy = _child_text(nodule, f'{ns}characteristics/{ns}malignancy')
+    malignancy = int(malignancy) if malignancy is not None and malignancy.isdigit() else None
+    if malignancy not in [1, 2, 3, 4, 5]:
+        malignancy = None
+
+    rois = [_parse_roi(roi, ns) for roi in nodule.iterfind(f'{ns}roi')]
+    return Nodule(reading_session, _child_text(nodule, f'{ns}noduleID'), malignancy, rois)
+
+
+
+def iter_nodules(xml_path, small_nodules=False):
+    """Read the nodules of an LIDC-IDRI XML file, one at a time
+    @params:
+        xml_path        - Required : Path to the XML file
+        small_nodules   - Optional : also yield the nodules < 3mm, that have no characteristics (malignancy is None)
+    Returns:
+        - Generator of Nodule records, in the order of the file
+    """
+    # Index of the current reading session, incremented at the end of each session
+    reading_session = 0
+    ns = None
+    # Only the end events, the elements of a nodule are complete when its end tag is parsed
+    # parse() does not take Path() objects, so convert it to string
+    for _event, element in ElementTree.iterparse(str(xml_path)):
+        tag = element.tag
+        # Namespace of the file ('{http://www.nih.gov}'), from the first element
+        if ns is None:
+            ns = tag[:tag.index('}') + 1] if tag.startswith('{') else ''
+            nodule_tag, non_nodule_tag, session_tag = f'{ns}unblindedReadNodule', f'{ns}nonNodule', f'{ns}readingSession'
+
+        if tag == nodule_tag:
+            # Nodules >=3mm have characteristics
+            if small_nodules or element.find(f'{ns}characteristics') is not None:
+                yield _parse_nodule(element, reading_session, ns)
+            # The nodule is converted, free its elements
+            element.clear()
+        elif tag == non_nodule_tag:
+            element.clear()
+        elif tag == session_tag:
+            reading_session += 1
+            element.clear()
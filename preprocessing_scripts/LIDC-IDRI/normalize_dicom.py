@@ -1,18 +1,22 @@
 import numpy as np
 from PIL import Image
 import pydicom
+from pathlib import Path
+from functools import lru_cache
+import json
 
 
-def get_LUT_value(numpyArray, windowWidth, windowCenter, rescaleSlope, rescaleIntercept):
-    """Apply the RGB Look-Up Table for the given data and window/level value.
-    @params:
-        numpyArray - Required: NumPy array containing the value of each pixel, 16 bits per pixel
-        windowWidth- Required: dataset.WindowWidth (cannot appear without WindowCenter)
-        windowCenter - Required: dataset.WindowCenter (cannot appear without WindowWidth)
-        rescaleSlope - Required: specify the linear transformation from pixels in their stored on disk representation to their
-                       in memory representation
-        rescaleIntercept - Required: specify the linear transformation from pixels in their stored on disk representation to their
-                       in memory representation
+# Named windows (name, window center, window width) used for multi-channel outputs, per modality
+# CT values are in Hounsfield units. Other modalities have no preset, their own DICOM windows are used
+WINDOW_PRESETS = {
+    'CT': [('lung', -600, 1500), ('mediastinum', 50, 350), ('bone', 300, 2000)],
+}
+
+
+def _get_LUT_value_piecewise(numpyArray, windowWidth, windowCenter, rescaleSlope, rescaleIntercept):
+    """Apply the window/level to the given data, element by element (reference implementation)
+    This function is used to build the look-up tables, so that they are bit-identical to this computation
+    @params: see get_LUT_value()
     """
 
     # Hounsfield unit:
@@ -28,15 +32,9 @@ def get_LUT_value(numpyArray, windowWidth, windowCenter, rescaleSlope, rescaleIn
     if rescaleSlope != None and rescaleIntercept != None:
         numpyArray = numpyArray * rescaleSlope + rescaleIntercept
 
-    if isinstance(windowCenter, pydicom.multival.MultiValue):
-        windowCenter = windowCenter[0]
-
-    if isinstance(windowWidth, pydicom.multival.MultiValue):
-        windowWidth = windowWidth[0]
-
     # np.piecewise iterates through an array, checks the given conditions on each element, returns the corresponding value of the last array
     # Example:
-    ### x = np.array([1,2,3,4])
+    ### x = np.array([1,2,3,4])
     ### np.piecewise(x, [x < 3, x >= 3], [0,1])
     ### --> array([0, 0, 1, 1])
     # http://dicom.nema.org/medical/dicom/2014a/output/pdf/part03.pdf page 1057
@@ -53,12 +51,241 @@ def get_LUT_value(numpyArray, windowWidth, windowCenter, rescaleSlope, rescaleIn
 
 
 
+@lru_cache(maxsize=32)
+def _get_LUT(dtype, windowWidth, windowCenter, rescaleSlope, rescaleIntercept):
+    """Build the look-up table of one (dtype, slope, intercept, center, width) tuple, least recently used ones are evicted
+    The table has one uint8 entry per possible stored value (65536 entries for 16 bits data),
+    ordered as the stored values viewed as unsigned integers"""
+    nbits = 8 * dtype.itemsize
+    stored_values = np.arange(2 ** nbits, dtype=f'u{dtype.itemsize}').view(dtype)
+    lut = _get_LUT_value_piecewise(stored_values, windowWidth, windowCenter, rescaleSlope, rescaleIntercept)
+    # The cached table is shared, protect it against modifications
+    lut.flags.writeable = False
+    return lut
+
+
+
+def _apply_window(numpyArray, windowWidth, windowCenter, rescaleSlope, rescaleIntercept):
+    """Apply the window/level to data that can not use a look-up table (float or 32/64 bits data)
+    Same result as _get_LUT_value_piecewise(), with in-place operations instead of np.piecewise"""
+    if rescaleSlope != None and rescaleIntercept != None:
+        numpyArray = numpyArray * rescaleSlope + rescaleIntercept
+
+    # Linear part of the window, computed on the whole array
+    values = numpyArray - (windowCenter - 0.5)
+    values /= (windowWidth-1)
+    values += 0.5
+    values *= 255
+
+    # Values outside of the window, same conditions as the reference implementation
+    values[numpyArray <= windowCenter-0.5-(windowWidth-1)/2] = 0
+    values[numpyArray > windowCenter - 0.5 + (windowWidth-1) /2] = 255
+
+    return values.astype('uint8')
+
+
+
+def get_LUT_value(numpyArray, windowWidth, windowCenter, rescaleSlope, rescaleIntercept):
+    """Apply the RGB Look-Up Table for the given data and window/level value.
+    @params:
+        numpyArray - Required: NumPy array containing the value of each pixel, 16 bits per pixel
+        windowWidth- Required: dataset.WindowWidth (cannot appear without WindowCenter)
+        windowCenter - Required: dataset.WindowCenter (cannot appear without WindowWidth)
+        rescaleSlope - Required: specify the linear transformation from pixels in their stored on disk representation to their
+                       in memory representation
+        rescaleIntercept - Required: specify the linear transformation from pixels in their stored on disk representation to their
+                       in memory representation
+    """
+    if isinstance(windowCenter, pydicom.multival.MultiValue):
+        windowCenter = windowCenter[0]
+
+    if isinstance(windowWidth, pydicom.multival.MultiValue):
+        windowWidth = windowWidth[0]
+
+    numpyArray = np.asarray(numpyArray)
+
+    # For 8 and 16 bits integer data, the output is a pure function of the stored value:
+    # compute it once for every possible value, then only index the look-up table
+    if numpyArray.dtype.kind in 'iu' and numpyArray.dtype.itemsize <= 2:
+        if not numpyArray.dtype.isnative:
+            numpyArray = numpyArray.astype(numpyArray.dtype.newbyteorder('='))
+        lut = _get_LUT(numpyArray.dtype, windowWidth, windowCenter, rescaleSlope, rescaleIntercept)
+        return np.take(lut, numpyArray.view(f'u{numpyArray.dtype.itemsize}'))
+
+    return _apply_window(numpyArray, windowWidth, windowCenter, rescaleSlope, rescaleIntercept)
+
+
+
+
+def get_windows(dataset, windows='preset'):
+    """Get the list of windows to apply to the given dataset
+    @params:
+        dataset   - Required : FileDataset (Pydicom) corresponding to one specific slice
+        windows   - Optional : list whose elements are windows (name, window center, window width),
+                               'dicom' for all the windows stored in the dataset, or a modality of WINDOW_PRESETS.
+                               'preset' (default) uses the preset of the dataset modality, or 'dicom' if there is none
+    Returns:
+        - List of tuples (name, window center, window width)
+    """
+    if isinstance(windows, str):
+        windows = [windows]
+
+    resolved = []
+    for window in windows:
+        if window == 'preset':
+            window = dataset.get('Modality') if dataset.get('Modality') in WINDOW_PRESETS else 'dicom'
+
+        if window == 'dicom':
+            # WindowCenter and WindowWidth can contain several values (MultiValue)
+            if ('WindowWidth' in dataset) and ('WindowCenter' in dataset):
+                centers = dataset.WindowCenter
+                widths = dataset.WindowWidth
+                if not isinstance(centers, pydicom.multival.MultiValue):
+                    centers, widths = [centers], [widths]
+                for index, (center, width) in enumerate(zip(centers, widths)):
+                    resolved.append((f'dicom{index}', center, width))
+        elif isinstance(window, str):
+            resolved.extend(WINDOW_PRESETS[window])
+        else:
+            resolved.append(tuple(window))
+
+    if len(resolved) == 0:
+        raise TypeError("DICOM dataset does not have window information, and no window was given")
+
+    return resolved
+
+
+
+def get_multi_window_array(dataset, windows='preset'):
+    """Get a multi-channel normalized NumPy array from DICOM file, one channel per window
+    The pixel data is decoded once, and rescaled at most once, for all the windows
+    @params:
+        dataset   - Required : FileDataset (Pydicom) corresponding to one specific slice
+        windows   - Optional : windows to apply, see get_windows()
+    Returns:
+        - uint8 NumPy array of shape (C, H, W), channels in the order of get_windows()
+    """
+    # dataset without pixels
+    if ('PixelData' not in dataset):
+        raise TypeError("DICOM dataset does not have pixel data")
+
+    windows = get_windows(dataset, windows)
+
+    if ('RescaleSlope' in dataset) and ('RescaleIntercept' in dataset):
+        rescaleSlope, rescaleIntercept = dataset.RescaleSlope, dataset.RescaleIntercept
+    else:
+        rescaleSlope, rescaleIntercept = None, None
+
+    # One decode of the pixel data
+    pixel_array = dataset.pixel_array
+    channels = np.empty((len(windows),) + pixel_array.shape, dtype=np.uint8)
+
+    if pixel_array.dtype.kind in 'iu' and pixel_array.dtype.itemsize <= 2:
+        # The look-up tables include the rescale, so the rescale is never computed on the whole array
+        for channel, (_name, center, width) in zip(channels, windows):
+            channel[...] = get_LUT_value(pixel_array, width, center, rescaleSlope, rescaleIntercept)
+    else:
+        # Rescale once, then apply each window to the rescaled values
+        if rescaleSlope != None and rescaleIntercept != None:
+            pixel_array = pixel_array * rescaleSlope + rescaleIntercept
+        for channel, (_name, center, width) in zip(channels, windows):
+            channel[...] = _apply_window(pixel_array, width, center, None, None)
+
+    return channels
+
+
+
+def get_series_windows(dicom_path, windows):
+    """Resolve the windows once for a whole series, from the header of one of its slices
+    The 'dicom' (and 'preset' without preset) windows are read in the DICOM header, which can list other windows
+    (or another number of windows) in other slices of the series: all the slices of a series are normalized with
+    the windows of the given slice, so that they have the same channels
+    @params:
+        dicom_path   - Required : Path to one slice of the series (the scripts use the first one)
+        windows      - Required : None, or windows to apply, see get_windows()
+    Returns:
+        - None if windows is None, else list of tuples (name, window center, window width) to give to get_normalized_array()
+    """
+    if windows is None:
+        return None
+    dataset = pydicom.dcmread(dicom_path, stop_before_pixels=True)
+    return [(name, float(center), float(width)) for name, center, width in get_windows(dataset, windows)]
+
+
+
+def get_channel_names(windows):
+    """Get the names of the channels of the images normalized with the given windows
+    @params:
+        windows   - Required : windows returned by get_series_windows(), None for (H, W) images
+    Returns:
+        - None for (H, W) images, else list of the window names, in the order of the channels
+    """
+    if windows is None:
+        return None
+    return [name for name, _center, _width in windows]
+
+
+
+def save_windows_header(output_folder, windows):
+    """Save the windows used for the multi-channel images in 'windows.json' in the output folder,
+    so that the order of the channels is known when the arrays are loaded
+    @params:
+        output_folder   - Required : Path to the output folder
+        windows         - Required : windows given to get_normalized_array()
+    """
+    header = {
+        'windows': windows,
+        'presets': WINDOW_PRESETS,
+        'description': "Images are uint8 arrays of shape (C, H, W), one channel per window (name, center, width), " +\
+                       "'dicom' channels use the windows stored in the DICOM, 'preset' the preset of the modality. " +\
+                       "The windows are read once per series (first slice), all the slices of a series have the same channels",
+    }
+    with open(Path(output_folder) / 'windows.json', mode='w') as file:
+        json.dump(header, file, indent=4)
+
+
 
-def get_normalized_array(dataset, flip=False):
+def get_native_array(dataset):
+    """Get the pixel values as stored in the DICOM (e.g. int16), and the parameters to normalize them later
+    @params:
+        dataset   - Required : FileDataset (Pydicom) corresponding to one specific slice
+    Returns:
+        - NumPy array of the stored values
+        - Dictionary {'slope', 'intercept', 'window_center', 'window_width'} (None if not in the dataset)
+    """
+    if ('PixelData' not in dataset):
+        raise TypeError("DICOM dataset does not have pixel data")
+
+    # First value of multi-valued attributes (several windows), as get_LUT_value()
+    def first_value(keyword):
+        value = dataset.get(keyword)
+        if isinstance(value, pydicom.multival.MultiValue):
+            value = value[0]
+        return None if value is None else float(value)
+
+    normalization = {
+        'slope': first_value('RescaleSlope'),
+        'intercept': first_value('RescaleIntercept'),
+        'window_center': first_value('WindowCenter'),
+        'window_width': first_value('WindowWidth'),
+    }
+    return dataset.pixel_array, normalization
+
+
+
+def get_normalized_array(dataset, flip=False, windows=None):
     """Get normalized NumPy array from DICOM file
     @params:
         dataset   - Required : FileDataset (Pydicom) corresponding to one specific slice
+        windows   - Optional : None (default) for a (H, W) array using the first DICOM window,
+                               else windows to apply, to get a (C, H, W) array (see get_windows())
     """
+    if windows is not None:
+        image_array = get_multi_window_array(dataset, windows)
+        if flip:
+            image_array = 255 - image_array
+        return image_array
+
     # dataset without pixels
     if ('PixelData' not in dataset):
         raise TypeError("DICOM dataset does not have pixel data")
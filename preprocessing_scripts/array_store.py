@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+from pathlib import Path
+
+import checkpoint
+
+
+"""
+Description: module shared by the preprocessing scripts, to choose how the output arrays are stored.
+Two backends are available:
+    - 'npy'     (default) : one .npy file per array, in the folders of each script (written atomically)
+    - 'shards'            : arrays appended into fixed-size shard files, in output_folder/shards, with an index
+                            (key -> shard, offset, shape, dtype). Shards are memory-mapped by ShardReader,
+                            which gives random access by key. Millions of small files become a few big ones.
+The key of an array is its path relative to the output folder with the 'npy' backend
+(e.g. 'HGG/t1/with_mask/BraTS19_X_slice_80_t1.npy'), so both layouts can be read the same way.
+
+Each process has its own shards and index file, so parallel workers never write in the same file
+(the threads of a process share its writer, which is protected by a lock).
+Index entries are buffered, and written by commit() at the end of each work unit: the arrays of a unit
+interrupted before commit() are ignored, as the unit is processed again when the run is resumed.
+"""
+
+SHARDS_FOLDER_NAME = 'shards'
+# Default maximal size of a shard file (bytes)
+SHARD_SIZE = 1024 ** 3
+# Arrays are aligned in the shards, for faster memory-mapped access
+ALIGNMENT = 64
+
+
+class ShardWriter:
+    """Append arrays into the shard files of this process, and record them in its index file"""
+
+    def __init__(self, folder, shard_size=SHARD_SIZE):
+        """
+        @params:
+            folder       - Required : Path to the shards folder
+            shard_size   - Optional : a new shard file is started when the current one is bigger than this size (bytes)
+        """
+        self.folder = Path(folder)
+        Path.mkdir(self.folder, parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        # Files of this process, the pid can be reused by a later run: files are only appended
+        self.prefix = f"{os.getpid()}"
+        self.index_path = self.folder / f"index-{self.prefix}.jsonl"
+        self.shard_number = 0
+        self.shard_file = None
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def _shard_name(self):
+        return f"shard-{self.prefix}-{self.shard_number:05d}.bin"
+
+    def _open_shard(self):
+        """Open the first shard of this process that is not full, in append mode"""
+        while (self.folder / self._shard_name()).exists() and \
+              (self.folder / self._shard_name()).stat().st_size >= self.shard_size:
+            self.shard_number += 1
+        self.shard_file = open(self.folder / self._shard_name(), mode='ab')
+
+    def append(self, key, array):
+        """Append one array to the current shard
+        @params:
+            key     - Required : unique string identifying the array
+            array   - Required : array to store (C order copy if needed)
+        """
+        array = np.ascontiguousarray(array)
+        with self.lock:
+            self._append(key, array)
+
+    def _append(self, key, array):
+        if self.shard_file is None:
+            self._open_shard()
+        elif self.shard_file.tell() >= self.shard_size:
+            self.shard_file.close()
+            self.shard_number += 1
+            self._open_shard()
+
+        # Padding, so that the array starts on an aligned offset
+        offset = self.shard_file.tell()
+        padding = -offset % ALIGNMENT
+        self.shard_file.write(b'\0' * padding)
+        offset += padding
+        self.shard_file.write(array.tobytes())
+
+        self.pending.append({
+            'key': key,
+            'shard': self._shard_name(),
+            'offset': offset,
+            'shape': list(array.shape),
+            'dtype': array.dtype.str,
+            # The most recent entry of a key wins when the indexes are merged
+            'time': time.time_ns(),
+        })
+
+    def commit(self):
+        """Write the data and the pending index entries on disk"""
+        with self.lock:
+            self._commit()
+
+    def _commit(self):
+        if self.shard_file is not None:
+            self.shard_file.flush()
+            os.fsync(self.shard_file.fileno())
+        if len(self.pending) == 0:
+            return
+        with open(self.index_path, mode='a') as file:
+            file.write(''.join(json.dumps(entry) + '\n' for entry in self.pending))
+            file.flush()
+            os.fsync(file.fileno())
+        self.pending = []
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            if self.shard_file is not None:
+                self.shard_file.close()
+                self.shard_file = None
+
+
+
+class ShardReader:
+    """Random access by key to the arrays stored in shards (memory-mapped, read-only)"""
+
+    def __init__(self, output_folder):
+        """
+        @params:
+            output_folder   - Required : Path to the output folder (containing the 'shards' folder)
+        """
+        self.folder = Path(output_folder) / SHARDS_FOLDER_NAME
+        self.index = load_index(self.folder)
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def __getitem__(self, key):
+        """Get the array of the given key, as a read-only view on the memory-mapped shard"""
+        entry = self.index[key]
+        if entry['shard'] not in self.maps:
+            self.maps[entry['shard']] = np.memmap(self.folder / entry['shard'], dtype=np.uint8, mode='r')
+        shard = self.maps[entry['shard']]
+        dtype = np.dtype(entry['dtype'])
+        size = int(np.prod(entry['shape'], dtype=np.int64)) * dtype.itemsize
+        return shard[entry['offset']:entry['offset'] + size].view(dtype).reshape(entry['shape'])
+
+
+
+def load_index(shards_folder):
+    """Merge the index files of all the processes
+    @params:
+        shards_folder   - Required : Path to the shards folder
+    Returns:
+        - Dictionary {key: index entry}, sorted by key
+    """
+    index = {}
+    for index_path in sorted(Path(shards_folder).glob("index-*.jsonl")):
+        with open(index_path, mode='r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry['key'] not in index or index[entry['key']]['time'] < entry['time']:
+                    index[entry['key']] = entry
+    return dict(sorted(index.items()))
+
+
+
+# Writer of this process, for each output folder
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_writer(output_folder):
+    """Get the shard writer of this process for the given output folder"""
+    output_folder = Path(output_folder)
+    with _writers_lock:
+        if output_folder not in _writers:
+            _writers[output_folder] = ShardWriter(output_folder / SHARDS_FOLDER_NAME)
+        return _writers[output_folder]
+
+
+
+def save_array(output_folder, path, array, backend='npy'):
+    """Save an array with the given backend
+    @params:
+        output_folder   - Required : Path to the output folder
+        path            - Required : destination path of the .npy file ('.npy' is appended if needed, as np.save() does)
+        array           - Required : array to save
+        backend         - Optional : 'npy' or 'shards'
+    Returns:
+        - Key of the array: path relative to the output folder (string)
+    """
+    if backend == 'npy':
+        return checkpoint.save_array(output_folder, path, np.asarray(array))
+    elif backend == 'shards':
+        path = Path(path)
+        if path.suffix != '.npy':
+            path = path.with_name(path.name + '.npy')
+        key = os.path.relpath(path, output_folder)
+        get_writer(output_folder).append(key, np.asarray(array))
+        return key
+    else:
+        raise ValueError(f"Unknown output backend {backend}")
+
+
+
+def commit(output_folder, backend='npy'):
+    """Write on disk the arrays saved by this process (to call at the end of each work unit)
+    @params:
+        output_folder   - Required : Path to the output folder
+        backend         - Optional : 'npy' or 'shards'
+    """
+    if backend == 'shards':
+        get_writer(output_folder).commit()
+
+
+
+def count_arrays(output_folder, folder, backend='npy'):
+    """Count the arrays saved in the given folder (for the sanity checks of the scripts)
+    @params:
+        output_folder   - Required : Path to the output folder
+        folder          - Required : Path to the folder, in the output folder
+        backend         - Optional : 'npy' or 'shards'
+    """
+    if backend == 'npy':
+        return len(list(Path.iterdir(Path(folder))))
+    prefix = os.path.relpath(folder, output_folder) + os.sep
+    return sum(1 for key in load_index(Path(output_folder) / SHARDS_FOLDER_NAME) if key.startswith(prefix))
@@ -0,0 +1,166 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from dataset_reader import PreprocessedDataset
+
+
+"""
+Description: module shared by the preprocessing scripts, to feed their outputs to a training loop (any framework).
+The samples of a batch are copied by a pool of threads directly into preallocated contiguous (N, C, H, W) image
+and mask buffers, and the next batches are read while the current one is used.
+The batches are views on buffers reused by the next batches: a batch is valid until the next one is requested
+(copy it, e.g. with torch.from_numpy(batch).to(device) or np.array(batch), to keep it longer).
+
+Shapes: a (H, W) image has one channel, a (C, H, W) image (BraTS2019 stacked) C channels. Each image has one mask
+(an image without mask gets an empty mask), of the level chosen with mask_level (LIDC-IDRI consensus levels,
+see dataset_reader). An image with several masks (several lesions in BUSI) raises an error, unless merge_masks
+merges them in one mask (maximum). All the samples must have the same shape.
+"""
+
+# Default number of batches read in advance
+PREFETCH = 2
+# Default number of threads
+WORKERS = 4
+
+
+class BatchLoader:
+    """Iterator over the (images, masks) batches of an output folder"""
+
+    def __init__(self, dataset, batch_size, prefetch=PREFETCH, workers=WORKERS, shuffle=False, seed=0,
+                 rank=0, world_size=1, drop_last=False, mask_level=None, merge_masks=False):
+        """
+        @params:
+            dataset      - Required : PreprocessedDataset, or Path to an output folder
+            batch_size   - Required : number of samples N of each batch
+            prefetch     - Optional : number of batches K read in advance
+            workers      - Optional : number of threads reading the samples
+            shuffle      - Optional : shuffle the samples at each epoch
+            seed         - Optional : seed of the shuffling, the order of an epoch depends on seed + epoch (the same for all the ranks)
+            rank         - Optional : rank of this process, which reads the samples rank, rank + world_size, ...
+            world_size   - Optional : number of processes (the samples that do not fill a round are dropped,
+                                      so that all the ranks have the same number of batches)
+            drop_last    - Optional : drop the last batch if it is not full
+            mask_level   - Optional : level of the masks (see PreprocessedDataset), None if there is only one
+            merge_masks  - Optional : merge the masks of an image that has several ones (union), instead of raising an error
+        """
+        if not isinstance(dataset, PreprocessedDataset):
+            # The loader copies every sample, no need to keep them in the cache of the dataset
+            dataset = PreprocessedDataset(dataset, cache_size=0, mask_level=mask_level)
+        elif mask_level is not None and mask_level != dataset.mask_level:
+            raise ValueError(f"Mask level {mask_level} differs from the level {dataset.mask_level} of the dataset")
+        if not 0 <= rank < world_size:
+            raise ValueError(f"Rank {rank} not in [0, {world_size})")
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.prefetch = max(prefetch, 1)
+        self.workers = workers
+        self.shuffle = shuffle
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.merge_masks = merge_masks
+        self.epoch = 0
+        # Image and mask buffers, allocated with the shapes and dtypes of the first sample
+        self.buffers = None
+
+
+    def set_epoch(self, epoch):
+        """Set the epoch of the next iteration (the shuffling order), e.g. when a training is resumed"""
+        self.epoch = epoch
+
+
+    def indices(self, epoch=None):
+        """Get the indices of the samples of this rank, in the order of the given epoch (default: the next one)"""
+        epoch = self.epoch if epoch is None else epoch
+        indices = np.arange(len(self.dataset))
+        if self.shuffle:
+            indices = np.random.default_rng(self.seed + epoch).permutation(indices)
+        # Same number of samples for all the ranks
+        indices = indices[:len(indices) - len(indices) % self.world_size]
+        return indices[self.rank::self.world_size]
+
+
+    def __len__(self):
+        """Number of batches of one epoch"""
+        nsamples = len(self.indices())
+        if self.drop_last:
+            return nsamples // self.batch_size
+        return -(-nsamples // self.batch_size)
+
+
+    def _allocate(self):
+        """Allocate the buffers of the current batch and of the prefetched ones"""
+        image, masks = self.dataset[0]
+        image_shape = image.shape if image.ndim == 3 else (1,) + image.shape
+        # Dtype of the saved masks (float64 if saved by a previous version), uint8 if there is none
+        mask_dtype = masks[0].dtype if len(masks) > 0 else np.uint8
+        mask_channels = masks[0].shape[0] if len(masks) > 0 and masks[0].ndim == 3 else 1
+        self.image_shape = image_shape
+        self.mask_shape = (mask_channels,) + image_shape[-2:]
+        self.buffers = [(np.empty((self.batch_size,) + self.image_shape, dtype=image.dtype),
+                         np.empty((self.batch_size,) + self.mask_shape, dtype=mask_dtype))
+                        for _ in range(self.prefetch + 1)]
+
+
+    def _read_sample(self, index, images, masks, position):
+        """Copy one sample in the position of the given buffers"""
+        image, sample_masks = self.dataset[index]
+        if image.size != np.prod(self.image_shape):
+            raise ValueError(f"Shape {image.shape} of {self.dataset.pairs[index][0]} differs from the first sample {self.image_shape}")
+        np.copyto(images[position], image.reshape(self.image_shape), casting='unsafe')
+        if len(sample_masks) == 0:
+            masks[position] = 0
+            return
+        if len(sample_masks) > 1 and not self.merge_masks:
+            raise ValueError(f"{self.dataset.pairs[index][0]} has {len(sample_masks)} masks, "
+                             f"set merge_masks to merge them in one mask")
+        np.copyto(masks[position], sample_masks[0].reshape(self.mask_shape), casting='unsafe')
+        for mask in sample_masks[1:]:
+            np.maximum(masks[position], mask.reshape(self.mask_shape), out=masks[position], casting='unsafe')
+
+
+    def __iter__(self):
+        """Iterate over the batches of one epoch
+        Yields:
+            - (n, C, H, W) image array (n = batch_size, except for the last batch)
+            - (n, C, H, W) mask array
+        """
+        indices = self.indices()
+        self.epoch += 1
+        nbatches = len(indices) // self.batch_size if self.drop_last else -(-len(indices) // self.batch_size)
+        if nbatches == 0:
+            return
+        if self.buffers is None:
+            self._allocate()
+
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        # Dictionary {batch: futures of its samples}
+        pending = {}
+
+        def submit(batch):
+            # Batch b uses the buffers b % (prefetch + 1): the buffers of the batch given to the caller
+            # are only reused for the batch b + prefetch + 1, submitted when the caller asks for the next batch
+            images, masks = self.buffers[batch % len(self.buffers)]
+            batch_indices = indices[batch * self.batch_size:(batch + 1) * self.batch_size]
+            pending[batch] = [pool.submit(self._read_sample, index, images, masks, position)
+                              for position, index in enumerate(batch_indices)]
+
+        try:
+            for batch in range(min(self.prefetch, nbatches)):
+                submit(batch)
+            for batch in range(nbatches):
+                if batch + self.prefetch < nbatches:
+                    submit(batch + self.prefetch)
+                futures = pending.pop(batch)
+                for future in futures:
+                    # Raises the errors of the threads
+                    future.result()
+                images, masks = self.buffers[batch % len(self.buffers)]
+                yield images[:len(futures)], masks[:len(futures)]
+        finally:
+            # Loop stopped early: the batches read in advance are not needed
+            for futures in pending.values():
+                for future in futures:
+                    future.cancel()
+            pool.shutdown(wait=True)
@@ -0,0 +1,168 @@
+import os
+import json
+import shutil
+import numpy as np
+from pathlib import Path
+
+import parallel_driver
+
+
+"""
+Description: module shared by the preprocessing scripts, to resume an interrupted run.
+A manifest in the output folder records each completed work unit (patient or series), with the parameters
+it ran with, the files it produced and its results (counters, errors). The output files are written atomically
+(temporary file, then rename), so a file in the output folders is always complete.
+A re-run skips the units completed with the same parameters, and redoes the other ones.
+"""
+
+MANIFEST_NAME = 'manifest.jsonl'
+PARTIAL_FOLDER_NAME = '.partial'
+
+
+def _normalize(parameters):
+    """JSON round trip, so that parameters compare equal to the ones loaded from the manifest (tuples -> lists...)"""
+    return json.loads(json.dumps(parameters, default=str))
+
+
+
+def load_manifest(output_folder):
+    """Load the completed work units of the previous runs
+    @params:
+        output_folder   - Required : Path to the output folder
+    Returns:
+        - Dictionary {unit key: record}, the last record of a unit wins
+    """
+    manifest = {}
+    manifest_path = Path(output_folder) / MANIFEST_NAME
+    if not manifest_path.exists():
+        return manifest
+
+    with open(manifest_path, mode='r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line only partially written when the run died
+                continue
+            manifest[record['unit']] = record
+    return manifest
+
+
+
+def _terminate_last_line(output_folder):
+    """End the manifest with a new line, if its last record was only partially written when the run died
+    (otherwise the next record would be appended to the partial one)"""
+    manifest_path = Path(output_folder) / MANIFEST_NAME
+    if not manifest_path.exists() or manifest_path.stat().st_size == 0:
+        return
+    with open(manifest_path, mode='rb+') as file:
+        file.seek(-1, os.SEEK_END)
+        if file.read(1) != b'\n':
+            file.write(b'\n')
+
+
+
+def is_completed(manifest, unit_key, parameters):
+    """Check if the work unit was completed by a previous run with the same parameters
+    @params:
+        manifest     - Required : dictionary returned by load_manifest()
+        unit_key     - Required : unique string identifying the work unit
+        parameters   - Required : dictionary of the parameters of this run
+    """
+    record = manifest.get(unit_key)
+    return record is not None and record['parameters'] == _normalize(parameters)
+
+
+
+def record_unit(output_folder, unit_key, parameters, result):
+    """Append a completed work unit to the manifest (called in the main process only)
+    @params:
+        output_folder   - Required : Path to the output folder
+        unit_key        - Required : unique string identifying the work unit
+        parameters      - Required : dictionary of the parameters of this run
+        result          - Required : dictionary returned by the work function, the 'files' list is the produced files
+    """
+    results = {key: value for key, value in result.items() if key != 'files'}
+    record = {
+        'unit': unit_key,
+        'parameters': parameters,
+        'files': result.get('files', []),
+        'results': results,
+    }
+    with open(Path(output_folder) / MANIFEST_NAME, mode='a') as file:
+        file.write(json.dumps(record, default=str) + '\n')
+        # The unit is completed only once its record is on disk
+        file.flush()
+        os.fsync(file.fileno())
+
+
+
+def clean_partial_files(output_folder):
+    """Remove the temporary files left by an interrupted run
+    @params:
+        output_folder   - Required : Path to the output folder
+    """
+    shutil.rmtree(Path(output_folder) / PARTIAL_FOLDER_NAME, ignore_errors=True)
+
+
+
+def save_array(output_folder, path, array):
+    """Save a numpy array atomically: written in a temporary file, then renamed to its final path
+    @params:
+        output_folder   - Required : Path to the output folder (the temporary files are in its '.partial' folder)
+        path            - Required : destination path, '.npy' is appended if needed (as np.save() does)
+        array           - Required : array to save
+    Returns:
+        - Destination path, relative to the output folder (string)
+    """
+    path = Path(path)
+    if path.suffix != '.npy':
+        path = path.with_name(path.name + '.npy')
+
+    # The temporary folder is in the output folder, so it is on the same file system (rename is atomic)
+    partial_folder = Path(output_folder) / PARTIAL_FOLDER_NAME
+    Path.mkdir(partial_folder, exist_ok=True)
+    temporary_path = partial_folder / f"{os.getpid()}_{path.name}"
+
+    with open(temporary_path, mode='wb') as file:
+        np.save(file, array)
+    os.replace(temporary_path, path)
+
+    return os.path.relpath(path, output_folder)
+
+
+
+def run(work_function, work_units, unit_key, parameters, output_folder, workers=None, resume=True, on_result=None):
+    """Run the work units with parallel_driver.run(), skipping the ones completed by a previous run
+    @params:
+        work_function   - Required : function taking one work unit (see parallel_driver.run())
+        work_units      - Required : iterable of work units
+        unit_key        - Required : function returning the unique string identifying a work unit
+        parameters      - Required : dictionary of the parameters of this run (JSON serializable)
+        output_folder   - Required : Path to the output folder
+        workers         - Optional : number of worker processes, None uses all the CPUs
+        resume          - Optional : skip the completed work units (False redoes everything)
+        on_result       - Optional : function on_result(work_unit, result) called for each processed work unit,
+                                     after it is recorded in the manifest (not called for the skipped units)
+    Returns:
+        - List of the results in the order of the work units, the results of the skipped units come from the manifest
+    """
+    work_units = list(work_units)
+    manifest = load_manifest(output_folder) if resume else {}
+    _terminate_last_line(output_folder)
+    clean_partial_files(output_folder)
+
+    keys = [unit_key(work_unit) for work_unit in work_units]
+    todo = [work_unit for work_unit, key in zip(work_units, keys) if not is_completed(manifest, key, parameters)]
+    print(f"\n{len(work_units) - len(todo)} work units already completed, {len(todo)} to process\n", flush=True)
+
+    # Each unit is recorded as soon as it is completed
+    def record(work_unit, result):
+        record_unit(output_folder, unit_key(work_unit), parameters, result)
+        if on_result is not None:
+            on_result(work_unit, result)
+    new_results = parallel_driver.run(work_function, todo, workers, on_result=record)
+    new_results = dict(zip(map(unit_key, todo), new_results))
+    clean_partial_files(output_folder)
+
+    return [new_results[key] if key in new_results else manifest[key]['results'] for key in keys]
@@ -0,0 +1,301 @@
+import os
+import json
+import threading
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+
+import array_store
+import dtype_policy
+
+
+"""
+Description: module shared by the preprocessing scripts, to read their outputs for training.
+The output folder is indexed once into a pairing table (image key -> mask keys), saved in 'pairs.json'
+in the output folder, so the next readers neither walk the folders nor pair the file names again.
+The arrays are loaded through memory maps ('npy' files or shards, see array_store), and the recently used
+samples are kept in memory (copies of the arrays, with the packed masks unpacked) in a cache bounded in bytes
+(least recently used samples are dropped first). Without cache, the samples are the memory maps themselves,
+and the page cache of the system keeps the recently read files.
+
+Pairing: the masks are the arrays whose file name contains '_mask'. A mask belongs to the folder containing
+its masks folder ('masks' or 'mask'), or to its own folder if it is next to the images. An image is paired with
+the masks of the same stem belonging to its folder, or else to the nearest of its parent folders:
+    - BUSI                  : img/benign12.npy              -> masks/benign12_mask0.npy, masks/benign12_mask1.npy
+    - BUSI (Jonas)          : benign/benign12.npy           -> benign/benign12_mask0.npy
+    - LIDC-IDRI, Head-Neck  : segmentation/img/X.npy        -> segmentation/masks/X_mask.npy
+    - LIDC-IDRI consensus   : segmentation/img/X.npy        -> segmentation/masks/<level>/X_mask.npy
+    - BraTS2019             : HGG/t1/with_mask/P_slice_80_t1.npy, HGG/stacked/with_mask/P_slice_80.npy
+                                                            -> HGG/mask/P_slice_80_mask.npy
+The masks of an image are grouped by level: the sub-folder of the masks folder (consensus level), DEFAULT_LEVEL
+for the others. Images without mask (LIDC-IDRI localization, BraTS2019 empty_mask) have no masks.
+"""
+
+PAIRS_NAME = 'pairs.json'
+# Version of the pairing table, the tables of the previous versions are built again
+PAIRS_VERSION = 2
+# Scale factors written by convert_to_0_1.py, in the folder it converted
+SCALES_NAME = 'convert_to_0_1.json'
+# Names of the folders of the masks, next to the folders of the images (img/ and masks/, HGG/t1/ and HGG/mask/)
+MASKS_FOLDERS = {'masks', 'mask'}
+# Level of the masks that are not in a sub-folder of a masks folder
+DEFAULT_LEVEL = 'default'
+# Default size of the cache (bytes)
+CACHE_SIZE = 256 * 1024 ** 2
+# Folders of the output folder that never contain images or masks
+IGNORED_FOLDERS = {'.partial', 'segmentationMasksLogs', 'index', array_store.SHARDS_FOLDER_NAME}
+
+
+def list_keys(output_folder):
+    """List the keys of all the arrays of an output folder, in one pass
+    @params:
+        output_folder   - Required : Path to the output folder
+    Returns:
+        - Sorted list of the keys (paths relative to the output folder), and the backend ('npy' or 'shards')
+    """
+    output_folder = Path(output_folder)
+    shards_folder = output_folder / array_store.SHARDS_FOLDER_NAME
+    if shards_folder.exists():
+        return list(array_store.load_index(shards_folder).keys()), 'shards'
+
+    keys = []
+    # scandir() returns the file types with the names, without a stat() per file
+    folders = [output_folder]
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in IGNORED_FOLDERS:
+                        folders.append(entry.path)
+                elif entry.name.endswith('.npy'):
+                    keys.append(os.path.relpath(entry.path, output_folder))
+    return sorted(keys), 'npy'
+
+
+
+def mask_owner(key):
+    """Get the folder a mask belongs to
+    @params:
+        key   - Required : key of a mask
+    Returns:
+        - Folder (relative to the output folder) whose images, or the images of its sub-folders, can be paired with it
+        - Level of the mask
+        - Stem of the mask, 'X_mask0.npy' and 'X_mask.npy' have the stem 'X'
+    """
+    folder, name = os.path.split(key)
+    stem = name[:name.index('_mask')]
+    parent, folder_name = os.path.split(folder)
+    if folder_name in MASKS_FOLDERS:
+        return parent, DEFAULT_LEVEL, stem
+    grandparent, parent_name = os.path.split(parent)
+    if parent_name in MASKS_FOLDERS:
+        return grandparent, folder_name, stem
+    # Masks next to their images
+    return folder, DEFAULT_LEVEL, stem
+
+
+
+def pair_keys(keys):
+    """Pair each image with its masks
+    @params:
+        keys   - Required : keys of the arrays of an output folder
+    Returns:
+        - List of [image key, {level: list of mask keys}], sorted by image key (the masks are sorted by key)
+    """
+    # Dictionary {(folder, stem): {level: list of mask keys}}
+    masks = {}
+    images = []
+    for key in keys:
+        if '_mask' in os.path.basename(key):
+            folder, level, stem = mask_owner(key)
+            masks.setdefault((folder, stem), {}).setdefault(level, []).append(key)
+        else:
+            images.append(key)
+
+    pairs = []
+    for key in sorted(images):
+        folder, name = os.path.split(key)
+        stem = name[:-len('.npy')]
+        # One file per modality (BraTS2019): 'P_slice_80_t1' -> 'P_slice_80'
+        stems = [stem, stem.rsplit('_', 1)[0]] if '_' in stem else [stem]
+        # Masks of the folder of the image, or else of the nearest parent folder
+        while True:
+            image_masks = next((masks[(folder, candidate)] for candidate in stems if (folder, candidate) in masks), {})
+            if len(image_masks) > 0 or folder == '':
+                break
+            folder = os.path.dirname(folder)
+        pairs.append([key, {level: sorted(level_keys) for level, level_keys in sorted(image_masks.items())}])
+    return pairs
+
+
+
+def build_pairs(output_folder):
+    """Index an output folder, and save its pairing table in 'pairs.json'
+    @params:
+        output_folder   - Required : Path to the output folder
+    Returns:
+        - Dictionary {'version', 'backend', 'pairs'}, as saved
+    """
+    keys, backend = list_keys(output_folder)
+    table = {'version': PAIRS_VERSION, 'backend': backend, 'pairs': pair_keys(keys)}
+    # Written atomically, a reader never sees a partial table
+    temporary_path = Path(output_folder) / f"{PAIRS_NAME}.{os.getpid()}.tmp"
+    with open(temporary_path, mode='w') as file:
+        json.dump(table, file)
+    os.replace(temporary_path, Path(output_folder) / PAIRS_NAME)
+    return table
+
+
+
+def load_pairs(output_folder, rebuild=False):
+    """Load the pairing table of an output folder, built (and saved) if there is none
+    @params:
+        output_folder   - Required : Path to the output folder
+        rebuild         - Optional : index the output folder again (after a new run of a script)
+    """
+    pairs_path = Path(output_folder) / PAIRS_NAME
+    if rebuild or not pairs_path.exists():
+        return build_pairs(output_folder)
+    with open(pairs_path, mode='r') as file:
+        table = json.load(file)
+    if table.get('version') != PAIRS_VERSION:
+        return build_pairs(output_folder)
+    return table
+
+
+
+def load_scales(output_folder):
+    """Load the scale factors of the arrays kept as they are by convert_to_0_1.py (dtype 'keep')
+    The scales are in 'convert_to_0_1.json' in the folder converted by convert_to_0_1.py: the output folder,
+    or one of its parents (the nearest one is used)
+    @params:
+        output_folder   - Required : Path to the output folder
+    Returns:
+        - Dictionary {key: scale}, the keys are relative to the output folder
+    """
+    output_folder = Path(output_folder).resolve()
+    for folder in [output_folder, *output_folder.parents]:
+        scales_path = folder / SCALES_NAME
+        if not scales_path.exists():
+            continue
+        with open(scales_path, mode='r') as file:
+            scales = json.load(file)['scales']
+        # Paths relative to the converted folder, only the ones in the output folder are kept
+        prefix = os.path.relpath(output_folder, folder)
+        if prefix == '.':
+            return scales
+        return {os.path.relpath(path, prefix): scale for path, scale in scales.items()
+                if path.startswith(prefix + os.sep)}
+    return {}
+
+
+
+class PreprocessedDataset:
+    """Random access to the (image, masks) samples of an output folder"""
+
+    def __init__(self, output_folder, cache_size=CACHE_SIZE, rebuild=False, with_masks=True, mask_level=None):
+        """
+        @params:
+            output_folder   - Required : Path to the output folder of a preprocessing script
+            cache_size      - Optional : maximal size (bytes) of the cached samples (in memory), 0 disables the cache
+            rebuild         - Optional : index the output folder again, instead of loading 'pairs.json'
+            with_masks      - Optional : False also lists the images without masks (e.g. LIDC-IDRI localization)
+            mask_level      - Optional : level of the masks of the samples (see levels), e.g. a consensus level
+                                         of LIDC-IDRI, None if the output folder has only one level
+        """
+        self.output_folder = Path(output_folder)
+        table = load_pairs(self.output_folder, rebuild)
+        self.backend = table['backend']
+        # Levels of the masks of the output folder
+        self.levels = sorted({level for _image_key, masks in table['pairs'] for level in masks})
+        if mask_level is None:
+            if len(self.levels) > 1:
+                raise ValueError(f"Masks of several levels {self.levels} in {output_folder}, choose one with mask_level")
+            mask_level = self.levels[0] if len(self.levels) > 0 else DEFAULT_LEVEL
+        elif mask_level not in self.levels:
+            raise ValueError(f"No masks of level {mask_level} in {output_folder}, levels: {self.levels}")
+        self.mask_level = mask_level
+        # List of [image key, list of mask keys of the level]
+        self.pairs = [[image_key, masks.get(mask_level, [])] for image_key, masks in table['pairs']
+                      if mask_level in masks or not with_masks]
+        self.shards = array_store.ShardReader(self.output_folder) if self.backend == 'shards' else None
+
+        # Dtype policy (packed masks are unpacked), None for the outputs of the previous versions
+        self.header = dtype_policy.load_header(self.output_folder) or {}
+        # Scale factors of the arrays kept as they are by convert_to_0_1.py (dtype 'keep')
+        self.scales = load_scales(self.output_folder)
+
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        # The samples can be read by several threads (see batch loaders)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def keys(self):
+        """Keys of the images, in the order of the samples"""
+        return [image_key for image_key, _mask_keys in self.pairs]
+
+    def load(self, key):
+        """Load one array by key, memory-mapped (read-only)"""
+        if self.shards is not None:
+            array = self.shards[key]
+        else:
+            array = np.load(self.output_folder / key, mmap_mode='r')
+        if key in self.scales:
+            array = array * np.float32(self.scales[key])
+        return array
+
+    def load_mask(self, key, shape):
+        """Load one mask by key, unpacked to the (..., H, W) shape of its image if needed"""
+        mask = self.load(key)
+        mask_dtype = self.header.get('mask_dtype')
+        if mask_dtype == 'packbits':
+            mask = dtype_policy.decode_mask(mask, mask_dtype, shape, self.header.get('labels'))
+        return mask
+
+    def __getitem__(self, index):
+        """Get a sample
+        Returns:
+            - Image array
+            - List of its mask arrays (empty if it has none)
+        """
+        with self.lock:
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                return self.cache[index]
+
+        image_key, mask_keys = self.pairs[index]
+        image = self.load(image_key)
+        sample = (image, [self.load_mask(mask_key, image.shape[-2:]) for mask_key in mask_keys])
+        return self._cache(index, sample)
+
+    def _cache(self, index, sample):
+        """Keep a sample in the cache, dropping the least recently used ones when it is full
+        Returns:
+            - The sample, read in memory if it is cached (the cache keeps no memory map, nor its open file)
+        """
+        size = sample[0].nbytes + sum(mask.nbytes for mask in sample[1])
+        if size > self.cache_size:
+            return sample
+        sample = (_in_memory(sample[0]), [_in_memory(mask) for mask in sample[1]])
+        with self.lock:
+            if index in self.cache:
+                return self.cache[index]
+            self.cache[index] = sample
+            self.cached_bytes += size
+            while self.cached_bytes > self.cache_size:
+                _index, (image, masks) = self.cache.popitem(last=False)
+                self.cached_bytes -= image.nbytes + sum(mask.nbytes for mask in masks)
+        return sample
+
+
+
+def _in_memory(array):
+    """Read-only copy in memory of a memory-mapped array (arrays already in memory, e.g. unpacked masks, are not copied)"""
+    if not array.flags.owndata:
+        array = np.array(array)
+    array.flags.writeable = False
+    return array
@@ -0,0 +1,234 @@
+import json
+import numpy as np
+from pathlib import Path
+
+
+"""
+Description: module shared by the preprocessing scripts, to compute the statistics of a data set while it is written
+(no second pass over the output files).
+For each modality: count, mean and variance (Welford / Chan et al. update, one batch of pixels at a time), min, max,
+and a histogram with fixed bins. For the masks: number of pixels and of foreground pixels (per label if given).
+The statistics of the work units are JSON dictionaries (returned by the work functions, and recorded in the
+manifest by checkpoint), merged in the main process and saved in 'statistics.json' in the output folder.
+"""
+
+SUMMARY_NAME = 'statistics.json'
+BINS = 256
+
+
+class StreamingStats:
+    """Streaming statistics of the pixel values of one modality"""
+
+    def __init__(self, value_range=(0, 256), bins=BINS):
+        """
+        @params:
+            value_range   - Optional : (min, max) of the histogram bins, values outside are counted in underflow/overflow
+            bins          - Optional : number of bins of the histogram
+        """
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+        self.bins = bins
+        self.count = 0
+        self.mean = 0.0
+        # Sum of the squared differences to the mean
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+
+    def update(self, array):
+        """Add the values of an array (any shape), in one batch"""
+        values = np.asarray(array, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+        batch = StreamingStats(self.value_range, self.bins)
+        batch.count = values.size
+        batch.mean = float(values.mean())
+        batch.m2 = float(np.square(values - batch.mean).sum())
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+        batch.histogram = np.histogram(values, bins=self.bins, range=self.value_range)[0].astype(np.int64)
+        batch.underflow = int(np.count_nonzero(values < self.value_range[0]))
+        batch.overflow = int(np.count_nonzero(values > self.value_range[1]))
+        self.merge(batch)
+
+
+    def merge(self, other):
+        """Add the statistics of other values (e.g. computed by another worker), with the same bins"""
+        if other.count == 0:
+            return
+        if other.value_range != self.value_range or other.bins != self.bins:
+            raise ValueError(f"Histograms with different bins: {self.value_range} {self.bins}, {other.value_range} {other.bins}")
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.histogram += other.histogram
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+
+    def to_dict(self):
+        """JSON dictionary, with the derived variance and standard deviation (of all the values)"""
+        variance = self.m2 / self.count if self.count > 0 else None
+        return {
+            'count': self.count,
+            'mean': self.mean if self.count > 0 else None,
+            'variance': variance,
+            'std': float(np.sqrt(variance)) if variance is not None else None,
+            'm2': self.m2,
+            'min': self.min,
+            'max': self.max,
+            'value_range': list(self.value_range),
+            'bins': self.bins,
+            'histogram': self.histogram.tolist(),
+            'underflow': self.underflow,
+            'overflow': self.overflow,
+        }
+
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        """Get back the statistics saved with to_dict()"""
+        stats = cls(dictionary['value_range'], dictionary['bins'])
+        stats.count = dictionary['count']
+        stats.mean = dictionary['mean'] or 0.0
+        stats.m2 = dictionary['m2']
+        stats.min = dictionary['min']
+        stats.max = dictionary['max']
+        stats.histogram = np.array(dictionary['histogram'], dtype=np.int64)
+        stats.underflow = dictionary['underflow']
+        stats.overflow = dictionary['overflow']
+        return stats
+
+
+
+class DatasetStatistics:
+    """Statistics of the images (one StreamingStats per modality) and of the masks of a data set, or of a work unit"""
+
+    def __init__(self, value_range=(0, 256), bins=BINS):
+        """
+        @params:
+            value_range   - Optional : (min, max) of the histogram bins of the images
+            bins          - Optional : number of bins of the histograms
+        """
+        self.value_range = value_range
+        self.bins = bins
+        # Dictionary {modality: StreamingStats}
+        self.images = {}
+        self.mask_pixels = 0
+        self.foreground_pixels = 0
+        # Dictionary {label: number of pixels}
+        self.label_pixels = {}
+
+
+    def add_image(self, modality, array, channels=None):
+        """Add the values of an image (or of a batch of images) of the given modality
+        @params:
+            modality   - Required : modality of the image
+            array      - Required : NumPy array
+            channels   - Optional : names of the channels of a multi-channel image (axis -3), e.g. its DICOM windows,
+                                    each channel is added separately to the modality '<modality>_<name>'
+        """
+        if channels is not None:
+            for index, name in enumerate(channels):
+                self.add_image(f"{modality}_{name}", array[..., index, :, :])
+            return
+        if modality not in self.images:
+            self.images[modality] = StreamingStats(self.value_range, self.bins)
+        self.images[modality].update(array)
+
+
+    def add_mask(self, mask, labels=None):
+        """Add a mask (or a batch of masks), 0 is the background
+        @params:
+            mask     - Required : NumPy array of the labels (before dtype_policy.encode_mask())
+            labels   - Optional : labels whose pixels are also counted separately
+        """
+        mask = np.asarray(mask)
+        self.mask_pixels += int(mask.size)
+        self.foreground_pixels += int(np.count_nonzero(mask))
+        if labels is not None:
+            counts = np.bincount(mask.ravel(), minlength=max(labels) + 1)
+            for label in labels:
+                self.label_pixels[str(label)] = self.label_pixels.get(str(label), 0) + int(counts[label])
+
+
+    def merge(self, other):
+        """Add the statistics of another work unit"""
+        for modality, stats in other.images.items():
+            if modality not in self.images:
+                self.images[modality] = StreamingStats(stats.value_range, stats.bins)
+            self.images[modality].merge(stats)
+        self.mask_pixels += other.mask_pixels
+        self.foreground_pixels += other.foreground_pixels
+        for label, count in other.label_pixels.items():
+            self.label_pixels[label] = self.label_pixels.get(label, 0) + count
+
+
+    def to_dict(self):
+        """JSON dictionary, returned by the work functions"""
+        return {
+            'images': {modality: stats.to_dict() for modality, stats in self.images.items()},
+            'masks': {
+                'pixels': self.mask_pixels,
+                'foreground': self.foreground_pixels,
+                'foreground_ratio': self.foreground_pixels / self.mask_pixels if self.mask_pixels > 0 else None,
+                'labels': self.label_pixels,
+            },
+        }
+
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        """Get back the statistics saved with to_dict()"""
+        statistics = cls()
+        statistics.images = {modality: StreamingStats.from_dict(stats) for modality, stats in dictionary['images'].items()}
+        statistics.mask_pixels = dictionary['masks']['pixels']
+        statistics.foreground_pixels = dictionary['masks']['foreground']
+        statistics.label_pixels = dict(dictionary['masks']['labels'])
+        return statistics
+
+
+
+def merge(statistics):
+    """Merge the statistics of the work units, in their order
+    @params:
+        statistics   - Required : list of DatasetStatistics, or of their to_dict() dictionaries
+    Returns:
+        - DatasetStatistics of all the work units
+    """
+    merged = DatasetStatistics()
+    for unit_statistics in statistics:
+        if isinstance(unit_statistics, dict):
+            unit_statistics = DatasetStatistics.from_dict(unit_statistics)
+        merged.merge(unit_statistics)
+    return merged
+
+
+
+def save_summary(output_folder, statistics, **metadata):
+    """Save the statistics in 'statistics.json' in the output folder
+    @params:
+        output_folder   - Required : Path to the output folder
+        statistics      - Required : DatasetStatistics (see merge())
+        metadata        - Optional : other entries (dtype of the saved values...)
+    """
+    summary = {**metadata, **statistics.to_dict()}
+    with open(Path(output_folder) / SUMMARY_NAME, mode='w') as file:
+        json.dump(summary, file, indent=4, default=str)
+
+
+
+def load_summary(output_folder):
+    """Load 'statistics.json' from the output folder, None if there is none"""
+    summary_path = Path(output_folder) / SUMMARY_NAME
+    if not summary_path.exists():
+        return None
+    with open(summary_path, mode='r') as file:
+        return json.load(file)
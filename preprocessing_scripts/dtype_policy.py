@@ -0,0 +1,121 @@
+import json
+import numpy as np
+from pathlib import Path
+
+
+"""
+Description: module shared by the preprocessing scripts, to choose the dtype of the saved images and masks.
+Images:
+    - 'uint8'     : windowed images, 0-255 (DICOM datasets, BUSI)
+    - 'native'    : values as stored in the data set (e.g. int16), the parameters to normalize them are in the header
+    - 'float32'   : float values (e.g. BraTS2019 intensities)
+    - 'float64'   : float values, as saved by the previous versions of the scripts
+Masks:
+    - 'uint8'     : label maps (0/1, or the labels of the data set)
+    - 'bool'      : binary masks
+    - 'packbits'  : binary masks packed along the last axis with np.packbits(), 8 pixels per byte.
+                    Label maps are packed as one binary plane per label (see decode_mask())
+    - 'float64'   : as saved by the previous versions of the scripts
+The header 'dtypes.json' in the output folder records the policy and the normalization parameters.
+"""
+
+HEADER_NAME = 'dtypes.json'
+IMAGE_DTYPES = ['uint8', 'native', 'float32', 'float64']
+MASK_DTYPES = ['uint8', 'bool', 'packbits', 'float64']
+
+
+def check_policy(image_dtype, mask_dtype, image_dtypes=IMAGE_DTYPES):
+    """Check the dtypes given in the arguments of a script
+    @params:
+        image_dtype    - Required : dtype of the images, one of image_dtypes
+        mask_dtype     - Required : dtype of the masks, one of MASK_DTYPES
+        image_dtypes   - Optional : image dtypes supported by the script
+    """
+    if image_dtype not in image_dtypes:
+        raise ValueError(f"Unknown image dtype {image_dtype}, expected one of {image_dtypes}")
+    if mask_dtype not in MASK_DTYPES:
+        raise ValueError(f"Unknown mask dtype {mask_dtype}, expected one of {MASK_DTYPES}")
+
+
+
+def cast_image(image, image_dtype):
+    """Convert an image to the float dtypes of the policy ('uint8' and 'native' images are kept as they are)
+    @params:
+        image         - Required : NumPy array
+        image_dtype   - Required : one of IMAGE_DTYPES
+    """
+    if image_dtype in ['float32', 'float64']:
+        return np.asarray(image).astype(image_dtype, copy=False)
+    return np.asarray(image)
+
+
+
+def encode_mask(mask, mask_dtype, labels=None):
+    """Convert a mask to the dtype of the policy
+    @params:
+        mask         - Required : NumPy array, 0 is the background
+        mask_dtype   - Required : one of MASK_DTYPES
+        labels       - Optional : labels of a label map, packed as one plane per label with 'packbits'
+                                  (None for binary masks, all non-zero pixels are foreground)
+    """
+    mask = np.asarray(mask)
+    if mask_dtype == 'uint8':
+        return mask.astype(np.uint8, copy=False)
+    elif mask_dtype == 'bool':
+        return mask > 0
+    elif mask_dtype == 'packbits':
+        if labels is None:
+            return np.packbits(mask > 0, axis=-1)
+        return np.packbits(np.stack([mask == label for label in labels]), axis=-1)
+    elif mask_dtype == 'float64':
+        return mask.astype(np.float64, copy=False)
+    else:
+        raise ValueError(f"Unknown mask dtype {mask_dtype}")
+
+
+
+def decode_mask(mask, mask_dtype, shape, labels=None):
+    """Get the (H, W) mask saved with encode_mask()
+    @params:
+        mask         - Required : NumPy array loaded from the output folder
+        mask_dtype   - Required : one of MASK_DTYPES ('mask_dtype' in the header)
+        shape        - Required : (H, W) shape of the mask (the shape of its image)
+        labels       - Optional : labels given to encode_mask() ('labels' in the header)
+    """
+    if mask_dtype != 'packbits':
+        return np.asarray(mask)
+    planes = np.unpackbits(mask, axis=-1, count=shape[-1]).astype(bool)
+    if labels is None:
+        return planes.astype(np.uint8)
+    label_map = np.zeros(shape[-2:], dtype=np.uint8)
+    for label, plane in zip(labels, planes):
+        label_map[plane] = label
+    return label_map
+
+
+
+def save_header(output_folder, image_dtype, mask_dtype, **metadata):
+    """Save the dtype policy (and the normalization parameters) in 'dtypes.json' in the output folder
+    @params:
+        output_folder   - Required : Path to the output folder
+        image_dtype     - Required : dtype of the images
+        mask_dtype      - Required : dtype of the masks
+        metadata        - Optional : other entries (labels, normalization parameters...)
+    """
+    header = {
+        'image_dtype': image_dtype,
+        'mask_dtype': mask_dtype,
+        **metadata,
+    }
+    with open(Path(output_folder) / HEADER_NAME, mode='w') as file:
+        json.dump(header, file, indent=4, default=str)
+
+
+
+def load_header(output_folder):
+    """Load 'dtypes.json' from the output folder, None if there is none (output of a previous version)"""
+    header_path = Path(output_folder) / HEADER_NAME
+    if not header_path.exists():
+        return None
+    with open(header_path, mode='r') as file:
+        return json.load(file)
@@ -0,0 +1,81 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+"""
+Description: module shared by all the preprocessing scripts, to process independent work units
+(patients, series, images...) with a pool of processes.
+A work function takes one work unit and returns a dictionary of results, for example
+{'errors': [...], 'nexported': 3}. The results of all the work units are then merged with merge_results().
+"""
+
+
+def get_workers(workers):
+    """Get the number of worker processes
+    @params:
+        workers   - Required : number of workers, None (or 0) to use all the CPUs
+    """
+    if not workers:
+        return os.cpu_count() or 1
+    return workers
+
+
+
+def run(work_function, work_units, workers=None, on_result=None, pool='process', chunksize=1):
+    """Apply the work function to each work unit, in parallel
+    @params:
+        work_function   - Required : function taking one work unit, must be picklable (defined at module level,
+                                     or functools.partial of such a function)
+        work_units      - Required : iterable of picklable work units
+        workers         - Optional : number of worker processes, None uses all the CPUs, 1 runs in this process
+        on_result       - Optional : function on_result(work_unit, result) called in this process for each work unit,
+                                     as soon as its result (and the results of the previous units) are available
+        pool            - Optional : 'process', or 'thread' for work that releases the GIL (image decoding, I/O),
+                                     nothing is pickled between threads
+        chunksize       - Optional : number of work units sent at once to a worker process, for many small units
+    Returns:
+        - List of the results, in the order of the work units (same as a serial run)
+    """
+    work_units = list(work_units)
+    workers = min(get_workers(workers), max(len(work_units), 1))
+    results = []
+
+    # No pool needed, run in this process
+    if workers == 1:
+        for work_unit in work_units:
+            result = work_function(work_unit)
+            if on_result is not None:
+                on_result(work_unit, result)
+            results.append(result)
+        return results
+
+    # map() returns the results in the order of the work units, whatever the completion order
+    if pool == 'thread':
+        executor = ThreadPoolExecutor(max_workers=workers)
+    elif pool == 'process':
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f"Unknown pool {pool}")
+    with executor:
+        for work_unit, result in zip(work_units, executor.map(work_function, work_units, chunksize=chunksize)):
+            if on_result is not None:
+                on_result(work_unit, result)
+            results.append(result)
+    return results
+
+
+
+def merge_results(results):
+    """Merge the results dictionaries of the work units
+    Lists (e.g. errors) are concatenated in the order of the results, numbers (counters) are summed
+    @params:
+        results   - Required : iterable of dictionaries returned by the work function
+    """
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
@@ -0,0 +1,80 @@
+import os
+import csv
+import json
+import time
+from pathlib import Path
+
+
+"""
+Description: module shared by the preprocessing scripts, to log the repairs of the segmentation masks
+(rows added and absurd values corrected by the span fill, see segmentation_mask.create_segmentation_mask()).
+The work units return the repair records, and the main process appends them to one JSONL file per run,
+in output_folder/segmentationMasksLogs, as soon as each work unit is completed (see log_result()), so an interrupted
+run keeps the records of its completed units. When the log is closed, a CSV summary counts the repairs of each patient.
+"""
+
+LOGS_FOLDER_NAME = 'segmentationMasksLogs'
+BATCH_SIZE = 1024
+
+
+class RepairLog:
+    """Append-only log of the mask repairs of one run, written by the main process only"""
+
+    def __init__(self, output_folder, batch_size=BATCH_SIZE):
+        """
+        @params:
+            output_folder   - Required : Path to the output folder
+            batch_size      - Optional : number of records kept in memory before they are written
+        """
+        self.logs_folder = Path(output_folder) / LOGS_FOLDER_NAME
+        # Unique name for each run
+        run_name = f"repairs_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}"
+        self.path = self.logs_folder / f"{run_name}.jsonl"
+        self.summary_path = self.logs_folder / f"{run_name}_summary.csv"
+        self.batch_size = batch_size
+        self.pending = []
+        # Dictionary {patient: {event: number of records}}
+        self.counts = {}
+        # Dictionary {patient: set of the repaired images}
+        self.images = {}
+
+
+    def add(self, records):
+        """Add repair records, dictionaries with at least the keys 'patient', 'image' and 'event'"""
+        for record in records:
+            patient_counts = self.counts.setdefault(record['patient'], {})
+            patient_counts[record['event']] = patient_counts.get(record['event'], 0) + 1
+            self.images.setdefault(record['patient'], set()).add(record['image'])
+            self.pending.append(record)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+
+
+    def flush(self):
+        """Write the pending records, in one append"""
+        if len(self.pending) == 0:
+            return
+        # The logs folder is only created if there is something to log
+        Path.mkdir(self.logs_folder, exist_ok=True)
+        with open(self.path, mode='a') as file:
+            file.write(''.join(json.dumps(record, default=int) + '\n' for record in self.pending))
+        self.pending = []
+
+
+    def close(self):
+        """Write the pending records and the summary of the repairs of each patient"""
+        self.flush()
+        if len(self.counts) == 0:
+            return
+        events = sorted({event for patient_counts in self.counts.values() for event in patient_counts})
+        with open(self.summary_path, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['patient', 'images'] + events)
+            for patient in sorted(self.counts):
+                writer.writerow([patient, len(self.images[patient])] + [self.counts[patient].get(event, 0) for event in events])
+
+
+    def log_result(self, _work_unit, result):
+        """Write the repair records of one completed work unit (on_result callback of parallel_driver.run() and checkpoint.run())"""
+        self.add(result.get('repairs', []))
+        self.flush()
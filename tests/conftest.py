@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+# The modules of the scripts are imported as the scripts do (normalize_dicom, segmentation_mask and dicom_index
+# are the same files in LIDC-IDRI and Head-Neck-PET-CT)
+sys.path[:0] = [str(ROOT / 'preprocessing_scripts'), str(ROOT / 'preprocessing_scripts' / 'LIDC-IDRI'),
+                str(ROOT / 'benchmarks'), str(ROOT)]
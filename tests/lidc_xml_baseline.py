@@ -0,0 +1,52 @@
+import numpy as np
+from xml.dom import minidom
+
+
+"""
+Description: frozen copy of the minidom parsing of LIDC-IDRI_preprocessing.py before the streaming reader (lidc_xml.py),
+the reference of test_lidc_xml.py. Do not modify: the loop is the one of the first version of the script
+(segmentation task), without the malignancy filter and the dataframe, which are not part of the parsing.
+"""
+
+def parse_nodules(xml_path):
+    """List of (reading session, nodule ID, malignancy string, [(z position, contour points)]) of the nodules >= 3mm"""
+    nodules_info = []
+
+    # parse() does not take Path() objects, so convert it to string
+    file = minidom.parse(str(xml_path))
+
+    # Search for all 4 reading sessions
+    reading_sessions = file.getElementsByTagName('readingSession')
+
+    for session_index, session in enumerate(reading_sessions):
+        # Search for nodules
+        nodules = session.getElementsByTagName('unblindedReadNodule')
+
+        for nodule in nodules:
+            # Nodules >=3mm have characteristics. If it is empty, we skip it
+            if nodule.getElementsByTagName('characteristics') == []:
+                continue
+            # Get the nodule ID and malignancy,
+            nodule_id = nodule.getElementsByTagName('noduleID')[0].firstChild.data
+            malignancy = nodule.getElementsByTagName('malignancy')[0].firstChild.data
+
+            rois = []
+            # Search for all slices (roi)
+            slices = nodule.getElementsByTagName('roi')
+            for slice in slices:
+                contour_points = []
+
+                # Get all edgeMaps
+                edge_maps = slice.getElementsByTagName('edgeMap')
+                for edge_map in edge_maps:
+                    # Add the values to the corresponding array
+                    x = int(edge_map.getElementsByTagName('xCoord')[0].firstChild.data)
+                    y = int(edge_map.getElementsByTagName('yCoord')[0].firstChild.data)
+                    contour_points.append([x, y])
+
+                center_z = float(slice.getElementsByTagName('imageZposition')[0].firstChild.data)
+                rois.append((center_z, np.array(contour_points)))
+
+            nodules_info.append((session_index, nodule_id, malignancy, rois))
+
+    return nodules_info
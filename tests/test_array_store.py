@@ -0,0 +1,69 @@
+import os
+import time
+
+import numpy as np
+
+import array_store
+import parallel_driver
+
+
+def sample(number):
+    """Array of a work unit, with its own shape and dtype"""
+    dtype = [np.uint8, np.int16, np.float32, np.float64][number % 4]
+    return np.arange(number * 7, dtype=np.float64).reshape(number, 7).astype(dtype)
+
+
+def save_sample(work_unit):
+    """Work function: save the array of the unit in the shards of this process"""
+    output_folder, number = work_unit
+    key = array_store.save_array(output_folder, os.path.join(output_folder, 'img', f"{number}"), sample(number),
+                                 backend='shards')
+    array_store.commit(output_folder, backend='shards')
+    # Leave time to the other worker to take a unit
+    time.sleep(0.02)
+    return {'key': key, 'pid': os.getpid()}
+
+
+def test_two_processes(tmp_path):
+    results = parallel_driver.run(save_sample, [(str(tmp_path), number) for number in range(1, 13)], workers=2)
+    pids = {result['pid'] for result in results}
+    assert len(pids) == 2
+    shards_folder = tmp_path / array_store.SHARDS_FOLDER_NAME
+    assert {path.name for path in shards_folder.glob('index-*.jsonl')} == {f"index-{pid}.jsonl" for pid in pids}
+
+    reader = array_store.ShardReader(tmp_path)
+    assert sorted(reader.keys()) == sorted(result['key'] for result in results)
+    for number in range(1, 13):
+        array = reader[os.path.join('img', f"{number}.npy")]
+        assert array.dtype == sample(number).dtype and not array.flags.writeable
+        np.testing.assert_array_equal(array, sample(number))
+        # Aligned view on the memory-mapped shard
+        assert isinstance(array.base, np.memmap) or isinstance(array, np.memmap)
+        assert array.__array_interface__['data'][0] % array_store.ALIGNMENT == 0
+    assert array_store.count_arrays(tmp_path, tmp_path / 'img', backend='shards') == 12
+
+
+def test_latest_entry_wins(tmp_path):
+    # Written by a worker process, then written again by this process (run resumed...)
+    first, _second = parallel_driver.run(save_sample, [(str(tmp_path), 3), (str(tmp_path), 4)], workers=2)
+    assert first['pid'] != os.getpid()
+    writer = array_store.ShardWriter(tmp_path / array_store.SHARDS_FOLDER_NAME)
+    writer.append(first['key'], np.full((2, 2), 1, dtype=np.uint8))
+    writer.append(first['key'], np.full((2, 2), 2, dtype=np.uint8))
+    writer.close()
+
+    index = array_store.load_index(tmp_path / array_store.SHARDS_FOLDER_NAME)
+    assert len(index) == 2
+    assert index[first['key']]['shard'].startswith(f"shard-{os.getpid()}-")
+    assert array_store.ShardReader(tmp_path)[first['key']].tolist() == [[2, 2], [2, 2]]
+
+
+def test_uncommitted_arrays_are_ignored(tmp_path):
+    writer = array_store.ShardWriter(tmp_path / array_store.SHARDS_FOLDER_NAME)
+    writer.append('a.npy', np.ones(3))
+    writer.commit()
+    # Interrupted before the commit of its unit
+    writer.append('b.npy', np.ones(3))
+    with open(writer.index_path, mode='a') as file:
+        file.write('{"key": "c.npy", "sha')
+    assert list(array_store.load_index(tmp_path / array_store.SHARDS_FOLDER_NAME)) == ['a.npy']
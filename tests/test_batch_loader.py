@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+import pytest
+
+import batch_loader
+
+
+def save(output_folder, arrays):
+    for path, array in arrays.items():
+        os.makedirs(output_folder / os.path.dirname(path), exist_ok=True)
+        np.save(output_folder / path, array)
+
+
+def mask(*pixels):
+    array = np.zeros((2, 2), dtype=np.uint8)
+    for pixel in pixels:
+        array[pixel] = 1
+    return array
+
+
+@pytest.fixture
+def busi_folder(tmp_path):
+    """One image with two lesions, one with one lesion"""
+    save(tmp_path, {'img/a.npy': np.full((2, 2), 1, dtype=np.uint8), 'masks/a_mask0.npy': mask((0, 0)),
+                    'masks/a_mask1.npy': mask((1, 1)), 'img/b.npy': np.full((2, 2), 2, dtype=np.uint8),
+                    'masks/b_mask0.npy': mask((0, 1))})
+    return tmp_path
+
+
+def test_several_masks_raise(busi_folder):
+    with pytest.raises(ValueError, match='has 2 masks'):
+        list(batch_loader.BatchLoader(busi_folder, batch_size=2))
+
+
+def test_merged_masks(busi_folder):
+    [(images, masks)] = list(batch_loader.BatchLoader(busi_folder, batch_size=2, merge_masks=True))
+    assert images.shape == masks.shape == (2, 1, 2, 2)
+    assert masks[0, 0].tolist() == [[1, 0], [0, 1]]
+    assert masks[1, 0].tolist() == [[0, 1], [0, 0]]
+
+
+def test_consensus_level(tmp_path):
+    save(tmp_path, {'segmentation/img/X.npy': np.zeros((2, 2), dtype=np.uint8),
+                    'segmentation/masks/union/X_mask.npy': mask((0, 0), (0, 1)),
+                    'segmentation/masks/intersection/X_mask.npy': mask((0, 0))})
+    with pytest.raises(ValueError, match='mask_level'):
+        batch_loader.BatchLoader(tmp_path, batch_size=1)
+    for level, expected in [('union', [[1, 1], [0, 0]]), ('intersection', [[1, 0], [0, 0]])]:
+        [(_images, masks)] = list(batch_loader.BatchLoader(tmp_path, batch_size=1, mask_level=level))
+        assert masks[0, 0].tolist() == expected
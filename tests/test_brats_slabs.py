@@ -0,0 +1,68 @@
+import importlib.util
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import preprocessing_benchmark
+
+
+# The script is not a package module, load it from its path (its main part is not run)
+spec = importlib.util.spec_from_file_location(
+    'BraTS2019_preprocessing', preprocessing_benchmark.ROOT / preprocessing_benchmark.SCRIPTS['BraTS2019'][0])
+brats = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(brats)
+
+
+def slice_with(pixels, label=1, shape=(6, 8)):
+    """Mask slice with the given number of foreground pixels, from the second row"""
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask.reshape(-1)[shape[1]:shape[1] + pixels] = label
+    return mask
+
+
+def test_mask_statistics_split():
+    mask = np.stack([slice_with(0), slice_with(1), slice_with(4, label=2), slice_with(5, label=4), slice_with(12)])
+    statistics = brats.mask_statistics(mask, first=40, min_mask_pixels=5)
+    assert statistics['slice'].tolist() == [40, 41, 42, 43, 44]
+    assert statistics['foreground'].tolist() == [0, 1, 4, 5, 12]
+    # Exactly min_mask_pixels pixels is kept
+    assert statistics['folder'].tolist() == ['empty_mask', 'dropped', 'dropped', 'with_mask', 'with_mask']
+    assert statistics['label_1'].tolist() == [0, 1, 0, 0, 12]
+    assert statistics['label_2'].tolist() == [0, 0, 4, 0, 0]
+    assert statistics['label_4'].tolist() == [0, 0, 0, 5, 0]
+    # Bounding boxes, -1 for the empty mask
+    assert statistics[['row_min', 'row_max', 'col_min', 'col_max']].to_numpy().tolist() == \
+           [[-1, -1, -1, -1], [1, 1, 0, 0], [1, 1, 0, 3], [1, 1, 0, 4], [1, 2, 0, 7]]
+
+    # Without minimum, every non-empty mask is kept
+    statistics = brats.mask_statistics(mask, first=0, min_mask_pixels=0)
+    assert statistics['folder'].tolist() == ['empty_mask'] + ['with_mask'] * 4
+
+
+@pytest.fixture(params=['.nii', '.nii.gz'])
+def volume_path(request, tmp_path):
+    """Volume (x, y, z) stored as scaled int16, as the BraTS modalities"""
+    rng = np.random.default_rng(0)
+    data = rng.normal(300, 120, size=(7, 9, 11))
+    image = nib.Nifti1Image(data, np.eye(4))
+    image.set_data_dtype(np.int16)
+    path = tmp_path / f"volume{request.param}"
+    nib.save(image, path)
+    return path
+
+
+@pytest.mark.parametrize('slab_size', [1, 4, 11])
+def test_slabs_are_the_slices_of_the_volume(volume_path, slab_size):
+    expected = nib.load(volume_path).get_fdata()
+    stored, scaling = brats.open_volume(volume_path)
+    assert scaling is not None
+    for first in range(0, 11, slab_size):
+        last = min(first + slab_size, 11)
+        native = brats.read_slab(stored, first, last)
+        real = brats.read_slab(stored, first, last, 'float64', scaling)
+        assert native.dtype == np.int16 and native.flags.c_contiguous and real.flags.c_contiguous
+        assert native.shape == real.shape == (last - first, 7, 9)
+        for i, slice in enumerate(range(first, last)):
+            np.testing.assert_array_equal(real[i], expected[:, :, slice])
+            np.testing.assert_array_equal(native[i] * scaling['slope'] + scaling['intercept'], expected[:, :, slice])
@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pytest
+
+import checkpoint
+
+
+PARAMETERS = {'dtype': 'uint8', 'window': [-1000, 400]}
+
+
+@pytest.fixture
+def output_folder(tmp_path):
+    (tmp_path / 'img').mkdir()
+    return tmp_path
+
+
+def run(output_folder, units, processed, parameters=PARAMETERS):
+    """Run the units in process, each one saves one array; the processed units are appended to processed"""
+    def work_function(unit):
+        processed.append(unit)
+        path = checkpoint.save_array(output_folder, output_folder / 'img' / unit, np.full((2, 2), len(unit)))
+        return {'files': [path], 'nslices': len(unit)}
+    return checkpoint.run(work_function, units, str, parameters, output_folder, workers=1)
+
+
+def test_completed_units_are_skipped(output_folder):
+    processed = []
+    assert run(output_folder, ['a', 'bb'], processed) == [{'files': ['img/a.npy'], 'nslices': 1},
+                                                          {'files': ['img/bb.npy'], 'nslices': 2}]
+    # The recorded results are returned for the skipped units
+    assert run(output_folder, ['a', 'bb', 'ccc'], processed) == [{'nslices': 1}, {'nslices': 2},
+                                                                 {'files': ['img/ccc.npy'], 'nslices': 3}]
+    assert processed == ['a', 'bb', 'ccc']
+    # Other parameters redo everything
+    run(output_folder, ['a'], processed, parameters={**PARAMETERS, 'dtype': 'float32'})
+    assert processed == ['a', 'bb', 'ccc', 'a']
+
+
+def test_partial_files_are_ignored_and_replaced(output_folder):
+    processed = []
+    run(output_folder, ['a'], processed)
+    # Run killed while saving 'bb': its temporary file is left, and it is not in the manifest
+    partial_folder = output_folder / checkpoint.PARTIAL_FOLDER_NAME
+    partial_folder.mkdir()
+    (partial_folder / '1234_bb.npy').write_bytes(b'\x93NUMPY truncated')
+
+    run(output_folder, ['a', 'bb'], processed)
+    assert processed == ['a', 'bb']
+    assert not partial_folder.exists()
+    assert np.load(output_folder / 'img' / 'bb.npy').tolist() == [[2, 2], [2, 2]]
+
+
+def test_truncated_last_record(output_folder):
+    processed = []
+    run(output_folder, ['a', 'bb'], processed)
+    # Run killed while writing the record of 'ccc'
+    manifest_path = output_folder / checkpoint.MANIFEST_NAME
+    with open(manifest_path, mode='a') as file:
+        file.write('{"unit": "ccc", "parameters": {"dtype": "ui')
+
+    manifest = checkpoint.load_manifest(output_folder)
+    assert sorted(manifest) == ['a', 'bb']
+    assert checkpoint.is_completed(manifest, 'bb', PARAMETERS)
+    assert not checkpoint.is_completed(manifest, 'ccc', PARAMETERS)
+
+    run(output_folder, ['a', 'bb', 'ccc'], processed)
+    assert processed == ['a', 'bb', 'ccc']
+    # The record of 'ccc' starts on a new line, after the partial one
+    lines = manifest_path.read_text().splitlines()
+    assert json.loads(lines[-1])['unit'] == 'ccc'
+    assert checkpoint.is_completed(checkpoint.load_manifest(output_folder), 'ccc', PARAMETERS)
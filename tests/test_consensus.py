@@ -0,0 +1,53 @@
+import numpy as np
+
+import consensus
+import lidc_xml
+
+
+def square(x, y, size):
+    return np.array([[x, y], [x + size, y], [x + size, y + size], [x, y + size]], dtype=np.float64)
+
+
+def nodule(reader, nodule_id, malignancy, x, y, z_positions=(0.0, 2.5)):
+    rois = [lidc_xml.ROI(z, f"1.2.{reader}.{z}", True, square(x, y, 8)) for z in z_positions]
+    return lidc_xml.Nodule(reader, nodule_id, malignancy, rois)
+
+
+def test_groups_are_selected_on_their_malignancy():
+    nodules = [
+        # One nodule, benign for one of its four readers
+        nodule(0, 'a', 4, 20, 20), nodule(1, 'b', 2, 21, 20), nodule(2, 'c', 5, 20, 22), nodule(3, 'd', 4, 19, 21),
+        # Another nodule, benign for most of its readers
+        nodule(0, 'e', 2, 60, 60), nodule(1, 'f', 3, 61, 60), nodule(2, 'g', 5, 60, 61),
+        # Not rated
+        nodule(0, 'h', None, 100, 20),
+    ]
+    groups = consensus.group_nodules(nodules, max_distance=10)
+    assert [[n.nodule_id for n in group] for group in groups] == [['a', 'b', 'c', 'd'], ['e', 'f', 'g'], ['h']]
+    assert [consensus.group_malignancy(group) for group in groups] == [3.75, 10 / 3, None]
+
+
+def test_all_readers_count_in_the_thresholds():
+    # Four readers contoured the nodule, the benign rating of one of them does not remove its vote
+    reader_masks = np.zeros((4, 1, 4), dtype=np.uint8)
+    reader_masks[:, 0, 0] = 1
+    reader_masks[:2, 0, 1] = 1
+    reader_masks[:1, 0, 2] = 1
+    masks = consensus.consensus_masks(reader_masks, nreaders=4)
+    assert masks['union'].tolist() == [[1, 1, 1, 0]]
+    assert masks['majority'].tolist() == [[1, 1, 0, 0]]
+    assert masks['intersection'].tolist() == [[1, 0, 0, 0]]
+
+
+def test_nodules_without_contour_are_left_out():
+    empty = lidc_xml.Nodule(1, 'empty', 4, [])
+    holes = lidc_xml.Nodule(2, 'holes', 4, [lidc_xml.ROI(0.0, '1.2', False, square(20, 20, 2))])
+    groups = consensus.group_nodules([nodule(0, 'a', 4, 20, 20), empty, holes], max_distance=10)
+    assert [[n.nodule_id for n in group] for group in groups] == [['a']]
+
+
+def test_holes_do_not_move_the_center():
+    hole = lidc_xml.ROI(0.0, '1.3', False, square(40, 40, 2))
+    with_hole = lidc_xml.Nodule(0, 'a', 4, nodule(0, 'a', 4, 20, 20).rois + [hole])
+    center, z_range = consensus.nodule_extent(with_hole)
+    assert center.tolist() == [24, 24] and z_range == (0.0, 2.5)
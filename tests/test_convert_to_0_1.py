@@ -0,0 +1,99 @@
+import json
+import numpy as np
+import pytest
+
+import convert_to_0_1
+import dtype_policy
+import synthetic_datasets
+import preprocessing_benchmark
+
+
+def convert(root_folder, dtype='float32'):
+    convert_to_0_1.arguments.update({'root_folder': str(root_folder), 'dtype': dtype, 'workers': 1, 'dry_run': False})
+    convert_to_0_1.main()
+
+
+@pytest.fixture
+def brats_like(tmp_path):
+    """Output folder with the BraTS2019 policy: native int16 images, uint8 label maps"""
+    (tmp_path / 'HGG' / 'mask').mkdir(parents=True)
+    (tmp_path / 'HGG' / 't1').mkdir(parents=True)
+    labels = np.array([[0, 1], [2, 4]], dtype=np.uint8)
+    np.save(tmp_path / 'HGG' / 'mask' / 'P_slice_1_mask.npy', labels)
+    # Only label 1, max value 1: a label map anyway
+    np.save(tmp_path / 'HGG' / 'mask' / 'P_slice_2_mask.npy', np.array([[0, 1], [1, 1]], dtype=np.uint8))
+    np.save(tmp_path / 'HGG' / 't1' / 'P_slice_1_t1.npy', np.array([[0, 1200], [-5, 700]], dtype=np.int16))
+    dtype_policy.save_header(tmp_path, 'native', 'uint8', labels=[1, 2, 4])
+    return tmp_path
+
+
+def test_label_maps_are_divided_by_the_largest_label(brats_like):
+    convert(brats_like)
+    mask = np.load(brats_like / 'HGG' / 'mask' / 'P_slice_1_mask.npy')
+    np.testing.assert_array_equal(mask, np.array([[0, 0.25], [0.5, 1]], dtype=np.float32))
+    np.testing.assert_array_equal(np.load(brats_like / 'HGG' / 'mask' / 'P_slice_2_mask.npy'),
+                                  np.array([[0, 0.25], [0.25, 0.25]], dtype=np.float32))
+    # Native images are kept
+    image = np.load(brats_like / 'HGG' / 't1' / 'P_slice_1_t1.npy')
+    assert image.dtype == np.int16 and image[0, 1] == 1200
+
+    # A second run does not divide again
+    convert(brats_like)
+    np.testing.assert_array_equal(np.load(brats_like / 'HGG' / 'mask' / 'P_slice_1_mask.npy'), mask)
+
+
+def test_keep_records_the_scale_of_the_label_maps(brats_like):
+    convert(brats_like, 'keep')
+    with open(brats_like / convert_to_0_1.SCALES_NAME) as file:
+        scales = json.load(file)['scales']
+    assert scales == {'HGG/mask/P_slice_1_mask.npy': 0.25, 'HGG/mask/P_slice_2_mask.npy': 0.25}
+
+
+def test_uint8_images_and_binary_masks(tmp_path):
+    (tmp_path / 'img').mkdir()
+    (tmp_path / 'masks').mkdir()
+    np.save(tmp_path / 'img' / 'a.npy', np.array([0, 51, 255], dtype=np.uint8))
+    np.save(tmp_path / 'masks' / 'a_mask0.npy', np.array([0, 255, 255], dtype=np.uint8))
+    np.save(tmp_path / 'masks' / 'b_mask0.npy', np.array([0, 1, 1], dtype=np.uint8))
+    dtype_policy.save_header(tmp_path, 'uint8', 'uint8')
+    convert(tmp_path)
+    np.testing.assert_allclose(np.load(tmp_path / 'img' / 'a.npy'), [0, 0.2, 1])
+    np.testing.assert_array_equal(np.load(tmp_path / 'masks' / 'a_mask0.npy'), [0, 1, 1])
+    # Already in [0,1]
+    assert np.load(tmp_path / 'masks' / 'b_mask0.npy').dtype == np.uint8
+
+
+def test_outputs_without_header(tmp_path):
+    np.save(tmp_path / 'a.npy', np.array([0, 255], dtype=np.int16))
+    convert(tmp_path)
+    np.testing.assert_array_equal(np.load(tmp_path / 'a.npy'), [0, 1])
+
+
+def test_brats_output(tmp_path):
+    """BraTS2019 script output (uint8 label maps, native images) through the converter"""
+    dataset_folder, output_folder = tmp_path / 'data', tmp_path / 'output'
+    synthetic_datasets.make_brats(dataset_folder, npatients=2, nslices=8, shape=(24, 24))
+    output_folder.mkdir()
+    _seconds, process = preprocessing_benchmark.run_script(
+        preprocessing_benchmark.ROOT / preprocessing_benchmark.SCRIPTS['BraTS2019'][0],
+        {'dataset_folder': str(dataset_folder), 'output_folder': str(output_folder), 'workers': 1, 'min_mask_pixels': 1})
+    assert process.returncode == 0, process.stderr
+
+    mask_paths = sorted(output_folder.glob('*/mask/*.npy'))
+    image_paths = sorted(output_folder.glob('*/t1/with_mask/*.npy'))
+    assert len(mask_paths) > 0
+    labels = [np.load(path) for path in mask_paths]
+    images = [np.load(path) for path in image_paths]
+    convert(output_folder)
+
+    for path, label_map in zip(mask_paths, labels):
+        np.testing.assert_array_equal(np.load(path), (label_map / 4).astype(np.float32))
+    for path, image in zip(image_paths, images):
+        np.testing.assert_array_equal(np.load(path), image)
+
+
+def test_root_folder_with_trailing_separator(brats_like):
+    convert(str(brats_like) + '/')
+    np.testing.assert_array_equal(np.load(brats_like / 'HGG' / 'mask' / 'P_slice_1_mask.npy'),
+                                  np.array([[0, 0.25], [0.5, 1]], dtype=np.float32))
+    assert np.load(brats_like / 'HGG' / 't1' / 'P_slice_1_t1.npy').dtype == np.int16
@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import dataset_reader
+
+
+def keys(*paths):
+    return [os.path.join(*path.split('/')) for path in paths]
+
+
+def pairs_of(*paths):
+    return {image_key: masks for image_key, masks in dataset_reader.pair_keys(keys(*paths))}
+
+
+def test_layouts_of_the_scripts():
+    pairs = pairs_of(
+        # BUSI, several lesions
+        'img/benign12.npy', 'masks/benign12_mask0.npy', 'masks/benign12_mask1.npy',
+        # BUSI (Jonas), masks next to the images
+        'benign/benign3.npy', 'benign/benign3_mask0.npy',
+        # BraTS2019, one file per modality, and the stacked modalities
+        'HGG/t1/with_mask/P_slice_80_t1.npy', 'HGG/stacked/with_mask/P_slice_80.npy', 'HGG/mask/P_slice_80_mask.npy',
+        'HGG/t1/empty_mask/P_slice_2_t1.npy',
+    )
+    default = dataset_reader.DEFAULT_LEVEL
+    assert pairs == {
+        keys('img/benign12.npy')[0]: {default: keys('masks/benign12_mask0.npy', 'masks/benign12_mask1.npy')},
+        keys('benign/benign3.npy')[0]: {default: keys('benign/benign3_mask0.npy')},
+        keys('HGG/t1/with_mask/P_slice_80_t1.npy')[0]: {default: keys('HGG/mask/P_slice_80_mask.npy')},
+        keys('HGG/stacked/with_mask/P_slice_80.npy')[0]: {default: keys('HGG/mask/P_slice_80_mask.npy')},
+        keys('HGG/t1/empty_mask/P_slice_2_t1.npy')[0]: {},
+    }
+
+
+def test_same_stems_in_different_folders():
+    pairs = pairs_of(
+        'HGG/t2/with_mask/P_slice_80_t2.npy', 'HGG/mask/P_slice_80_mask.npy',
+        'LGG/t2/with_mask/P_slice_80_t2.npy', 'LGG/mask/P_slice_80_mask.npy',
+        # Same names in two output folders gathered in one folder
+        'run1/segmentation/img/X.npy', 'run1/segmentation/masks/X_mask.npy', 'run2/segmentation/img/X.npy',
+    )
+    default = dataset_reader.DEFAULT_LEVEL
+    assert pairs[keys('HGG/t2/with_mask/P_slice_80_t2.npy')[0]] == {default: keys('HGG/mask/P_slice_80_mask.npy')}
+    assert pairs[keys('LGG/t2/with_mask/P_slice_80_t2.npy')[0]] == {default: keys('LGG/mask/P_slice_80_mask.npy')}
+    assert pairs[keys('run1/segmentation/img/X.npy')[0]] == {default: keys('run1/segmentation/masks/X_mask.npy')}
+    assert pairs[keys('run2/segmentation/img/X.npy')[0]] == {}
+
+
+def test_consensus_levels():
+    pairs = pairs_of('segmentation/img/X.npy', 'segmentation/masks/union/X_mask.npy',
+                     'segmentation/masks/majority/X_mask.npy', 'segmentation/masks/intersection/X_mask.npy')
+    assert pairs == {keys('segmentation/img/X.npy')[0]: {
+        'intersection': keys('segmentation/masks/intersection/X_mask.npy'),
+        'majority': keys('segmentation/masks/majority/X_mask.npy'),
+        'union': keys('segmentation/masks/union/X_mask.npy'),
+    }}
+
+
+@pytest.fixture
+def consensus_folder(tmp_path):
+    output_folder = tmp_path / 'output'
+    for path, value in [('img/X', 7), ('masks/union/X_mask', 1), ('masks/majority/X_mask', 0), ('img/Y', 9),
+                        ('masks/union/Y_mask', 1)]:
+        os.makedirs(output_folder / 'segmentation' / os.path.dirname(path), exist_ok=True)
+        np.save(output_folder / 'segmentation' / path, np.full((2, 2), value, dtype=np.uint8))
+    return output_folder
+
+
+def test_dataset_selects_a_level(consensus_folder):
+    with pytest.raises(ValueError, match='mask_level'):
+        dataset_reader.PreprocessedDataset(consensus_folder)
+    with pytest.raises(ValueError, match='No masks of level'):
+        dataset_reader.PreprocessedDataset(consensus_folder, mask_level='intersection')
+
+    dataset = dataset_reader.PreprocessedDataset(consensus_folder, mask_level='majority')
+    assert dataset.levels == ['majority', 'union']
+    assert dataset.keys() == [os.path.join('segmentation', 'img', 'X.npy')]
+    image, masks = dataset[0]
+    assert image[0, 0] == 7 and len(masks) == 1 and masks[0][0, 0] == 0
+    assert len(dataset_reader.PreprocessedDataset(consensus_folder, mask_level='union')) == 2
+
+
+def test_old_pairing_table_is_rebuilt(consensus_folder):
+    with open(consensus_folder / dataset_reader.PAIRS_NAME, mode='w') as file:
+        json.dump({'backend': 'npy', 'pairs': [['segmentation/img/X.npy', ['segmentation/masks/union/X_mask.npy']]]}, file)
+    assert dataset_reader.load_pairs(consensus_folder)['version'] == dataset_reader.PAIRS_VERSION
+
+
+def test_scales_of_a_parent_folder(consensus_folder):
+    # convert_to_0_1.py run on the parent folder of the output folder, keys relative to that folder
+    scales = {os.path.join('output', 'segmentation', 'img', 'X.npy'): 0.5,
+              os.path.join('other', 'segmentation', 'img', 'X.npy'): 0.25}
+    with open(consensus_folder.parent / dataset_reader.SCALES_NAME, mode='w') as file:
+        json.dump({'scales': scales}, file)
+    dataset = dataset_reader.PreprocessedDataset(consensus_folder, mask_level='union')
+    assert dataset.scales == {os.path.join('segmentation', 'img', 'X.npy'): 0.5}
+    assert dataset[0][0][0, 0] == 3.5
+    assert dataset[1][0][0, 0] == 9
+
+
+def test_cache_keeps_arrays_in_memory(consensus_folder):
+    dataset = dataset_reader.PreprocessedDataset(consensus_folder, mask_level='union')
+    image, masks = dataset[0]
+    assert not isinstance(image, np.memmap) and image.base is None and not image.flags.writeable
+    assert all(mask.base is None for mask in masks)
+    assert dataset[0][0] is image
+    assert dataset.cached_bytes == image.nbytes + sum(mask.nbytes for mask in masks)
+
+    # Without cache, the samples are the memory maps
+    image, _masks = dataset_reader.PreprocessedDataset(consensus_folder, cache_size=0, mask_level='union')[0]
+    assert isinstance(image, np.memmap)
@@ -0,0 +1,14 @@
+import numpy as np
+
+import dataset_statistics
+
+
+def test_channels_are_added_separately():
+    statistics = dataset_statistics.DatasetStatistics(value_range=(0, 256))
+    # (Z, C, H, W) volume of two windows
+    volume = np.stack([np.full((3, 4), 10, dtype=np.uint8), np.full((3, 4), 200, dtype=np.uint8)])[None].repeat(2, axis=0)
+    statistics.add_image('CT', volume, channels=['lung', 'bone'])
+    summary = statistics.to_dict()['images']
+    assert sorted(summary) == ['CT_bone', 'CT_lung']
+    assert summary['CT_lung']['mean'] == 10 and summary['CT_bone']['mean'] == 200
+    assert summary['CT_lung']['count'] == 24
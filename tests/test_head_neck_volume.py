@@ -0,0 +1,38 @@
+import json
+
+import numpy as np
+import pydicom
+
+import synthetic_datasets
+import preprocessing_benchmark
+
+
+def test_volume_keeps_the_slices_without_contour(tmp_path):
+    dataset_folder, output_folder, excel = tmp_path / 'data', tmp_path / 'output', tmp_path / 'rois.xlsx'
+    synthetic_datasets.make_head_neck(dataset_folder, excel, npatients=1, nslices=8, ncontours=5, shape=(32, 32))
+
+    # The GTV of the patient is not contoured on its middle slice
+    [rt_path] = dataset_folder.glob('*/*/RTSTRUCT-*/*.dcm')
+    rtstruct = pydicom.dcmread(rt_path)
+    [gtv_number] = [roi.ROINumber for roi in rtstruct.StructureSetROISequence if roi.ROIName == 'GTV']
+    [gtv] = [roi for roi in rtstruct.ROIContourSequence if roi.ReferencedROINumber == gtv_number]
+    del gtv.ContourSequence[2]
+    rtstruct.save_as(rt_path)
+
+    output_folder.mkdir()
+    _seconds, process = preprocessing_benchmark.run_script(
+        preprocessing_benchmark.ROOT / preprocessing_benchmark.SCRIPTS['Head-Neck-PET-CT'][0],
+        {'dataset_folder': str(dataset_folder), 'roinames_excel': str(excel), 'output_folder': str(output_folder),
+         'workers': 1, 'mask_mode': 'volume'})
+    assert process.returncode == 0, process.stderr
+
+    with open(output_folder / 'volumes.json') as file:
+        [(image_key, volume)] = json.load(file)['volumes'].items()
+    assert volume['contoured'] == [True, True, False, True, True]
+    # Contiguous slices, sorted by position
+    np.testing.assert_allclose(np.diff(volume['positions']), synthetic_datasets.SLICE_THICKNESS)
+
+    image = np.load(output_folder / image_key)
+    mask = np.load(output_folder / image_key.replace('img', 'masks', 1).replace('.npy', '_mask.npy'))
+    assert image.shape == mask.shape == (5, 32, 32)
+    assert (mask.reshape(5, -1).max(axis=1) > 0).tolist() == volume['contoured']
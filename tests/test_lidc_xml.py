@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import numpy as np
+
+import lidc_xml
+import lidc_xml_baseline
+
+
+XML_PATH = Path(__file__).parent / 'data' / 'lidc_annotation.xml'
+
+
+def test_same_nodules_as_baseline():
+    expected = lidc_xml_baseline.parse_nodules(XML_PATH)
+    nodules = list(lidc_xml.iter_nodules(XML_PATH))
+    assert len(expected) == 3
+    assert [(n.reading_session, n.nodule_id) for n in nodules] == [(session, nid) for session, nid, _m, _r in expected]
+    for nodule, (_session, _nid, malignancy, rois) in zip(nodules, expected):
+        assert nodule.malignancy == int(malignancy)
+        assert [roi.z_position for roi in nodule.rois] == [z for z, _contour in rois]
+        for roi, (_z, contour) in zip(nodule.rois, rois):
+            assert roi.contour.dtype == np.int32
+            np.testing.assert_array_equal(roi.contour, contour)
+
+
+def test_inclusion_and_uids():
+    [first, _second, _third] = lidc_xml.iter_nodules(XML_PATH)
+    assert [roi.inclusion for roi in first.rois] == [True, True, False]
+    # The hole is in the same slice as the second contour
+    assert first.rois[1].sop_uid == first.rois[2].sop_uid == \
+           '1.3.6.1.4.1.14519.5.2.1.6279.6001.107109359065300889765026303943'
+
+
+def test_small_nodules():
+    nodules = list(lidc_xml.iter_nodules(XML_PATH, small_nodules=True))
+    assert [n.nodule_id for n in nodules] == ['Nodule 001', 'Nodule 002', 'IL057_127364', '0']
+    small = nodules[1]
+    assert small.reading_session == 0 and small.malignancy is None
+    assert small.rois[0].z_position == -180.0 and small.rois[0].contour.tolist() == [[98, 204]]
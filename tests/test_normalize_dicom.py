@@ -0,0 +1,40 @@
+import numpy as np
+import pydicom
+import pytest
+
+import normalize_dicom
+import synthetic_datasets
+
+
+@pytest.fixture
+def series(tmp_path):
+    """Three CT slices, the second one lists two DICOM windows"""
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"{i}.dcm"
+        synthetic_datasets.write_dicom_slice(path, -2.5 * i, '1.2.3', 'CT', (16, 16), rng)
+        paths.append(path)
+    dataset = pydicom.dcmread(paths[1])
+    dataset.WindowCenter, dataset.WindowWidth = [-600, 40], [1500, 400]
+    dataset.save_as(paths[1])
+    return paths
+
+
+def test_dicom_windows_differ_between_slices(series):
+    shapes = {normalize_dicom.get_normalized_array(pydicom.dcmread(path), windows='dicom').shape for path in series}
+    assert shapes == {(1, 16, 16), (2, 16, 16)}
+
+
+@pytest.mark.parametrize('windows', ['dicom', 'preset', ['dicom', 'CT'], [('custom', 40, 400)]])
+def test_series_windows_give_the_same_channels(series, windows):
+    series_windows = normalize_dicom.get_series_windows(series[0], windows)
+    arrays = [normalize_dicom.get_normalized_array(pydicom.dcmread(path), windows=series_windows) for path in series]
+    assert {array.shape for array in arrays} == {(len(series_windows), 16, 16)}
+    # The windows of the first slice, as get_windows() resolves them
+    first = pydicom.dcmread(series[0])
+    np.testing.assert_array_equal(arrays[0], normalize_dicom.get_normalized_array(first, windows=windows))
+
+
+def test_series_windows_none(series):
+    assert normalize_dicom.get_series_windows(series[0], None) is None
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+
+import segmentation_mask
+
+
+NROW, NCOL = 40, 36
+
+
+def edges(parts):
+    for part in parts:
+        for k in range(len(part)):
+            yield part[k], part[(k + 1) % len(part)]
+
+
+def reference_fill(parts, nrow, ncol):
+    """Even-odd test of every pixel center (crossings counted on a ray towards +x), one pixel at a time"""
+    mask = np.zeros((nrow, ncol), dtype=bool)
+    for r in range(nrow):
+        for c in range(ncol):
+            inside = False
+            for (xi, yi), (xj, yj) in edges(parts):
+                if (yi > r) != (yj > r) and c < xi + (r - yi) * (xj - xi) / (yj - yi):
+                    inside = not inside
+            mask[r, c] = inside
+    return mask
+
+
+def reference_outline(parts, nrow, ncol):
+    """Pixels of the edges, one sample per pixel along the major axis of each edge (DDA)"""
+    mask = np.zeros((nrow, ncol), dtype=bool)
+    for (xi, yi), (xj, yj) in edges(parts):
+        n = int(np.ceil(max(abs(xj - xi), abs(yj - yi))))
+        for k in range(n + 1):
+            t = k / max(n, 1)
+            x, y = round(xi + t * (xj - xi)), round(yi + t * (yj - yi))
+            if 0 <= x < ncol and 0 <= y < nrow:
+                mask[y, x] = True
+    return mask
+
+
+def distance_to_edges(parts, nrow, ncol):
+    """Distance of every pixel center to the closest edge"""
+    rows, cols = np.mgrid[:nrow, :ncol]
+    centers = np.stack([cols, rows], axis=-1).astype(np.float64)
+    distance = np.full((nrow, ncol), np.inf)
+    for start, end in edges(parts):
+        start, end = np.asarray(start, dtype=np.float64), np.asarray(end, dtype=np.float64)
+        direction = end - start
+        t = np.clip((centers - start) @ direction / max(direction @ direction, 1e-12), 0, 1)
+        distance = np.minimum(distance, np.linalg.norm(centers - start - t[..., None] * direction, axis=-1))
+    return distance
+
+
+# Contours in image coordinates (column, row), list of closed polygons
+CONTOURS = {
+    'concave_c': [[[30, 5], [10, 5], [6, 10], [5, 20], [6, 30], [10, 35], [30, 35], [30, 30], [14, 28], [12, 20],
+                   [14, 12], [30, 10]]],
+    'concave_star': [[[20, 2], [23, 14], [35, 14], [26, 22], [30, 35], [20, 27], [10, 35], [14, 22], [4, 14],
+                      [17, 14]]],
+    # Two squares touching at one vertex, the contour passes twice through (15, 15)
+    'touching_vertex': [[[5, 5], [15, 5], [15, 15], [25, 15], [25, 25], [15, 25], [15, 15], [5, 15]]],
+    # Keyhole: the cut to the hole goes back and forth along the same edge
+    'keyhole': [[[4, 4], [30, 4], [30, 30], [17, 30], [17, 22], [22, 22], [22, 12], [12, 12], [12, 22], [17, 22],
+                 [17, 30], [4, 30]]],
+    'bowtie': [[[5, 5], [30, 30], [30, 5], [5, 30]]],
+    'hole': [[[3, 3], [32, 3], [32, 36], [3, 36]], [[10, 10], [25, 10], [25, 28], [10, 28]]],
+    'single_point': [[[12, 30]]],
+    'collinear_row': [[[3, 7], [20, 7], [9, 7]]],
+    'collinear_diagonal': [[[2, 3], [14, 15], [8, 9], [20, 21]]],
+    'collinear_column': [[[15, 5], [15, 6], [15, 9], [15, 7]]],
+    # Partly out of the image
+    'clipped': [[[-6, 10], [20, -4], [45, 20], [20, 50]]],
+}
+
+
+@pytest.mark.parametrize('compiled', [True, False])
+@pytest.mark.parametrize('name', CONTOURS)
+def test_reference_fill(name, compiled):
+    parts = CONTOURS[name]
+    mask = segmentation_mask.rasterize_polygon([np.array(part) for part in parts], NROW, NCOL, dtype=bool,
+                                               compiled=compiled)
+    expected = reference_fill(parts, NROW, NCOL) | reference_outline(parts, NROW, NCOL)
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_degenerate_contours_are_their_outline():
+    for name in ['single_point', 'collinear_row', 'collinear_diagonal', 'collinear_column']:
+        parts = CONTOURS[name]
+        mask = segmentation_mask.rasterize_polygon(np.array(parts[0]), NROW, NCOL, dtype=bool)
+        np.testing.assert_array_equal(mask, reference_outline(parts, NROW, NCOL))
+    assert segmentation_mask.rasterize_polygon(np.array(CONTOURS['single_point'][0]), NROW, NCOL).sum() == 1
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_random_contours_in_mm(seed):
+    """Not rounded contours (converted from mm): same fill away from the edges, for both paths"""
+    rng = np.random.default_rng(seed)
+    npoints = rng.integers(5, 40)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, npoints))
+    radius = rng.uniform(4, 16) * (1 + 0.4 * rng.standard_normal(npoints))
+    parts = [np.c_[NCOL / 2 + radius * np.cos(angles), NROW / 2 + radius * np.sin(angles)]]
+
+    compiled = segmentation_mask.rasterize_polygon(parts, NROW, NCOL, dtype=bool, compiled=True)
+    numpy = segmentation_mask.rasterize_polygon(parts, NROW, NCOL, dtype=bool, compiled=False)
+    np.testing.assert_array_equal(compiled, numpy)
+
+    away = distance_to_edges(parts, NROW, NCOL) > 1
+    np.testing.assert_array_equal(numpy[away], reference_fill(parts, NROW, NCOL)[away])
+    # The pixels of the contour points are in the mask
+    cols, rows = np.rint(parts[0]).astype(int).T
+    inside = (cols >= 0) & (cols < NCOL) & (rows >= 0) & (rows < NROW)
+    assert numpy[rows[inside], cols[inside]].all()
@@ -0,0 +1,44 @@
+import json
+from functools import partial
+
+import pytest
+
+import checkpoint
+import repair_log
+
+
+def repair_unit(unit, fail_on=None):
+    """Work unit returning one repair record, failing on the given unit"""
+    if unit == fail_on:
+        raise RuntimeError(f"unit {unit} failed")
+    return {'repairs': [{'patient': f"P{unit}", 'image': f"P{unit}_0", 'event': 'row_added'}]}
+
+
+def read_records(output_folder):
+    records = []
+    for path in sorted((output_folder / repair_log.LOGS_FOLDER_NAME).glob('*.jsonl')):
+        with open(path, mode='r') as file:
+            records.append([json.loads(line)['patient'] for line in file])
+    return records
+
+
+def test_records_are_written_as_units_complete(tmp_path):
+    repairs = repair_log.RepairLog(tmp_path)
+    with pytest.raises(RuntimeError):
+        checkpoint.run(partial(repair_unit, fail_on=2), range(4), str, {}, tmp_path, workers=1,
+                       on_result=repairs.log_result)
+    # The run stopped before close(), the completed units are logged
+    assert read_records(tmp_path) == [['P0', 'P1']]
+
+
+def test_resumed_run_logs_the_new_units_only(tmp_path):
+    with pytest.raises(RuntimeError):
+        checkpoint.run(partial(repair_unit, fail_on=2), range(4), str, {}, tmp_path, workers=1,
+                       on_result=repair_log.RepairLog(tmp_path).log_result)
+    # Second run, in another log file
+    repairs = repair_log.RepairLog(tmp_path)
+    repairs.path = repairs.path.with_name('z_' + repairs.path.name)
+    results = checkpoint.run(repair_unit, range(4), str, {}, tmp_path, workers=1, on_result=repairs.log_result)
+    repairs.close()
+    assert read_records(tmp_path) == [['P0', 'P1'], ['P2', 'P3']]
+    assert [result['repairs'][0]['patient'] for result in results] == ['P0', 'P1', 'P2', 'P3']
@@ -0,0 +1,167 @@
+import warnings
+
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset
+
+import segmentation_mask
+import segmentation_mask_baseline
+
+
+NROW, NCOL = 48, 40
+
+
+def make_image(uid, position=(-120.0, -80.0, 10.0), spacing=(0.75, 0.75), orientation=(1, 0, 0, 0, 1, 0)):
+    """Header of a slice, as read by create_segmentation_mask()"""
+    image = Dataset()
+    image.SOPInstanceUID = uid
+    image.Rows, image.Columns = NROW, NCOL
+    image.ImagePositionPatient = list(position)
+    image.PixelSpacing = list(spacing)
+    image.ImageOrientationPatient = list(orientation)
+    return image
+
+
+def log_line(record):
+    """Line written by the baseline for a repair record"""
+    if record['event'] == 'row_missing':
+        return f"Row {record['row']} is missing"
+    (a, b, c), bound, before, after = record['rows'], record['bound'], record['before'], record['after']
+    return (f"Rows {a} - {b} - {c} have {bound} absurd value. "
+            f"Before: {before[0]} - {before[1]} - {before[2]}. After: {after[0]} - {after[1]} - {after[2]}")
+
+
+def baseline(image, contour, tmp_path, conversion):
+    """Mask and log lines of the baseline"""
+    with warnings.catch_warnings():
+        # Zero averages (column 0) divide by zero, as in the previous versions
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mask = segmentation_mask_baseline.create_segmentation_mask(image, contour, tmp_path, conversion)
+    log_path = tmp_path / 'segmentationMasksLogs' / f"{image.SOPInstanceUID}_logs.txt"
+    lines = log_path.read_text().splitlines() if log_path.exists() else []
+    return mask, lines
+
+
+def assert_same_as_baseline(contour, tmp_path, conversion=False, uid='1.2.3'):
+    image = make_image(uid)
+    expected_mask, expected_lines = baseline(image, contour, tmp_path, conversion)
+    repairs = []
+    mask = segmentation_mask.create_segmentation_mask(image, contour, tmp_path, conversion, fill_method='span',
+                                                      dtype=np.float64, repairs=repairs)
+    assert mask.dtype == expected_mask.dtype
+    np.testing.assert_array_equal(mask, expected_mask)
+    assert [log_line(record) for record in repairs] == expected_lines
+    assert all(record['sop_uid'] == uid for record in repairs)
+    return repairs
+
+
+# Contours in image coordinates (column, row)
+CONTOURS = {
+    'single_point': [[12, 30]],
+    'same_row': [[3, 7], [20, 7], [9, 7]],
+    'vertical_line': [[15, 5], [15, 6], [15, 7], [15, 8], [15, 9]],
+    'two_points_gap': [[10, 5], [25, 20]],
+    'column_zero': [[0, 10], [5, 11], [0, 12], [6, 13], [0, 14]],
+    'concave_c': [[30, 5], [10, 5], [6, 10], [5, 20], [6, 30], [10, 35], [30, 35], [30, 30], [14, 28],
+                  [12, 20], [14, 12], [30, 10]],
+    'concave_star': [[20, 2], [23, 14], [36, 14], [26, 22], [30, 35], [20, 27], [10, 35], [14, 22], [4, 14],
+                     [17, 14]],
+    'zigzag_rows': [[5, 10], [30, 11], [6, 12], [31, 13], [5, 14], [2, 18], [35, 18], [4, 25], [33, 25]],
+    'sparse_rows': [[8, 1], [9, 9], [30, 9], [10, 25], [29, 40], [15, 47]],
+    'last_column': [[39, 0], [0, 47], [39, 47], [0, 0]],
+    # Negative coordinates are out of the image, and index from the end (as in the baseline)
+    'negative_wrap': [[-1, 5], [10, 6], [-3, 7], [4, -2], [12, -1]],
+}
+
+
+@pytest.mark.parametrize('name', CONTOURS)
+def test_recorded_contours(name, tmp_path):
+    assert_same_as_baseline(np.array(CONTOURS[name]), tmp_path)
+
+
+def test_recorded_contours_repair(tmp_path):
+    """The recorded contours cover both kinds of repairs"""
+    events = set()
+    for index, contour in enumerate(CONTOURS.values()):
+        repairs = assert_same_as_baseline(np.array(contour), tmp_path, uid=f"1.2.9.{index}")
+        events.update(record['event'] for record in repairs)
+    assert events == {'row_missing', 'absurd_value'}
+
+
+@pytest.mark.parametrize('contour', [[[NCOL, 5], [3, 6]], [[3, 5], [4, NROW]]])
+def test_out_of_image_raises(contour, tmp_path):
+    image = make_image('1.2.4')
+    with pytest.raises(IndexError):
+        baseline(image, np.array(contour), tmp_path, False)
+    with pytest.raises(IndexError):
+        segmentation_mask.create_segmentation_mask(image, np.array(contour), tmp_path, False, fill_method='span')
+
+
+def test_contour_in_mm(tmp_path):
+    # Outline of a concave nodule in mm (x, y)
+    angles = np.linspace(0, 2 * np.pi, 40, endpoint=False)
+    radius = 8 * (1 + 0.4 * np.cos(3 * angles))
+    contour = np.c_[-105 + radius * np.cos(angles), -62 + radius * np.sin(angles)]
+    assert_same_as_baseline(contour, tmp_path, conversion=True)
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_random_contours(seed, tmp_path):
+    """Noisy blobs, random points and sparse zig-zag rows (chains of corrections)"""
+    rng = np.random.default_rng(seed)
+    for case in range(60):
+        kind = case % 3
+        if kind == 0:
+            npoints = rng.integers(3, 40)
+            angles = np.sort(rng.uniform(0, 2 * np.pi, npoints))
+            radius = rng.uniform(2, 18) * (1 + 0.5 * rng.standard_normal(npoints))
+            contour = np.rint(np.c_[20 + radius * np.cos(angles), 24 + radius * np.sin(angles)])
+            contour = contour.clip(0, [NCOL - 1, NROW - 1]).astype(int)
+        elif kind == 1:
+            npoints = rng.integers(1, 50)
+            contour = np.c_[rng.integers(0, rng.integers(1, NCOL), npoints), rng.integers(0, NROW, npoints)]
+        else:
+            npoints = rng.integers(1, 20)
+            rows = np.sort(rng.choice(NROW, npoints, replace=False))
+            contour = np.c_[np.r_[rng.integers(0, NCOL, npoints), rng.integers(0, NCOL, npoints)], np.r_[rows, rows]]
+        assert_same_as_baseline(contour, tmp_path, uid=f"1.2.{seed}.{case}")
+
+
+# Oblique slice, rotated around the z axis and tilted
+OBLIQUE = (0.9, 0.3, 0.31622777, -0.25, 0.95, 0.18708287)
+
+
+def solve_points(image, points):
+    """Per point conversion, solving the equations of each point (as the previous versions)"""
+    Sx, Sy, _Sz = image.ImagePositionPatient
+    Di, Dj = image.PixelSpacing
+    Xx, Xy, _Xz, Yx, Yy, _Yz = image.ImageOrientationPatient
+    a = np.array([[Xx * Di, Yx * Dj], [Xy * Di, Yy * Dj]])
+    return np.array([np.linalg.solve(a, [Px - Sx, Py - Sy]) for Px, Py in points[:, :2]])
+
+
+def test_oblique_conversion():
+    image = make_image('1.2.5', position=(-110.5, -75.25, 3.0), spacing=(0.7, 0.9), orientation=OBLIQUE)
+    rng = np.random.default_rng(0)
+    # ContourData points (x, y, z)
+    points = np.c_[rng.uniform(-130, 30, (200, 2)), np.full(200, 3.0)]
+    np.testing.assert_allclose(segmentation_mask.mm_to_imagecoordinates_array(image, points),
+                               solve_points(image, points), rtol=0, atol=1e-9)
+    assert [segmentation_mask.mm_to_imagecoordinates(image, point) for point in points[:20]] == \
+           [segmentation_mask_baseline.mm_to_imagecoordinates(image, point[:2]) for point in points[:20]]
+
+
+def test_same_uid_different_geometry():
+    """The transform is cached with the geometry, a reused SOPInstanceUID does not get the transform of another slice"""
+    points = np.array([[-100.0, -60.0], [-20.0, 15.5]])
+    images = [make_image('1.2.6'), make_image('1.2.6', position=(-90.0, -70.0, 10.0)),
+              make_image('1.2.6', spacing=(0.5, 0.6)), make_image('1.2.6', orientation=OBLIQUE)]
+    for _ in range(2):
+        for image in images:
+            np.testing.assert_allclose(segmentation_mask.mm_to_imagecoordinates_array(image, points),
+                                       solve_points(image, points), rtol=0, atol=1e-9)
+    transforms = [segmentation_mask.get_image_transform(image) for image in images]
+    assert len({id(inverse) for inverse, _origin in transforms}) == len(images)
+    # The cached transform is shared by the slices of the same geometry, and cannot be modified
+    inverse, _origin = segmentation_mask.get_image_transform(make_image('1.2.6'))
+    assert inverse is transforms[0][0] and not inverse.flags.writeable